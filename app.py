@@ -1,40 +1,94 @@
 import os
+import json
+import time
 import logging
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory
+from functools import partial
+from flask import Flask, Blueprint, Response, current_app, request, jsonify, send_from_directory
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from flask_migrate import Migrate, upgrade, stamp
 from werkzeug.utils import secure_filename
-from models import db, User, Project, Document, Output
-from utils.file_handler import save_uploaded_file, get_file_content, process_outline
-from utils.pdf_processor import process_pdfs
-from utils.gpt4_processor import generate_narrative
+from models import db, User, Project, Document, Output, ProcessingJob, UploadSession, TimelineEvent
+from utils.file_handler import save_uploaded_file
+from utils.pipeline import stream_project_narrative, restore_output
+from utils.gpt4_processor import TokenUsage
+from utils.versions import VersionError, KINDS as VERSION_KINDS, get_version, list_versions, diff_versions
+from utils.http_cache import make_etag, not_modified, cached_json_response, file_response
+from utils.uploads import (
+    UploadError, BulkUploadError, UPLOAD_CHUNK_SIZE, start_upload, append_chunk, complete_upload, expire_uploads,
+    ingest_documents, record_document
+)
+from utils.jobs import (
+    init_job_queue, enqueue_project_processing, enqueue_document_extraction, get_latest_job, get_slowest_jobs,
+    job_status, add_extraction_jobs, submit_jobs, enqueue_export, start_stream_job, finish_stream_job
+)
+from utils.render import (
+    KINDS, MIMETYPES, FRAGMENT, EXPORT_BACKGROUND_MIN_CHARS, format_available, make_render_key, get_rendered,
+    render_output, output_hash, output_text, export_filename
+)
+from utils import metrics
+from utils.search import SearchError, search_pages, is_search_index_object
+from utils.timeline import events_from_outline, filter_events, load_events, render_markdown
+from datetime import date
+from sqlalchemy import inspect
 from sqlalchemy.exc import SQLAlchemyError
-from io import BytesIO
-import markdown
+from sqlalchemy.orm import selectinload
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__, static_folder='static/dist')
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Revision matching the schema the app used to create with db.create_all()
+BASELINE_REVISION = '0001_baseline'
 
-# Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
-if not app.config['SQLALCHEMY_DATABASE_URI']:
-    raise ValueError("DATABASE_URL environment variable is not set")
+bp = Blueprint('main', __name__)
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
+migrate = Migrate()
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+def include_in_migrations(obj, name, type_, reflected, compare_to):
+    # The search index is created by hand in a migration, not from the models
+    return not (reflected and compare_to is None and is_search_index_object(name))
 
-# Initialize extensions
-db.init_app(app)
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+def create_app(config=None):
+    """Build the Flask app.
+
+    Nothing here touches the network: the database, OpenAI and storage
+    clients connect on first use, and the schema is managed by migrations
+    (flask --app main db upgrade) rather than created on import.
+    """
+    app = Flask(__name__, static_folder='static/dist')
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
+    # Uploads are streamed to storage in chunks, so this bounds request size, not memory
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', str(512 * 1024 * 1024)))
+
+    # Database configuration
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if config:
+        app.config.update(config)
+    if not app.config['SQLALCHEMY_DATABASE_URI']:
+        raise ValueError("DATABASE_URL environment variable is not set")
+
+    # Initialize extensions
+    db.init_app(app)
+    login_manager.init_app(app)
+    migrate.init_app(app, db, directory=MIGRATIONS_DIR, include_object=include_in_migrations)
+    app.register_blueprint(bp)
+
+    # Background workers for project processing; queued jobs are resumed
+    # without holding up startup
+    init_job_queue(app)
+    return app
 
-# Create database tables
-with app.app_context():
-    db.create_all()
+def upgrade_schema(app):
+    """Apply pending migrations. Databases created by db.create_all() before
+    migrations existed are stamped at the baseline first."""
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+        if 'users' in tables and 'alembic_version' not in tables:
+            stamp(directory=MIGRATIONS_DIR, revision=BASELINE_REVISION)
+        upgrade(directory=MIGRATIONS_DIR)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -44,8 +98,46 @@ def load_user(user_id):
         logger.error(f"Error loading user: {e}")
         return None
 
+PROJECTS_PER_PAGE = 50
+MAX_PROJECTS_PER_PAGE = 200
+
+def project_listing_query(user_id):
+    """(Project, has_output) rows for a user, newest first.
+
+    Documents are loaded for the whole page in one extra query and has_output
+    is an EXISTS subquery, so listing costs a fixed number of queries however
+    many projects there are.
+    """
+    has_output = db.exists().where(Output.project_id == Project.id).label('has_output')
+    return db.session.query(Project, has_output).filter(
+        Project.user_id == user_id
+    ).options(
+        selectinload(Project.documents)
+    ).order_by(Project.created_at.desc(), Project.id.desc())
+
+def project_to_dict(project, has_output):
+    return {
+        'id': project.id,
+        'name': project.name,
+        'created_at': project.created_at.isoformat(),
+        'archived': project.archived,
+        'documents': [{
+            'id': doc.id,
+            'filename': doc.filename,
+            'file_type': doc.file_type,
+            'page_count': doc.page_count,
+            'extraction_status': doc.extraction_status,
+            'coverage': {
+                'text_pages': doc.text_pages,
+                'ocr_pages': doc.ocr_pages,
+                'failed_pages': doc.failed_pages
+            }
+        } for doc in project.documents],
+        'has_output': bool(has_output)
+    }
+
 # API Routes
-@app.route('/api/login', methods=['POST'])
+@bp.route('/api/login', methods=['POST'])
 def api_login():
     data = request.get_json()
     user = User.query.filter_by(username=data['username']).first()
@@ -57,13 +149,13 @@ def api_login():
         })
     return jsonify({'success': False}), 401
 
-@app.route('/api/logout')
+@bp.route('/api/logout')
 @login_required
 def api_logout():
     logout_user()
     return jsonify({'success': True})
 
-@app.route('/api/check_auth')
+@bp.route('/api/check_auth')
 def check_auth():
     if current_user.is_authenticated:
         return jsonify({
@@ -72,7 +164,7 @@ def check_auth():
         })
     return jsonify({'authenticated': False}), 401
 
-@app.route('/api/register', methods=['POST'])
+@bp.route('/api/register', methods=['POST'])
 def api_register():
     try:
         data = request.get_json()
@@ -94,7 +186,7 @@ def api_register():
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects', methods=['GET', 'POST'])
+@bp.route('/api/projects', methods=['GET', 'POST'])
 @login_required
 def api_projects():
     if request.method == 'POST':
@@ -112,68 +204,91 @@ def api_projects():
             
             return jsonify({
                 'success': True,
-                'project': {
-                    'id': project.id,
-                    'name': project.name,
-                    'created_at': project.created_at.isoformat(),
-                    'archived': project.archived,
-                    'documents': [],
-                    'has_output': False
-                }
+                'project': project_to_dict(project, False)
             })
         except Exception as e:
             logger.error(f"Error creating project: {str(e)}")
             db.session.rollback()
             return jsonify({'success': False, 'message': 'Error creating project'}), 500
 
-    # GET request
-    active_projects = Project.query.filter_by(user_id=current_user.id, archived=False).all()
-    archived_projects = Project.query.filter_by(user_id=current_user.id, archived=True).all()
-    
-    def project_to_dict(project):
-        return {
-            'id': project.id,
-            'name': project.name,
-            'created_at': project.created_at.isoformat(),
-            'archived': project.archived,
-            'documents': [{
-                'id': doc.id,
-                'filename': doc.filename,
-                'file_type': doc.file_type
-            } for doc in project.documents],
-            'has_output': bool(project.output)
-        }
-    
-    return jsonify({
-        'active_projects': [project_to_dict(p) for p in active_projects],
-        'archived_projects': [project_to_dict(p) for p in archived_projects]
-    })
+    # GET request: ?page=&per_page= paginate each list, ?archived=true|false
+    # returns only that list and ?q= filters by project name
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', PROJECTS_PER_PAGE, type=int), 1), MAX_PROJECTS_PER_PAGE)
+    archived = request.args.get('archived')
+    search = request.args.get('q', '').strip()
+
+    response = {'pagination': {'page': page, 'per_page': per_page}}
+    for key, is_archived in (('active_projects', False), ('archived_projects', True)):
+        if archived is not None and (archived.lower() == 'true') != is_archived:
+            continue
+        query = project_listing_query(current_user.id).filter(Project.archived == is_archived)
+        if search:
+            query = query.filter(Project.name.ilike(f'%{search}%'))
+        total = query.order_by(None).count()
+        rows = query.limit(per_page).offset((page - 1) * per_page).all()
+        response[key] = [project_to_dict(project, has_output) for project, has_output in rows]
+        response['pagination'][f'{key}_total'] = total
+
+    return jsonify(response)
 
-@app.route('/api/projects/<int:project_id>/timeline')
+def get_output_for_etag(project_id):
+    """The project's Output with its hashes, content columns left unloaded"""
+    output = Output.query.filter_by(project_id=project_id).first()
+    if output and (output.timeline_hash is None or output.narrative_hash is None):
+        # Written before content hashes existed; backfill once
+        output.update_hashes()
+        db.session.commit()
+    return output
+
+@bp.route('/api/projects/<int:project_id>/timeline')
 @login_required
 def api_project_timeline(project_id):
+    """The project's timeline; ?start= and/or ?end= (YYYY-MM-DD) return only
+    the events dated in that range, rendered from the stored events"""
     try:
         project = Project.query.get_or_404(project_id)
         if project.user_id != current_user.id:
             return jsonify({'success': False, 'message': 'Unauthorized'}), 403
 
-        output = Output.query.filter_by(project_id=project_id).first()
+        try:
+            start, end = (date.fromisoformat(request.args[key]) if request.args.get(key) else None
+                          for key in ('start', 'end'))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'start and end must be dates (YYYY-MM-DD)'}), 400
+
+        output = get_output_for_etag(project_id)
         if not output:
             return jsonify({'success': False, 'message': 'No output found'}), 404
 
-        return jsonify({
+        etag = make_etag(output.timeline_hash, project.name, start, end)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        response = {
             'success': True,
             'project': {
                 'id': project.id,
                 'name': project.name
-            },
-            'timeline_content': output.timeline_content
-        })
+            }
+        }
+        if start or end:
+            events = load_events(project_id, start, end)
+            if not events and not TimelineEvent.query.filter_by(project_id=project_id).first():
+                # Timeline built before events were stored
+                events = filter_events(events_from_outline(output.timeline_content or ''), start, end)
+            response['timeline_content'] = render_markdown(events)
+            response['events'] = [event.to_dict() for event in events]
+            response['range'] = {'start': start and start.isoformat(), 'end': end and end.isoformat()}
+        else:
+            response['timeline_content'] = output.timeline_content
+        return cached_json_response(response, etag)
     except Exception as e:
         logger.error(f"Error fetching timeline: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects/<int:project_id>/narrative')
+@bp.route('/api/projects/<int:project_id>/narrative')
 @login_required
 def api_project_narrative(project_id):
     try:
@@ -181,23 +296,185 @@ def api_project_narrative(project_id):
         if project.user_id != current_user.id:
             return jsonify({'success': False, 'message': 'Unauthorized'}), 403
 
-        output = Output.query.filter_by(project_id=project_id).first()
+        output = get_output_for_etag(project_id)
         if not output:
             return jsonify({'success': False, 'message': 'No output found'}), 404
 
-        return jsonify({
+        # ?html=1 adds the narrative rendered server-side, from the render cache
+        with_html = request.args.get('html') == '1'
+        etag = make_etag(output.narrative_hash, project.name, with_html)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        response = {
             'success': True,
             'project': {
                 'id': project.id,
                 'name': project.name
             },
             'narrative_content': output.narrative_content
-        })
+        }
+        if with_html:
+            response['narrative_html'] = render_output(output, 'narrative', FRAGMENT, project.name)[1].decode('utf-8')
+        return cached_json_response(response, etag)
     except Exception as e:
         logger.error(f"Error fetching narrative: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects/<int:project_id>/archive', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/export/<kind>.<fmt>')
+@login_required
+def api_export_output(project_id, kind, fmt):
+    """Download the narrative or timeline as html, docx or pdf.
+
+    Exports come from the render cache while the content is unchanged. A
+    large DOCX or PDF that is not cached yet is rendered in the background:
+    the response is then a 202 with the export job, and the download is
+    ready once the job has succeeded.
+    """
+    try:
+        project = Project.query.get_or_404(project_id)
+        if project.user_id != current_user.id:
+            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+        if kind not in KINDS or fmt not in MIMETYPES:
+            return jsonify({'success': False, 'message': 'Unknown export'}), 404
+        if not format_available(fmt):
+            return jsonify({'success': False, 'message': f'{fmt.upper()} export is not available on this server'}), 501
+
+        output = get_output_for_etag(project_id)
+        if not output:
+            return jsonify({'success': False, 'message': 'No output found'}), 404
+
+        cache_key = make_render_key(output_hash(output, kind), kind, fmt, project.name)
+        etag = cache_key[:32]
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        data = get_rendered(cache_key)
+        if data is None:
+            if fmt != 'html' and len(output_text(output, kind) or '') >= EXPORT_BACKGROUND_MIN_CHARS:
+                job = enqueue_export(project_id, current_user.id, f'{kind}.{fmt}')
+                return jsonify({'success': True, 'job': job_status(job)}), 202
+            data = render_output(output, kind, fmt, project.name)[1]
+        return file_response(data, MIMETYPES[fmt], etag, export_filename(project.name, kind, fmt))
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error exporting {kind}.{fmt}: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/projects/<int:project_id>/versions')
+@login_required
+def api_output_versions(project_id):
+    """Every saved version of the project's output, newest first, without content"""
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    output = Output.query.filter_by(project_id=project_id).first()
+    return jsonify({
+        'success': True,
+        'latest': output.version if output else None,
+        'versions': [version.to_dict() for version in list_versions(project_id)]
+    })
+
+@bp.route('/api/projects/<int:project_id>/versions/<int:version>')
+@login_required
+def api_output_version(project_id, version):
+    try:
+        project = Project.query.get_or_404(project_id)
+        if project.user_id != current_user.id:
+            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+        output = get_output_for_etag(project_id)
+        if not output:
+            return jsonify({'success': False, 'message': 'No output found'}), 404
+
+        # A version never changes, except the latest while it is a draft
+        etag = make_etag('version', project_id, version,
+                         *((output.timeline_hash, output.narrative_hash) if version == output.version else ()))
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        timeline_content, narrative_content = get_version(output, version)
+        return cached_json_response({
+            'success': True,
+            'version': version,
+            'latest': output.version,
+            'timeline_content': timeline_content,
+            'narrative_content': narrative_content
+        }, etag)
+    except VersionError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error fetching output version: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/projects/<int:project_id>/versions/diff')
+@login_required
+def api_output_diff(project_id):
+    """Unified diff between two versions: ?from=&to= (default: the latest) and ?kind=narrative|timeline"""
+    try:
+        project = Project.query.get_or_404(project_id)
+        if project.user_id != current_user.id:
+            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+        output = get_output_for_etag(project_id)
+        if not output:
+            return jsonify({'success': False, 'message': 'No output found'}), 404
+
+        kind = request.args.get('kind', 'narrative')
+        from_version = request.args.get('from', type=int)
+        to_version = request.args.get('to', output.version, type=int)
+        if kind not in VERSION_KINDS or from_version is None:
+            return jsonify({'success': False, 'message': 'Give from (a version number) and kind (narrative or timeline)'}), 400
+
+        etag = make_etag('diff', project_id, kind, from_version, to_version, output.narrative_hash, output.timeline_hash)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        diff, added, removed = diff_versions(output, from_version, to_version, kind)
+        return cached_json_response({
+            'success': True,
+            'kind': kind,
+            'from': from_version,
+            'to': to_version,
+            'added_lines': added,
+            'removed_lines': removed,
+            'diff': diff
+        }, etag)
+    except VersionError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except Exception as e:
+        logger.error(f"Error diffing output versions: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/projects/<int:project_id>/versions/<int:version>/restore', methods=['POST'])
+@login_required
+def api_restore_version(project_id, version):
+    """Make an earlier version the newest one again, without calling the model"""
+    try:
+        project = Project.query.get_or_404(project_id)
+        if project.user_id != current_user.id:
+            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+        latest = get_latest_job(project_id)
+        if latest and latest.status in ('queued', 'running'):
+            return jsonify({'success': False, 'message': 'Project is being processed'}), 409
+
+        output = restore_output(project_id, version)
+        return jsonify({'success': True, 'restored': version, 'version': output.version})
+    except VersionError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error restoring output version: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/projects/<int:project_id>/archive', methods=['POST'])
 @login_required
 def api_archive_project(project_id):
     try:
@@ -212,7 +489,7 @@ def api_archive_project(project_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects/<int:project_id>/unarchive', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/unarchive', methods=['POST'])
 @login_required
 def api_unarchive_project(project_id):
     try:
@@ -227,7 +504,7 @@ def api_unarchive_project(project_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects/<int:project_id>/upload_outline', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/upload_outline', methods=['POST'])
 @login_required
 def api_upload_outline(project_id):
     if 'outline' not in request.files:
@@ -243,14 +520,11 @@ def api_upload_outline(project_id):
             return jsonify({'success': False, 'message': 'Unauthorized'}), 403
         
         filename = secure_filename(file.filename)
-        save_uploaded_file(file, filename, current_user.id, project_id)
+        content_hash = save_uploaded_file(file, filename, current_user.id, project_id)
+        if not content_hash:
+            return jsonify({'success': False, 'message': 'Error saving file to storage'}), 500
         
-        document = Document(
-            project_id=project_id,
-            filename=filename,
-            file_type='outline'
-        )
-        db.session.add(document)
+        document = record_document(project_id, filename, 'outline', content_hash)
         db.session.commit()
         
         return jsonify({
@@ -265,9 +539,11 @@ def api_upload_outline(project_id):
         db.session.rollback()
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/projects/<int:project_id>/upload_documents', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/upload_documents', methods=['POST'])
 @login_required
 def api_upload_documents(project_id):
+    """Store several supporting documents at once; the response lists what
+    happened to each file (see ingest_documents)"""
     if 'documents' not in request.files:
         return jsonify({'success': False, 'message': 'No files uploaded'}), 400
     
@@ -275,137 +551,250 @@ def api_upload_documents(project_id):
         project = Project.query.get_or_404(project_id)
         if project.user_id != current_user.id:
             return jsonify({'success': False, 'message': 'Unauthorized'}), 403
-        
-        documents = []
-        files = request.files.getlist('documents')
-        
-        for file in files:
-            if file.filename:
-                filename = secure_filename(file.filename)
-                save_uploaded_file(file, filename, current_user.id, project_id)
-                
-                document = Document(
-                    project_id=project_id,
-                    filename=filename,
-                    file_type='supporting'
-                )
-                db.session.add(document)
-                documents.append({
-                    'filename': filename,
-                    'file_type': 'supporting'
-                })
-        
+
+        job_ids = []
+        results, _ = ingest_documents(
+            current_user.id, project_id, request.files.getlist('documents'),
+            before_commit=lambda document_ids: job_ids.extend(
+                add_extraction_jobs(project_id, current_user.id, document_ids)
+            )
+        )
+
+        # Parse the PDFs in the background so processing can use stored text
+        submit_jobs(job_ids)
+
+        return jsonify({
+            'success': True,
+            'documents': [
+                {'filename': result['stored_as'], 'file_type': 'supporting'}
+                for result in results if result['status'] == 'stored'
+            ],
+            'files': results
+        })
+    except BulkUploadError as e:
+        return jsonify({'success': False, 'message': str(e), 'files': e.results}), e.status
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/projects/<int:project_id>/uploads', methods=['POST'])
+@login_required
+def api_start_upload(project_id):
+    """Open a resumable upload; the file is then PUT in chunks to /api/uploads/<id>"""
+    try:
+        project = Project.query.get_or_404(project_id)
+        if project.user_id != current_user.id:
+            return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+        data = request.get_json() or {}
+        filename = secure_filename(data.get('filename') or '')
+        file_type = data.get('file_type', 'supporting')
+        if not filename or file_type not in ('outline', 'supporting') or 'size' not in data:
+            return jsonify({'success': False, 'message': 'filename, file_type and size are required'}), 400
+
+        expire_uploads()
+        upload = start_upload(current_user.id, project_id, filename, file_type, int(data['size']))
+        return jsonify({'success': True, 'upload': upload.to_dict(), 'chunk_size': UPLOAD_CHUNK_SIZE})
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), e.status
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error starting upload: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/uploads/<upload_id>', methods=['GET', 'PUT'])
+@login_required
+def api_upload_chunk(upload_id):
+    """GET reports the received offset; PUT ?offset=N appends the request body"""
+    upload = UploadSession.query.get_or_404(upload_id)
+    if upload.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+    if request.method == 'GET':
+        return jsonify({'success': True, 'upload': upload.to_dict()})
+
+    try:
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({'success': False, 'message': 'offset is required'}), 400
+        append_chunk(upload, offset, request.stream)
+        return jsonify({'success': True, 'upload': upload.to_dict()})
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e), 'upload': upload.to_dict()}), e.status
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error receiving upload chunk: {str(e)}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@bp.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def api_complete_upload(upload_id):
+    upload = UploadSession.query.get_or_404(upload_id)
+    if upload.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    try:
+        content_hash = complete_upload(upload)
+        document = record_document(upload.project_id, upload.filename, upload.file_type, content_hash)
         db.session.commit()
+
+        if document.file_type == 'supporting':
+            enqueue_document_extraction(document, current_user.id)
+
         return jsonify({
             'success': True,
-            'documents': documents
+            'document': {
+                'id': document.id,
+                'filename': document.filename,
+                'file_type': document.file_type
+            }
         })
+    except UploadError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), e.status
     except Exception as e:
         db.session.rollback()
+        logger.error(f"Error completing upload: {str(e)}")
         return jsonify({'success': False, 'message': str(e)}), 500
 
-@app.route('/api/current_project')
+@bp.route('/api/current_project')
 @login_required
 def api_current_project():
-    if not current_user.projects:
+    # Get the most recent project
+    row = project_listing_query(current_user.id).first()
+    if not row:
         return jsonify({'project': None})
     
-    project = current_user.projects[-1]  # Get the most recent project
-    return jsonify({
-        'project': {
-            'id': project.id,
-            'name': project.name,
-            'created_at': project.created_at.isoformat(),
-            'archived': project.archived,
-            'documents': [{
-                'id': doc.id,
-                'filename': doc.filename,
-                'file_type': doc.file_type
-            } for doc in project.documents],
-            'has_output': bool(project.output)
-        }
-    })
+    project, has_output = row
+    return jsonify({'project': project_to_dict(project, has_output)})
 
-@app.route('/api/projects/<int:project_id>/process', methods=['POST'])
+@bp.route('/api/projects/<int:project_id>/process', methods=['POST'])
 @login_required
 def api_process_project(project_id):
     try:
         project = Project.query.get_or_404(project_id)
         if project.user_id != current_user.id:
             return jsonify({'success': False, 'message': 'Unauthorized'}), 403
-            
-        # Get outline content
+
         outline_doc = Document.query.filter_by(
             project_id=project_id,
             file_type='outline'
         ).first()
         if not outline_doc:
             return jsonify({'success': False, 'message': 'Outline document not found'}), 404
-            
-        outline_content = get_file_content(current_user.id, project_id, outline_doc.filename)
-        if not outline_content:
-            return jsonify({'success': False, 'message': 'Could not read outline content'}), 500
-            
-        # Process outline to create timeline
-        timeline_content = process_outline(outline_content)
-        if not timeline_content:
-            return jsonify({'success': False, 'message': 'Error processing outline'}), 500
-            
-        # Get supporting documents content
-        supporting_docs = Document.query.filter_by(
-            project_id=project_id,
-            file_type='supporting'
-        ).all()
-        
-        pdf_contents = []
-        for doc in supporting_docs:
-            content = get_file_content(current_user.id, project_id, doc.filename)
-            if content:
-                pdf_contents.append(content)
-                
-        if not pdf_contents:
-            return jsonify({'success': False, 'message': 'No readable supporting documents found'}), 500
-                
-        # Generate narrative using GPT-4
-        narrative_content = generate_narrative(timeline_content, pdf_contents)
-        if not narrative_content:
-            return jsonify({'success': False, 'message': 'Error generating narrative'}), 500
-        
-        # Save output
-        output = Output.query.filter_by(project_id=project_id).first()
-        if output:
-            output.timeline_content = timeline_content
-            output.narrative_content = narrative_content
-        else:
-            output = Output(
-                project_id=project_id,
-                timeline_content=timeline_content,
-                narrative_content=narrative_content
-            )
-            db.session.add(output)
-            
-        db.session.commit()
-        
+
+        # {"force": true} recomputes stages even if their inputs are unchanged;
+        # a run (or stream) still in flight is returned instead of a new one
+        force = bool((request.get_json(silent=True) or {}).get('force'))
+        job = enqueue_project_processing(project_id, current_user.id, force=force)
+        return jsonify({'success': True, 'job': job_status(job)}), 202
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error queueing project processing: {str(e)}")
+        return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
+
+@bp.route('/api/projects/<int:project_id>/narrative/stream')
+@login_required
+def api_stream_narrative(project_id):
+    """Regenerate the narrative, streaming it to the browser as Server-Sent Events"""
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    # Holds the same lock as processing jobs, so only one run writes the output
+    job_id = start_stream_job(project_id, current_user.id)
+    if job_id is None:
+        return jsonify({'success': False, 'message': 'Project is already being processed'}), 409
+
+    usage = TokenUsage(tenant=(current_user.id, project_id))
+    events = stream_project_narrative(current_app._get_current_object(), project_id, current_user.id, usage=usage,
+                                      on_finish=partial(finish_stream_job, job_id, usage=usage))
+
+    def generate():
+        for event, data in events:
+            if event == 'ping':
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@bp.route('/api/projects/<int:project_id>/jobs/latest')
+@login_required
+def api_project_latest_job(project_id):
+    project = Project.query.get_or_404(project_id)
+    if project.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    job = get_latest_job(project_id)
+    return jsonify({'success': True, 'job': job_status(job) if job else None})
+
+@bp.route('/api/jobs/<int:job_id>')
+@login_required
+def api_job_status(job_id):
+    job = ProcessingJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 403
+
+    return jsonify({'success': True, 'job': job_status(job)})
+
+@bp.route('/api/jobs/slowest')
+@login_required
+def api_slowest_jobs():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    jobs = get_slowest_jobs(current_user.id, limit=limit)
+    return jsonify({'success': True, 'jobs': [job.to_dict() for job in jobs]})
+
+@bp.route('/api/search')
+@login_required
+def api_search():
+    project_id = request.args.get('project_id', type=int)
+    limit = request.args.get('limit', 20, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    try:
+        started = time.perf_counter()
+        hits, has_more = search_pages(current_user.id, request.args.get('q', ''), project_id=project_id,
+                                      limit=limit, offset=offset)
         return jsonify({
             'success': True,
-            'output': {
-                'timeline_content': timeline_content,
-                'narrative_content': narrative_content
-            }
+            'results': hits,
+            'has_more': has_more,
+            'took_ms': round((time.perf_counter() - started) * 1000, 1)
         })
-        
+    except SearchError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error processing project: {str(e)}")
+        logger.error(f"Error searching documents: {str(e)}")
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'}), 500
 
-# Serve React App
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+@bp.route('/metrics')
+def prometheus_metrics():
+    if not metrics.METRICS_ENABLED:
+        return Response('Metrics are disabled\n', status=404, mimetype='text/plain')
+    if metrics.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {metrics.METRICS_TOKEN}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Serve React App; the login page is named so login_required can send
+# signed-out users to it
+@bp.route('/login')
+def login():
+    return send_from_directory(current_app.static_folder, 'index.html')
+
+@bp.route('/', defaults={'path': ''})
+@bp.route('/<path:path>')
 def serve(path):
-    if path and os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
-    return send_from_directory(app.static_folder, 'index.html')
+    if path and os.path.exists(os.path.join(current_app.static_folder, path)):
+        return send_from_directory(current_app.static_folder, path)
+    return send_from_directory(current_app.static_folder, 'index.html')
 
 if __name__ == '__main__':
+    app = create_app()
+    upgrade_schema(app)
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,332 @@
+"""ASGI server: the API's slow endpoints as async views in front of the Flask app.
+
+    uvicorn asgi:create_asgi_app --factory --host 0.0.0.0 --port 5000    (or: python asgi.py)
+
+Under `python main.py` every request holds a thread until it finishes, so a
+process serves as many narrative streams as it has threads, each thread idle
+while it waits on the model. Here the narrative stream, processing, bulk
+upload and timeline/narrative endpoints run on the event loop: the model is
+streamed from the async OpenAI client, the database is read through an async
+SQLAlchemy session (utils/async_db.py) and upload bodies are received
+without a thread. Work that is still synchronous - preparing a run's inputs,
+saving outputs, writing uploads to object storage, rendering - runs on a
+bounded pool of worker threads. Every other route is the Flask app's own,
+served on threads by a2wsgi, with the same session cookie.
+
+Needs the optional "asgi" dependencies. Compare the two servers with
+python -m benchmarks.load.
+"""
+import os
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import date
+from functools import partial
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import FileStorage
+from werkzeug.http import parse_accept_header, parse_etags
+from app import create_app, upgrade_schema
+from models import Project, Document, Output, TimelineEvent
+from utils.async_db import init_async_db, async_session, dispose_async_db
+from utils.http_cache import CACHE_CONTROL, make_etag, compress
+from utils.gpt4_processor import TokenUsage
+from utils.jobs import (
+    start_job_queue, submit_jobs, add_extraction_jobs, job_status, enqueue_project_processing, start_stream_job,
+    finish_stream_job
+)
+from utils.pipeline import stream_project_narrative_async, run_in_app_context
+from utils.render import FRAGMENT, render_output
+from utils.timeline import events_from_outline, filter_events, render_markdown, rows_to_events, select_events
+from utils.uploads import BulkUploadError, ingest_documents
+
+logger = logging.getLogger(__name__)
+
+# Threads for the synchronous work of async requests (see above)
+ASGI_WORKER_THREADS = int(os.environ.get('ASGI_WORKER_THREADS', '32'))
+# Threads serving the Flask routes
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '16'))
+
+def _user_id(request):
+    """The logged-in user's id from the Flask session cookie, or None"""
+    flask_app = request.app.state.flask_app
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        session = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    user_id = session.get('_user_id')
+    return int(user_id) if user_id else None
+
+def _error(message, status):
+    return JSONResponse({'success': False, 'message': message}, status_code=status)
+
+async def _owned_project(session, request):
+    """(project, None), or (None, error response) if it is missing or not the user's"""
+    user_id = _user_id(request)
+    if user_id is None:
+        return None, _error('Login required', 401)
+    project = await session.get(Project, request.path_params['project_id'])
+    if project is None:
+        return None, _error('Project not found', 404)
+    if project.user_id != user_id:
+        return None, _error('Unauthorized', 403)
+    return project, None
+
+async def _output_for_etag(session, project_id):
+    """The project's Output with its hashes, content columns left unloaded"""
+    output = await session.scalar(select(Output).filter_by(project_id=project_id))
+    if output and (output.timeline_hash is None or output.narrative_hash is None):
+        # Written before content hashes existed; backfill once
+        await session.refresh(output, ['timeline_content', 'narrative_content'])
+        output.update_hashes()
+        await session.commit()
+    return output
+
+def _cache_headers(etag):
+    return {'ETag': f'W/"{etag}"', 'Cache-Control': CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+
+def _not_modified(request, etag):
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return Response(status_code=304, headers=_cache_headers(etag))
+    return None
+
+def _cached_json(request, payload, etag):
+    body, encoding = compress(json.dumps(payload).encode('utf-8'),
+                              parse_accept_header(request.headers.get('accept-encoding')))
+    headers = _cache_headers(etag)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return Response(body, media_type='application/json', headers=headers)
+
+async def project_timeline(request):
+    """Async /api/projects/<id>/timeline, with the same ?start= and ?end="""
+    project_id = request.path_params['project_id']
+    try:
+        start, end = (date.fromisoformat(request.query_params[key]) if request.query_params.get(key) else None
+                      for key in ('start', 'end'))
+    except ValueError:
+        return _error('start and end must be dates (YYYY-MM-DD)', 400)
+
+    try:
+        async with async_session() as session:
+            project, error = await _owned_project(session, request)
+            if error:
+                return error
+            output = await _output_for_etag(session, project_id)
+            if not output:
+                return _error('No output found', 404)
+
+            etag = make_etag(output.timeline_hash, project.name, start, end)
+            cached = _not_modified(request, etag)
+            if cached:
+                return cached
+
+            response = {'success': True, 'project': {'id': project.id, 'name': project.name}}
+            if start or end:
+                events = rows_to_events(await session.scalars(select_events(project_id, start, end)))
+                if not events and not await session.scalar(
+                        select(TimelineEvent.id).filter_by(project_id=project_id).limit(1)):
+                    # Timeline built before events were stored
+                    await session.refresh(output, ['timeline_content'])
+                    events = filter_events(events_from_outline(output.timeline_content or ''), start, end)
+                response['timeline_content'] = render_markdown(events)
+                response['events'] = [event.to_dict() for event in events]
+                response['range'] = {'start': start and start.isoformat(), 'end': end and end.isoformat()}
+            else:
+                await session.refresh(output, ['timeline_content'])
+                response['timeline_content'] = output.timeline_content
+        return _cached_json(request, response, etag)
+    except Exception as e:
+        logger.error(f"Error fetching timeline: {str(e)}")
+        return _error(str(e), 500)
+
+async def project_narrative(request):
+    """Async /api/projects/<id>/narrative, with the same ?html=1"""
+    project_id = request.path_params['project_id']
+    try:
+        async with async_session() as session:
+            project, error = await _owned_project(session, request)
+            if error:
+                return error
+            output = await _output_for_etag(session, project_id)
+            if not output:
+                return _error('No output found', 404)
+
+            with_html = request.query_params.get('html') == '1'
+            etag = make_etag(output.narrative_hash, project.name, with_html)
+            cached = _not_modified(request, etag)
+            if cached:
+                return cached
+
+            await session.refresh(output, ['narrative_content'])
+        response = {
+            'success': True,
+            'project': {'id': project.id, 'name': project.name},
+            'narrative_content': output.narrative_content
+        }
+        if with_html:
+            # Rendering and the render cache are synchronous
+            _, fragment = await asyncio.to_thread(run_in_app_context, request.app.state.flask_app, render_output,
+                                                  output, 'narrative', FRAGMENT, project.name)
+            response['narrative_html'] = fragment.decode('utf-8')
+        return _cached_json(request, response, etag)
+    except Exception as e:
+        logger.error(f"Error fetching narrative: {str(e)}")
+        return _error(str(e), 500)
+
+async def process_project(request):
+    """Async POST /api/projects/<id>/process: queue a run on the job queue"""
+    project_id = request.path_params['project_id']
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    try:
+        async with async_session() as session:
+            project, error = await _owned_project(session, request)
+            if error:
+                return error
+
+            outline = await session.scalar(select(Document.id).filter_by(
+                project_id=project_id, file_type='outline').limit(1))
+            if not outline:
+                return _error('Outline document not found', 404)
+
+            user_id = project.user_id
+
+        # {"force": true} recomputes stages even if their inputs are unchanged;
+        # the job queue's project lock is taken on a worker thread
+        force = bool(isinstance(body, dict) and body.get('force'))
+        status = await asyncio.to_thread(run_in_app_context, request.app.state.flask_app, _enqueue_processing,
+                                         project_id, user_id, force)
+        return JSONResponse({'success': True, 'job': status}, status_code=202)
+    except Exception as e:
+        logger.error(f"Error queueing project processing: {str(e)}")
+        return _error(f'Server error: {str(e)}', 500)
+
+def _enqueue_processing(project_id, user_id, force):
+    """job_status() of a new run, or of the process or stream job already in flight"""
+    return job_status(enqueue_project_processing(project_id, user_id, force=force))
+
+def _ingest(user_id, project_id, files):
+    job_ids = []
+    results, _ = ingest_documents(
+        user_id, project_id, files,
+        before_commit=lambda document_ids: job_ids.extend(add_extraction_jobs(project_id, user_id, document_ids))
+    )
+    return results, job_ids
+
+async def upload_documents(request):
+    """Async /api/projects/<id>/upload_documents. The body is received on the
+    event loop; the files are then stored by ingest_documents on a worker
+    thread, all or nothing as in the Flask route."""
+    flask_app = request.app.state.flask_app
+    project_id = request.path_params['project_id']
+    if int(request.headers.get('content-length') or 0) > flask_app.config['MAX_CONTENT_LENGTH']:
+        return _error('Upload too large', 413)
+
+    async with async_session() as session:
+        project, error = await _owned_project(session, request)
+        if error:
+            return error
+        user_id = project.user_id
+
+    form = await request.form()
+    try:
+        files = [
+            FileStorage(stream=upload.file, filename=upload.filename)
+            for upload in form.getlist('documents') if isinstance(upload, UploadFile)
+        ]
+        if not files:
+            return _error('No files uploaded', 400)
+
+        results, job_ids = await asyncio.to_thread(run_in_app_context, flask_app, _ingest, user_id, project_id, files)
+        # Parse the PDFs in the background so processing can use stored text
+        submit_jobs(job_ids)
+        return JSONResponse({
+            'success': True,
+            'documents': [
+                {'filename': result['stored_as'], 'file_type': 'supporting'}
+                for result in results if result['status'] == 'stored'
+            ],
+            'files': results
+        })
+    except BulkUploadError as e:
+        return JSONResponse({'success': False, 'message': str(e), 'files': e.results}, status_code=e.status)
+    except Exception as e:
+        logger.error(f"Error uploading documents: {str(e)}")
+        return _error(str(e), 500)
+    finally:
+        await form.close()
+
+async def stream_narrative(request):
+    """Async /api/projects/<id>/narrative/stream: Server-Sent Events as in the Flask route"""
+    project_id = request.path_params['project_id']
+    async with async_session() as session:
+        project, error = await _owned_project(session, request)
+        if error:
+            return error
+        user_id = project.user_id
+
+    # Holds the same lock as processing jobs, so only one run writes the output
+    flask_app = request.app.state.flask_app
+    job_id = await asyncio.to_thread(run_in_app_context, flask_app, start_stream_job, project_id, user_id)
+    if job_id is None:
+        return _error('Project is already being processed', 409)
+
+    usage = TokenUsage(tenant=(user_id, project_id))
+    events = stream_project_narrative_async(flask_app, project_id, user_id, usage=usage,
+                                            on_finish=partial(finish_stream_job, job_id, usage=usage))
+
+    async def generate():
+        async for event, data in events:
+            if event == 'ping':
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+def create_asgi_app(flask_app=None):
+    """The async routes above, with every other request passed to flask_app"""
+    flask_app = flask_app or create_app()
+    init_async_db(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+
+    @asynccontextmanager
+    async def lifespan(_):
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=ASGI_WORKER_THREADS, thread_name_prefix='asgi-worker'))
+        start_job_queue()
+        yield
+        await dispose_async_db()
+
+    asgi_app = Starlette(routes=[
+        Route('/api/projects/{project_id:int}/timeline', project_timeline),
+        Route('/api/projects/{project_id:int}/narrative', project_narrative),
+        Route('/api/projects/{project_id:int}/narrative/stream', stream_narrative),
+        Route('/api/projects/{project_id:int}/process', process_project, methods=['POST']),
+        Route('/api/projects/{project_id:int}/upload_documents', upload_documents, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)),
+    ], lifespan=lifespan)
+    asgi_app.state.flask_app = flask_app
+    return asgi_app
+
+if __name__ == '__main__':
+    import uvicorn
+    app = create_asgi_app()
+    upgrade_schema(app.state.flask_app)
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,235 @@
+"""Generate timelines and narratives for whole case folders from the command line.
+
+Each case directory holds an outline (outline.txt, or the only .txt file) and
+the supporting PDFs, like inputs/. For every case this writes timeline.md and
+narrative.md into the output directory (<case>/output by default).
+
+    python batch_process.py cases/smith cases/jones ... [--workers 8] [--case-workers 2]
+
+Progress is checkpointed per case in .brief_checkpoint.json, so an
+interrupted run picks up where it left off: summarized documents are not
+sent to the model again and finished cases are skipped unless their inputs
+changed (or --force is given). Set LLM_BACKEND=fake to run against the
+local stand-in instead of OpenAI.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import gpt4_processor
+from utils.chunking import PAGE_BREAK
+from utils.file_handler import process_outline
+from utils.gpt4_processor import (
+    TokenUsage, summarize_text, write_narrative,
+    SUMMARY_ERROR, SUMMARY_PROMPT_VERSION, SUMMARY_MODEL, NARRATIVE_PROMPT_VERSION, NARRATIVE_MODEL
+)
+from utils.pdf_processor import iter_pdf_pages
+from utils.timeline import TIMELINE_VERSION
+
+logger = logging.getLogger('batch_process')
+
+CHECKPOINT_FILE = '.brief_checkpoint.json'
+
+def write_atomic(path, content):
+    """Write text so readers only ever see the old or the complete new file"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_outline(case_dir):
+    preferred = os.path.join(case_dir, 'outline.txt')
+    if os.path.exists(preferred):
+        return preferred
+    candidates = glob.glob(os.path.join(case_dir, '*.txt'))
+    if len(candidates) == 1:
+        return candidates[0]
+    return None
+
+class BatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = 0
+        self.cases_done = 0
+        self.cases_skipped = 0
+        self.cases_failed = 0
+        self.usage = TokenUsage()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, amount in counts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+class Case:
+    def __init__(self, case_dir, output_dir):
+        self.dir = case_dir
+        self.name = os.path.basename(os.path.normpath(case_dir))
+        self.output_dir = output_dir
+        self.checkpoint_path = os.path.join(case_dir, CHECKPOINT_FILE)
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_checkpoint(self, checkpoint):
+        write_atomic(self.checkpoint_path, json.dumps(checkpoint, indent=2))
+
+def summarize_pdf(path):
+    """Extract and summarize one PDF; runs on the shared document pool"""
+    with open(path, 'rb') as f:
+        pdf_content = f.read()
+    text = PAGE_BREAK.join(iter_pdf_pages(pdf_content))
+    if not text.strip():
+        return None
+    return summarize_text(text, usage=STATS.usage)
+
+def process_case(case, document_pool, force=False):
+    outline_path = find_outline(case.dir)
+    if not outline_path:
+        raise ValueError('no outline.txt found')
+    pdf_paths = sorted(glob.glob(os.path.join(case.dir, '*.pdf')))
+    if not pdf_paths:
+        raise ValueError('no PDF files found')
+
+    pdf_hashes = [sha256_file(path) for path in pdf_paths]
+    summary_version = f"{SUMMARY_PROMPT_VERSION}:{SUMMARY_MODEL}"
+    pdf_names = [os.path.basename(path) for path in pdf_paths]
+    fingerprint = hashlib.sha256(":".join([
+        sha256_file(outline_path), TIMELINE_VERSION, NARRATIVE_PROMPT_VERSION, NARRATIVE_MODEL, summary_version,
+        *pdf_hashes, *pdf_names
+    ]).encode('utf-8')).hexdigest()
+
+    checkpoint = {} if force else case.load_checkpoint()
+    if checkpoint.get('summary_version') != summary_version:
+        checkpoint['summaries'] = {}
+    checkpoint['summary_version'] = summary_version
+    summaries = checkpoint.setdefault('summaries', {})
+
+    outputs = [os.path.join(case.output_dir, name) for name in ('timeline.md', 'narrative.md')]
+    if checkpoint.get('completed') == fingerprint and all(os.path.exists(path) for path in outputs):
+        return 'skipped'
+
+    with open(outline_path, 'rb') as f:
+        outline_content = f.read()
+
+    pending = {
+        document_pool.submit(summarize_pdf, path): (path, pdf_hash)
+        for path, pdf_hash in zip(pdf_paths, pdf_hashes)
+        if pdf_hash not in summaries
+    }
+    failed = []
+    for future in as_completed(pending):
+        path, pdf_hash = pending[future]
+        summary = future.result()
+        STATS.add(documents=1)
+        if summary == SUMMARY_ERROR:
+            failed.append(os.path.basename(path))
+            continue
+        # None (no readable text) is recorded too, so the PDF is not re-read
+        summaries[pdf_hash] = summary
+        case.save_checkpoint(checkpoint)
+
+    if failed:
+        raise RuntimeError(f"summarization failed for {', '.join(failed)}; rerun to retry")
+
+    ordered = [summaries[pdf_hash] for pdf_hash in pdf_hashes if summaries.get(pdf_hash)]
+    if not ordered:
+        raise ValueError('no readable supporting documents')
+
+    # Dated events from the summaries are merged into the outline's timeline
+    timeline_content = process_outline(
+        outline_content, pdf_names,
+        {name: summaries[pdf_hash] for name, pdf_hash in zip(pdf_names, pdf_hashes) if summaries.get(pdf_hash)}
+    )
+    if not timeline_content:
+        raise ValueError('could not read outline')
+    write_atomic(outputs[0], timeline_content)
+    narrative_content = write_narrative(timeline_content, ordered, usage=STATS.usage)
+    write_atomic(outputs[1], narrative_content)
+
+    checkpoint['completed'] = fingerprint
+    case.save_checkpoint(checkpoint)
+    return 'done'
+
+STATS = BatchStats()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('cases', nargs='+', help='case directories (outline.txt + PDFs)')
+    parser.add_argument('--output-dir', help='write outputs to <output-dir>/<case name> instead of <case>/output')
+    parser.add_argument('--workers', type=int, default=gpt4_processor.SUMMARY_CONCURRENCY,
+                        help='documents extracted and summarized at once, across all cases')
+    parser.add_argument('--case-workers', type=int, default=2, help='cases processed at once')
+    parser.add_argument('--force', action='store_true', help='ignore checkpoints and redo every case')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    cases = []
+    for case_dir in args.cases:
+        if not os.path.isdir(case_dir):
+            parser.error(f"not a directory: {case_dir}")
+        name = os.path.basename(os.path.normpath(case_dir))
+        output_dir = os.path.join(args.output_dir, name) if args.output_dir else os.path.join(case_dir, 'output')
+        cases.append(Case(case_dir, output_dir))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='document') as document_pool, \
+            ThreadPoolExecutor(max_workers=args.case_workers, thread_name_prefix='case') as case_pool:
+        futures = {case_pool.submit(process_case, case, document_pool, args.force): case for case in cases}
+        for future in as_completed(futures):
+            case = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                STATS.add(cases_failed=1)
+                logger.error(f"[{case.name}] failed: {str(e)}")
+                continue
+            if result == 'skipped':
+                STATS.add(cases_skipped=1)
+                logger.info(f"[{case.name}] up to date, skipped")
+            else:
+                STATS.add(cases_done=1)
+                logger.info(f"[{case.name}] wrote {case.output_dir}")
+
+    minutes = max(time.monotonic() - started, 1e-9) / 60
+    usage = STATS.usage.to_dict()
+    tokens = usage['prompt_tokens'] + usage['completion_tokens']
+    print(
+        f"\n{STATS.cases_done} cases processed, {STATS.cases_skipped} skipped, {STATS.cases_failed} failed "
+        f"in {minutes * 60:.1f}s\n"
+        f"{STATS.documents} documents summarized: {STATS.documents / minutes:.1f} docs/min\n"
+        f"{tokens} tokens ({usage['prompt_tokens']} prompt, {usage['completion_tokens']} completion): "
+        f"{tokens / minutes:.0f} tokens/min"
+    )
+    return 1 if STATS.cases_failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""Synthetic case folders for benchmarks.
+
+A case folder looks like inputs/: an outline.txt plus dated PDF records.
+The PDFs are written by hand (one Helvetica text stream per page) so no PDF
+library is needed, and their text is seeded, so the same arguments always
+produce the same files.
+
+    python -m benchmarks.cases .bench/cases/medium --documents 10 --pages 40 --outline-lines 60
+"""
+import argparse
+import os
+import random
+from datetime import date, timedelta
+
+WORDS = (
+    "student team meeting goal progress report services minutes weekly speech therapy "
+    "occupational reading writing math assessment accommodations placement district parent "
+    "teacher evaluation behavior support plan observed trials accuracy data baseline objective "
+    "annual review consent transition schedule classroom instruction independent prompt level"
+).split()
+
+EVENTS = (
+    "IEP meeting held", "Progress report issued", "Parent requested evaluation",
+    "District evaluation completed", "Services reduced", "Extended school year offered",
+    "Independent evaluation received", "Placement changed", "Prior written notice sent",
+)
+
+LINES_PER_PAGE = 48
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def make_pdf(pages):
+    """A minimal PDF with one page per list of text lines"""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_ids = []
+    for lines in pages:
+        stream = "BT /F1 9 Tf 11 TL 40 770 Td " + " ".join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        stream = stream.encode('latin-1', 'replace')
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_ids.append(len(objects))
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+def _sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(9, 14))).capitalize() + "."
+
+def make_case(path, documents=5, pages=10, outline_lines=30, seed=0):
+    """Write a synthetic case folder; returns its page and byte totals"""
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    start = date(2018, 9, 1)
+
+    with open(os.path.join(path, 'outline.txt'), 'w', encoding='utf-8') as f:
+        for i in range(outline_lines):
+            day = start + timedelta(days=i * 1500 // max(outline_lines, 1))
+            f.write(f"{day:%m/%d/%Y} - {rng.choice(EVENTS)}: {_sentence(rng)}\n")
+
+    total_bytes = 0
+    for n in range(documents):
+        day = start + timedelta(days=n * 1500 // max(documents, 1))
+        title = rng.choice(EVENTS).split()[0]
+        page_lines = []
+        for page in range(pages):
+            lines = [f"{title} record {n + 1}, page {page + 1} - {day:%B %d, %Y}"]
+            lines += [_sentence(rng) for _ in range(LINES_PER_PAGE - 1)]
+            page_lines.append(lines)
+        content = make_pdf(page_lines)
+        total_bytes += len(content)
+        with open(os.path.join(path, f"{day:%Y.%m.%d} {title} Record {n + 1}.pdf"), 'wb') as f:
+            f.write(content)
+
+    return {'documents': documents, 'pages': documents * pages, 'outline_lines': outline_lines, 'bytes': total_bytes}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--documents', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=10)
+    parser.add_argument('--outline-lines', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(make_case(args.path, args.documents, args.pages, args.outline_lines, args.seed))
+
+if __name__ == '__main__':
+    main()
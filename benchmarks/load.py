@@ -0,0 +1,341 @@
+"""Load test the sync server (main.py) against the ASGI server (asgi.py).
+
+Usage: python -m benchmarks.load [--servers sync asgi] [--scenarios stream content] [--concurrency 50 200]
+                                 [--requests 400] [--llm-latency 1.0] [--llm-tokens-per-second 30]
+                                 [--llm-output-tokens 300] [--json] [--output FILE]
+
+A throwaway SQLite database is seeded once with one processed project per
+client (an outline and one PDF), and every server starts from a copy of it,
+with local storage, the fake LLM (utils/fake_llm.py) and no rate limits, so
+what is measured is the server rather than the model. Each concurrent
+client has its own connection and project and sends requests back to back
+until --requests have been made:
+
+  stream   GET /api/projects/<id>/narrative/stream, read to its done event:
+           a long-running LLM request
+  content  GET /api/projects/<id>/narrative, a short database read
+
+Reported per server, scenario and concurrency: requests/sec, p50/p99/max
+latency, errors, and the server process's peak threads and RSS.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'stream': ('/api/projects/{project_id}/narrative/stream', b'event: done'),
+    'content': ('/api/projects/{project_id}/narrative', b'"success": true'),
+}
+SECRET_KEY = 'load-test'
+POLL_SECONDS = 0.05
+
+def seed(run_dir, projects, timeout):
+    """Create the user and projects in this process and print the session cookie and project ids"""
+    sys.path.insert(0, ROOT)
+    from app import create_app, upgrade_schema
+    from models import db, User, Document
+    from benchmarks.cases import make_case
+
+    app = create_app()
+    upgrade_schema(app)
+    with app.app_context():
+        user = User(username='load', email='load@example.com')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    case_dir = os.path.join(run_dir, 'case')
+    make_case(case_dir, documents=1, pages=3, outline_lines=20)
+    pdf_name = next(name for name in os.listdir(case_dir) if name.endswith('.pdf'))
+    project_ids = []
+    for n in range(projects):
+        project_id = client.post('/api/projects', json={'name': f'Load {n + 1}'}).get_json()['project']['id']
+        for route, field, name in (('upload_outline', 'outline', 'outline.txt'),
+                                   ('upload_documents', 'documents', pdf_name)):
+            with open(os.path.join(case_dir, name), 'rb') as f:
+                response = client.post(f'/api/projects/{project_id}/{route}', data={field: (f, name)})
+            if response.status_code != 200:
+                raise RuntimeError(f"{route} failed: {response.get_json()}")
+        project_ids.append(project_id)
+
+    def wait_for(condition):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise TimeoutError('seeding timed out')
+            time.sleep(POLL_SECONDS)
+
+    def extracted():
+        with app.app_context():
+            return not Document.query.filter(
+                Document.file_type == 'supporting',
+                Document.extraction_status.notin_(('done', 'failed'))
+            ).count()
+
+    wait_for(extracted)
+    jobs = [client.post(f'/api/projects/{project_id}/process').get_json()['job']['id'] for project_id in project_ids]
+    for job_id in jobs:
+        job = {}
+
+        def finished():
+            job.update(client.get(f'/api/jobs/{job_id}').get_json()['job'])
+            return job['status'] in ('succeeded', 'failed')
+
+        wait_for(finished)
+        if job['status'] != 'succeeded':
+            raise RuntimeError(f"processing failed: {job['error']}")
+
+    print(json.dumps({'cookie': client.get_cookie('session').value, 'project_ids': project_ids}))
+
+def serve(kind, port):
+    """Run one server in this process until it is terminated"""
+    sys.path.insert(0, ROOT)
+    if kind == 'sync':
+        import logging
+        from main import app
+        # Per-request access logs would dominate the sync server's profile
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        app.run(host='127.0.0.1', port=port, threaded=True)
+    else:
+        import uvicorn
+        from asgi import create_asgi_app
+        uvicorn.run(create_asgi_app(), host='127.0.0.1', port=port, log_level='warning')
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _wait_for_port(port, proc, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(POLL_SECONDS)
+    raise TimeoutError('server did not start')
+
+class ProcessSampler:
+    """Peak thread count and RSS of a process, read from /proc while the load runs"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.threads = 0
+        self.rss_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            try:
+                with open(f'/proc/{self.pid}/status') as f:
+                    for line in f:
+                        if line.startswith('Threads:'):
+                            self.threads = max(self.threads, int(line.split()[1]))
+                        elif line.startswith('VmRSS:'):
+                            self.rss_kb = max(self.rss_kb, int(line.split()[1]))
+            except OSError:
+                return
+            if self._stop.wait(0.1):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+async def _request(port, path, cookie, expect, timeout):
+    """One GET on a new connection, read to the end; returns (seconds, ok)"""
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+        try:
+            writer.write((f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                          f"Cookie: session={cookie}\r\nConnection: close\r\n\r\n").encode('ascii'))
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), timeout)
+        finally:
+            writer.close()
+        ok = response.startswith(b'HTTP/1.1 200') and expect in response
+    except (OSError, asyncio.TimeoutError):
+        ok = False
+    return time.perf_counter() - started, ok
+
+async def _load(port, cookie, project_ids, scenario, concurrency, total, timeout):
+    template, expect = SCENARIOS[scenario]
+    remaining = [total]
+    latencies, errors = [], [0]
+
+    async def client(project_id):
+        path = template.format(project_id=project_id)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            seconds, ok = await _request(port, path, cookie, expect, timeout)
+            if ok:
+                latencies.append(seconds)
+            else:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(project_ids[n]) for n in range(concurrency)))
+    return time.perf_counter() - started, sorted(latencies), errors[0]
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 4)
+
+def run_server(kind, seed_dir, seeded, args, env):
+    """Start a server on a copy of the seeded database and put every scenario through it"""
+    results = []
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(seed_dir)) as run_dir:
+        for name in ('load.db', 'storage'):
+            source = os.path.join(seed_dir, name)
+            (shutil.copytree if os.path.isdir(source) else shutil.copy)(source, os.path.join(run_dir, name))
+        port = _free_port()
+        server_env = dict(env, DATABASE_URL=f"sqlite:///{os.path.join(run_dir, 'load.db')}",
+                          LOCAL_STORAGE_ROOT=os.path.join(run_dir, 'storage'))
+        log_path = os.path.join(run_dir, 'server.log')
+        log = open(log_path, 'w')
+        proc = subprocess.Popen([sys.executable, '-m', 'benchmarks.load', '--serve', kind, '--port', str(port)],
+                                cwd=ROOT, env=server_env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            _wait_for_port(port, proc, 60)
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    with ProcessSampler(proc.pid) as sampler:
+                        seconds, latencies, errors = asyncio.run(_load(
+                            port, seeded['cookie'], seeded['project_ids'], scenario, concurrency,
+                            args.requests, args.timeout))
+                    result = {
+                        'server': kind,
+                        'scenario': scenario,
+                        'concurrency': concurrency,
+                        'requests': len(latencies) + errors,
+                        'errors': errors,
+                        'seconds': round(seconds, 3),
+                        'requests_per_second': round(len(latencies) / seconds, 2) if seconds else None,
+                        'p50_seconds': _percentile(latencies, 0.50),
+                        'p99_seconds': _percentile(latencies, 0.99),
+                        'max_seconds': round(latencies[-1], 4) if latencies else None,
+                        'peak_threads': sampler.threads,
+                        'peak_rss_mb': round(sampler.rss_kb / 1024, 1),
+                    }
+                    results.append(result)
+                    if not args.json:
+                        print(f"{kind:5} {scenario:8} c={concurrency:<4} {result['requests_per_second']:>8} req/s  "
+                              f"p50 {result['p50_seconds']}s  p99 {result['p99_seconds']}s  "
+                              f"errors {errors}  threads {sampler.threads}  RSS {result['peak_rss_mb']} MB")
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            log.close()
+            if proc.returncode not in (0, -15) or any(result['errors'] for result in results):
+                with open(log_path) as f:
+                    sys.stderr.write(f.read()[-4000:])
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', nargs='+', default=['sync', 'asgi'], choices=['sync', 'asgi'])
+    parser.add_argument('--scenarios', nargs='+', default=['stream', 'content'], choices=sorted(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[50, 200])
+    parser.add_argument('--requests', type=int, default=400, help='requests per scenario and concurrency')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='fake LLM seconds to first token')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=30, help='fake LLM output speed')
+    parser.add_argument('--llm-output-tokens', type=int, default=300, help='fake LLM answer length')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds allowed per request')
+    parser.add_argument('--json', action='store_true', help='print results as JSON only')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--seed', metavar='RUN_DIR', help=argparse.SUPPRESS)
+    parser.add_argument('--projects', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', choices=['sync', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.seed, args.projects, args.timeout * 10)
+        return
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    work_dir = os.path.join(ROOT, '.bench', 'load')
+    os.makedirs(work_dir, exist_ok=True)
+    config = {
+        'llm_latency': args.llm_latency,
+        'llm_tokens_per_second': args.llm_tokens_per_second,
+        'llm_output_tokens': args.llm_output_tokens,
+        'requests': args.requests,
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as seed_dir:
+        env = dict(
+            os.environ,
+            SECRET_KEY=SECRET_KEY,
+            DATABASE_URL=f"sqlite:///{os.path.join(seed_dir, 'load.db')}",
+            STORAGE_BACKEND='local',
+            LOCAL_STORAGE_ROOT=os.path.join(seed_dir, 'storage'),
+            UPLOAD_TMP_DIR=os.path.join(seed_dir, 'uploads'),
+            LLM_BACKEND='fake',
+            EMBEDDING_BACKEND='local',
+            LLM_REQUESTS_PER_MINUTE='0',
+            LLM_TOKENS_PER_MINUTE='0',
+            # Partial narratives are not written mid-stream, so SQLite's
+            # single writer is not what limits either server
+            STREAM_PERSIST_SECONDS='3600',
+            FAKE_LLM_LATENCY='0',
+            FAKE_LLM_TOKENS_PER_SECOND='0',
+            FAKE_LLM_OUTPUT_TOKENS=str(args.llm_output_tokens),
+        )
+        proc = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.load', '--seed', seed_dir,
+             '--projects', str(max(args.concurrency)), '--timeout', str(args.timeout)],
+            cwd=ROOT, env=env, capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr[-4000:])
+            raise SystemExit('seeding failed')
+        seeded = json.loads(proc.stdout.strip().splitlines()[-1])
+
+        env.update(FAKE_LLM_LATENCY=str(args.llm_latency), FAKE_LLM_TOKENS_PER_SECOND=str(args.llm_tokens_per_second))
+        for kind in args.servers:
+            results.extend(run_server(kind, seed_dir, seeded, args, env))
+
+    report = {'config': config, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
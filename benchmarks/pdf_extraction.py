@@ -0,0 +1,109 @@
+"""Benchmark PDF text extraction across worker counts.
+
+Usage: python -m benchmarks.pdf_extraction [--min-pages 300] [--workers 1 2 4 8]
+
+Each sample PDF in inputs/ is padded (by repeating its pages) to at least
+--min-pages so the numbers resemble real IEP records. Every configuration
+runs in a fresh subprocess so peak RSS is measured in isolation; the figure
+reported is the parent plus the largest worker process.
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+import PyPDF2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def pad_pdf(pdf_content, min_pages):
+    """Repeat the pages of a PDF until it has at least min_pages"""
+    reader = PyPDF2.PdfReader(BytesIO(pdf_content))
+    if len(reader.pages) >= min_pages:
+        return pdf_content
+    writer = PyPDF2.PdfWriter()
+    while len(writer.pages) < min_pages:
+        for page in reader.pages:
+            writer.add_page(page)
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+def run_single(path, workers):
+    """Extract one PDF in this process and print a JSON result line"""
+    sys.path.insert(0, ROOT)
+    from utils.pdf_processor import iter_pdf_pages
+
+    with open(path, 'rb') as f:
+        pdf_content = f.read()
+
+    start = time.perf_counter()
+    first_page_at = None
+    pages = 0
+    chars = 0
+    for text in iter_pdf_pages(pdf_content, workers=workers):
+        if first_page_at is None:
+            first_page_at = time.perf_counter() - start
+        pages += 1
+        chars += len(text)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in KiB on Linux
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps({
+        'pages': pages,
+        'chars': chars,
+        'seconds': round(elapsed, 4),
+        'first_page_seconds': round(first_page_at or 0.0, 4),
+        'pages_per_second': round(pages / elapsed, 2) if elapsed else None,
+        'peak_rss_mb': round((self_rss + child_rss) / 1024, 1)
+    }))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--inputs', default=os.path.join(ROOT, 'inputs'))
+    parser.add_argument('--min-pages', type=int, default=300)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--json', action='store_true', help='print results as JSON only')
+    parser.add_argument('--single', nargs=2, metavar=('PDF', 'WORKERS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single[0], int(args.single[1]))
+        return
+
+    results = []
+    tmp_dir = os.path.join(ROOT, '.bench')
+    os.makedirs(tmp_dir, exist_ok=True)
+    for source in sorted(glob.glob(os.path.join(args.inputs, '*.pdf'))):
+        with open(source, 'rb') as f:
+            padded = pad_pdf(f.read(), args.min_pages)
+        path = os.path.join(tmp_dir, os.path.basename(source))
+        with open(path, 'wb') as f:
+            f.write(padded)
+
+        for workers in args.workers:
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.pdf_extraction', '--single', path, str(workers)],
+                cwd=ROOT, capture_output=True, text=True, check=True
+            )
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            result.update({'file': os.path.basename(source), 'workers': workers})
+            results.append(result)
+            if not args.json:
+                print(f"{result['file'][:40]:40} workers={workers:<3} pages={result['pages']:<5} "
+                      f"{result['pages_per_second']:>8} pages/s  first page {result['first_page_seconds']:.3f}s  "
+                      f"peak RSS {result['peak_rss_mb']} MB")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""Benchmark the whole processing path offline, from upload to saved narrative.
+
+Usage: python -m benchmarks.pipeline [--cases small medium large inputs] [--custom 40x100x200]
+                                     [--llm-latency 0.1] [--llm-tokens-per-second 500] [--json] [--output FILE]
+
+Every case runs in a fresh subprocess against a throwaway SQLite database,
+local storage and the fake LLM (utils/fake_llm.py), driven through the Flask
+test client exactly as the browser would: upload the outline and PDFs, wait
+for background extraction, POST /api/projects/<id>/process and poll the job
+until it finishes, then run it once more with force set to measure a warm
+rerun (summaries or passage embeddings come from the cache). Reported per case: end-to-end and
+per-stage seconds, LLM calls and tokens, throughput and peak RSS.
+
+Cases are the presets below, --custom DOCSxPAGESxOUTLINE_LINES folders, and
+"inputs" (the real samples in inputs/).
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRESETS = {
+    'small': {'documents': 3, 'pages': 5, 'outline_lines': 20},
+    'medium': {'documents': 10, 'pages': 20, 'outline_lines': 60},
+    'large': {'documents': 25, 'pages': 60, 'outline_lines': 150},
+}
+
+POLL_SECONDS = 0.05
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('benchmark step timed out')
+        time.sleep(POLL_SECONDS)
+
+def _run_job(client, project_id, force, timeout):
+    started = time.perf_counter()
+    response = client.post(f'/api/projects/{project_id}/process', json={'force': force})
+    job_id = response.get_json()['job']['id']
+    job = {}
+
+    def finished():
+        job.update(client.get(f'/api/jobs/{job_id}').get_json()['job'])
+        return job['status'] in ('succeeded', 'failed')
+
+    _wait_for(finished, timeout)
+    seconds = time.perf_counter() - started
+    if job['status'] != 'succeeded':
+        raise RuntimeError(f"processing failed: {job['error']}")
+    usage = job['token_usage'] or {}
+    return {
+        'seconds': round(seconds, 4),
+        'job_seconds': job['duration_seconds'],
+        'stages': usage.get('timings', {}),
+        'llm': usage.get('stages', {}),
+        'prompt_tokens': usage.get('prompt_tokens', 0),
+        'completion_tokens': usage.get('completion_tokens', 0),
+        'cache': usage.get('counters', {}),
+    }
+
+def _merge_timings(usages):
+    merged = {}
+    for usage in usages:
+        for stage, entry in ((usage or {}).get('timings') or {}).items():
+            target = merged.setdefault(stage, {})
+            for field, value in entry.items():
+                if field == 'max_seconds':
+                    target[field] = max(target.get(field, 0), value)
+                else:
+                    target[field] = round(target.get(field, 0) + value, 4)
+    return merged
+
+def run_single(case_dir, timeout):
+    """Run one case in this process and print a JSON result line.
+
+    The environment (DATABASE_URL, LLM_BACKEND=fake, storage) is set up by
+    main() before this process starts, since create_app() reads it.
+    """
+    sys.path.insert(0, ROOT)
+    import_started = time.perf_counter()
+    from app import create_app, upgrade_schema
+    from models import db, User, Document, ProcessingJob
+    app = create_app()
+    import_seconds = time.perf_counter() - import_started
+    upgrade_schema(app)
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+    pdf_names = sorted(name for name in os.listdir(case_dir) if name.lower().endswith('.pdf'))
+    upload_bytes = sum(os.path.getsize(os.path.join(case_dir, name)) for name in pdf_names)
+
+    started = time.perf_counter()
+    project_id = client.post('/api/projects', json={'name': os.path.basename(case_dir)}).get_json()['project']['id']
+    with open(os.path.join(case_dir, 'outline.txt'), 'rb') as outline:
+        response = client.post(f'/api/projects/{project_id}/upload_outline', data={'outline': (outline, 'outline.txt')})
+    if response.status_code != 200:
+        raise RuntimeError(f"outline upload failed: {response.get_json()}")
+    files = [open(os.path.join(case_dir, name), 'rb') for name in pdf_names]
+    try:
+        response = client.post(
+            f'/api/projects/{project_id}/upload_documents',
+            data={'documents': [(f, name) for f, name in zip(files, pdf_names)]}
+        )
+    finally:
+        for f in files:
+            f.close()
+    if response.status_code != 200:
+        raise RuntimeError(f"document upload failed: {response.get_json()}")
+    upload_seconds = time.perf_counter() - started
+
+    def extracted():
+        with app.app_context():
+            return not Document.query.filter(
+                Document.project_id == project_id,
+                Document.file_type == 'supporting',
+                Document.extraction_status.notin_(('done', 'failed'))
+            ).count()
+
+    _wait_for(extracted, timeout)
+    extract_seconds = time.perf_counter() - started - upload_seconds
+
+    cold = _run_job(client, project_id, force=False, timeout=timeout)
+    total_seconds = time.perf_counter() - started
+    warm = _run_job(client, project_id, force=True, timeout=timeout)
+
+    with app.app_context():
+        pages = sum(doc.page_count or 0 for doc in Document.query.filter_by(project_id=project_id, file_type='supporting'))
+        extract_jobs = ProcessingJob.query.filter_by(project_id=project_id, job_type='extract').all()
+        extraction = _merge_timings(job.token_usage for job in extract_jobs)
+
+    # ru_maxrss is in KiB on Linux; children are PDF extraction workers
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    tokens = cold['prompt_tokens'] + cold['completion_tokens']
+    print(json.dumps({
+        'documents': len(pdf_names),
+        'pages': pages,
+        'upload_bytes': upload_bytes,
+        'import_seconds': round(import_seconds, 4),
+        'upload_seconds': round(upload_seconds, 4),
+        'extract_seconds': round(extract_seconds, 4),
+        'total_seconds': round(total_seconds, 4),
+        'extraction_stages': extraction,
+        'process': cold,
+        'rerun': warm,
+        'throughput': {
+            'documents_per_minute': round(len(pdf_names) / total_seconds * 60, 2),
+            'pages_per_second': round(pages / extract_seconds, 2) if extract_seconds else None,
+            'llm_tokens_per_second': round(tokens / cold['seconds'], 1) if cold['seconds'] else None,
+        },
+        'peak_rss_mb': round(max(self_rss, child_rss) / 1024, 1),
+        'peak_rss_self_mb': round(self_rss / 1024, 1),
+    }))
+
+def _prepare_cases(args, work_dir):
+    from benchmarks.cases import make_case
+
+    cases = []
+    for name in args.cases:
+        if name == 'inputs':
+            cases.append((name, os.path.join(ROOT, 'inputs'), {}))
+        else:
+            spec = PRESETS[name]
+            path = os.path.join(work_dir, 'cases', name)
+            cases.append((name, path, make_case(path, seed=args.seed, **spec)))
+    for custom in args.custom or []:
+        documents, pages, outline_lines = (int(part) for part in custom.split('x'))
+        path = os.path.join(work_dir, 'cases', custom)
+        cases.append((custom, path, make_case(path, documents, pages, outline_lines, seed=args.seed)))
+    return cases
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cases', nargs='+', default=['small', 'medium', 'large', 'inputs'],
+                        choices=sorted(PRESETS) + ['inputs'])
+    parser.add_argument('--custom', nargs='+', metavar='DOCSxPAGESxLINES', help='extra synthetic cases')
+    parser.add_argument('--llm-latency', type=float, default=0.1, help='fake LLM seconds to first token')
+    parser.add_argument('--llm-tokens-per-second', type=float, default=500, help='fake LLM output speed')
+    parser.add_argument('--llm-output-tokens', type=int, default=300, help='fake LLM answer length')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds allowed per case step')
+    parser.add_argument('--json', action='store_true', help='print results as JSON only')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--single', metavar='CASE_DIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.timeout)
+        return
+
+    work_dir = os.path.join(ROOT, '.bench', 'pipeline')
+    os.makedirs(work_dir, exist_ok=True)
+    config = {
+        'llm_latency': args.llm_latency,
+        'llm_tokens_per_second': args.llm_tokens_per_second,
+        'llm_output_tokens': args.llm_output_tokens,
+        'summary_concurrency': int(os.environ.get('SUMMARY_CONCURRENCY', '8')),
+        'job_workers': int(os.environ.get('JOB_WORKERS', '2')),
+        'cpu_count': os.cpu_count(),
+        'python': sys.version.split()[0],
+    }
+
+    results = []
+    for name, path, generated in _prepare_cases(args, work_dir):
+        with tempfile.TemporaryDirectory(dir=work_dir) as run_dir:
+            env = dict(
+                os.environ,
+                DATABASE_URL=f"sqlite:///{os.path.join(run_dir, 'bench.db')}",
+                STORAGE_BACKEND='local',
+                LOCAL_STORAGE_ROOT=os.path.join(run_dir, 'storage'),
+                UPLOAD_TMP_DIR=os.path.join(run_dir, 'uploads'),
+                LLM_BACKEND='fake',
+                FAKE_LLM_LATENCY=str(args.llm_latency),
+                FAKE_LLM_TOKENS_PER_SECOND=str(args.llm_tokens_per_second),
+                FAKE_LLM_OUTPUT_TOKENS=str(args.llm_output_tokens),
+            )
+            proc = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.pipeline', '--single', path, '--timeout', str(args.timeout)],
+                cwd=ROOT, env=env, capture_output=True, text=True
+            )
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr[-4000:])
+            raise SystemExit(f"case {name} failed")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result.update({'case': name, 'generated': generated})
+        results.append(result)
+        if not args.json:
+            process = result['process']
+            print(f"{name:10} docs={result['documents']:<4} pages={result['pages']:<5} "
+                  f"total {result['total_seconds']:8.2f}s (upload {result['upload_seconds']:.2f}s, "
+                  f"extract {result['extract_seconds']:.2f}s, process {process['seconds']:.2f}s, "
+                  f"rerun {result['rerun']['seconds']:.2f}s)  "
+                  f"{result['throughput']['documents_per_minute']} docs/min  peak RSS {result['peak_rss_mb']} MB")
+
+    report = {'config': config, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
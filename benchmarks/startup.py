@@ -0,0 +1,104 @@
+"""Measure how long a fresh worker process takes to boot the app.
+
+Usage: python -m benchmarks.startup [--runs 10] [--compare REV] [--json]
+
+Each run starts a new interpreter and imports main, as a gunicorn worker
+does on boot when the app is not preloaded (with --preload the master pays
+this once and workers inherit the result). Reported: median and best
+wall time for the import, time to the first response, peak RSS, and which
+heavy modules ended up loaded. --compare REV runs the same measurement
+against another git revision, exported to a temporary directory, for a
+before/after comparison.
+
+The database is a throwaway SQLite file and the LLM and storage backends
+are the local ones, so network setup is not measured, only the work done
+on import.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('openai', 'PyPDF2', 'markdown', 'tiktoken', 'replit', 'boto3')
+
+# Runs inside the measured interpreter; prints one JSON line
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter() - started
+client = app.test_client()
+started = time.perf_counter()
+client.get('/api/check_auth')
+first_request = time.perf_counter() - started
+print(json.dumps({
+    'import_seconds': imported,
+    'first_request_seconds': first_request,
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'loaded': sorted(name for name in %r if name in sys.modules),
+}))
+""" % (HEAVY_MODULES,)
+
+def measure(source_dir, runs):
+    samples = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'startup.db')}",
+            LLM_BACKEND='fake',
+            STORAGE_BACKEND='local',
+            LOCAL_STORAGE_ROOT=os.path.join(tmp, 'storage'),
+            # A real key, if set, would not be used, but keep older revisions
+            # that construct the client on import from failing without one
+            OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'sk-startup-benchmark'),
+        )
+        # Warm the bytecode cache so every measured run is comparable
+        subprocess.run([sys.executable, '-c', PROBE], cwd=source_dir, env=env, capture_output=True, check=True)
+        for _ in range(runs):
+            proc = subprocess.run([sys.executable, '-c', PROBE], cwd=source_dir, env=env,
+                                  capture_output=True, text=True, check=True)
+            samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    imports = [sample['import_seconds'] for sample in samples]
+    return {
+        'runs': runs,
+        'import_median_seconds': round(statistics.median(imports), 4),
+        'import_min_seconds': round(min(imports), 4),
+        'first_request_median_seconds': round(statistics.median(s['first_request_seconds'] for s in samples), 4),
+        'peak_rss_mb': round(max(s['peak_rss_mb'] for s in samples), 1),
+        'heavy_modules_loaded': samples[-1]['loaded'],
+    }
+
+def export_revision(rev, dest):
+    archive = subprocess.run(['git', 'archive', rev], cwd=ROOT, capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', dest], input=archive, check=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--compare', metavar='REV', help='also measure this git revision')
+    parser.add_argument('--json', action='store_true', help='print results as JSON only')
+    args = parser.parse_args()
+
+    results = {'current': measure(ROOT, args.runs)}
+    if args.compare:
+        with tempfile.TemporaryDirectory() as source_dir:
+            export_revision(args.compare, source_dir)
+            results[args.compare] = measure(source_dir, args.runs)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for label, result in results.items():
+        print(f"{label:12} import {result['import_median_seconds']:.3f}s median "
+              f"({result['import_min_seconds']:.3f}s best of {result['runs']})  "
+              f"first request {result['first_request_median_seconds']:.3f}s  "
+              f"peak RSS {result['peak_rss_mb']} MB  loaded: {', '.join(result['heavy_modules_loaded']) or 'none'}")
+
+if __name__ == '__main__':
+    main()
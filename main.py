@@ -1,4 +1,7 @@
-from app import app
+from app import create_app, upgrade_schema
+
+app = create_app()
 
 if __name__ == "__main__":
+    upgrade_schema(app)
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,115 @@
+"""Background jobs, summary cache and per-page document text
+
+processing_jobs and summary_cache were created by db.create_all() before
+migrations existed, so databases may already have them; each step is
+skipped if its table, column or index is already there.
+
+Revision ID: 0002_document_extraction
+Revises: 0001_baseline
+Create Date: 2026-10-18 14:12:36.402187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_document_extraction'
+down_revision = '0001_baseline'
+branch_labels = None
+depends_on = None
+
+
+def _inspector():
+    return sa.inspect(op.get_bind())
+
+
+def _has_table(table):
+    return table in _inspector().get_table_names()
+
+
+def _add_columns(table, *columns):
+    existing = {column['name'] for column in _inspector().get_columns(table)}
+    for column in columns:
+        if column.name not in existing:
+            op.add_column(table, column)
+
+
+def _create_index(name, table, columns, unique=False):
+    if name not in {index['name'] for index in _inspector().get_indexes(table)}:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def upgrade():
+    _add_columns('documents',
+        sa.Column('content_hash', sa.String(length=64), nullable=True),
+        sa.Column('page_count', sa.Integer(), nullable=True),
+        sa.Column('extraction_status', sa.String(length=20), nullable=False, server_default='pending'),
+        sa.Column('extraction_error', sa.Text(), nullable=True),
+    )
+
+    if not _has_table('document_pages'):
+        op.create_table('document_pages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('document_id', sa.Integer(), nullable=False),
+        sa.Column('page_number', sa.Integer(), nullable=False),
+        sa.Column('text', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('document_id', 'page_number')
+        )
+    _create_index('ix_document_pages_document_id', 'document_pages', ['document_id'])
+
+    if not _has_table('summary_cache'):
+        op.create_table('summary_cache',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('cache_key', sa.String(length=64), nullable=False),
+        sa.Column('content_hash', sa.String(length=64), nullable=False),
+        sa.Column('prompt_version', sa.String(length=20), nullable=False),
+        sa.Column('model', sa.String(length=50), nullable=False),
+        sa.Column('summary', sa.Text(), nullable=False),
+        sa.Column('size_bytes', sa.Integer(), nullable=False),
+        sa.Column('hit_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('last_used_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('cache_key')
+        )
+    _create_index('ix_summary_cache_content_hash', 'summary_cache', ['content_hash'])
+    _create_index('ix_summary_cache_last_used_at', 'summary_cache', ['last_used_at'])
+
+    if not _has_table('processing_jobs'):
+        op.create_table('processing_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('document_id', sa.Integer(), nullable=True),
+        sa.Column('job_type', sa.String(length=50), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('stage', sa.String(length=50), nullable=True),
+        sa.Column('progress_current', sa.Integer(), nullable=True),
+        sa.Column('progress_total', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['document_id'], ['documents.id'], ),
+        sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    _add_columns('processing_jobs',
+        sa.Column('document_id', sa.Integer(), nullable=True),
+    )
+    _create_index('ix_processing_jobs_project_id', 'processing_jobs', ['project_id'])
+    _create_index('ix_processing_jobs_status', 'processing_jobs', ['status'])
+
+
+def downgrade():
+    with op.batch_alter_table('processing_jobs') as batch_op:
+        batch_op.drop_column('document_id')
+    op.drop_table('document_pages')
+    with op.batch_alter_table('documents') as batch_op:
+        for column in ('extraction_error', 'extraction_status', 'page_count', 'content_hash'):
+            batch_op.drop_column(column)
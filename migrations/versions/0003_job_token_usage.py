@@ -0,0 +1,25 @@
+"""Per-stage token usage on processing jobs
+
+Revision ID: 0003_job_token_usage
+Revises: 0002_document_extraction
+Create Date: 2026-10-18 14:31:08.915362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_job_token_usage'
+down_revision = '0002_document_extraction'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('processing_jobs', sa.Column('token_usage', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('processing_jobs') as batch_op:
+        batch_op.drop_column('token_usage')
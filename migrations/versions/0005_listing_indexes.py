@@ -0,0 +1,25 @@
+"""Indexes for project listings
+
+Revision ID: 0005_listing_indexes
+Revises: 0004_upload_sessions
+Create Date: 2026-10-18 15:02:17.348906
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_listing_indexes'
+down_revision = '0004_upload_sessions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_projects_user_id_archived', 'projects', ['user_id', 'archived'])
+    op.create_index('ix_documents_project_id_file_type', 'documents', ['project_id', 'file_type'])
+
+
+def downgrade():
+    op.drop_index('ix_documents_project_id_file_type', table_name='documents')
+    op.drop_index('ix_projects_user_id_archived', table_name='projects')
@@ -0,0 +1,31 @@
+"""Content hashes and version on outputs
+
+Existing outputs get their hashes on first read (see get_output_for_etag).
+
+Revision ID: 0006_output_content_hashes
+Revises: 0005_listing_indexes
+Create Date: 2026-10-18 15:09:44.120573
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_output_content_hashes'
+down_revision = '0005_listing_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('outputs', sa.Column('timeline_hash', sa.String(length=64), nullable=True))
+    op.add_column('outputs', sa.Column('narrative_hash', sa.String(length=64), nullable=True))
+    op.add_column('outputs', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('outputs', sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('outputs') as batch_op:
+        for column in ('updated_at', 'version', 'narrative_hash', 'timeline_hash'):
+            batch_op.drop_column(column)
@@ -0,0 +1,38 @@
+"""Stage fingerprints, and force and stage_report on processing jobs
+
+Revision ID: 0007_stage_fingerprints
+Revises: 0006_output_content_hashes
+Create Date: 2026-10-18 15:14:29.884031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_stage_fingerprints'
+down_revision = '0006_output_content_hashes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stage_fingerprints',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('stage', sa.String(length=50), nullable=False),
+    sa.Column('fingerprint', sa.String(length=64), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('project_id', 'stage')
+    )
+    op.add_column('processing_jobs', sa.Column('force', sa.Boolean(), nullable=False, server_default=sa.false()))
+    op.add_column('processing_jobs', sa.Column('stage_report', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('processing_jobs') as batch_op:
+        batch_op.drop_column('stage_report')
+        batch_op.drop_column('force')
+    op.drop_table('stage_fingerprints')
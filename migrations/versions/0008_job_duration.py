@@ -0,0 +1,27 @@
+"""Run duration on processing jobs
+
+Revision ID: 0008_job_duration
+Revises: 0007_stage_fingerprints
+Create Date: 2026-10-18 15:21:55.067412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_job_duration'
+down_revision = '0007_stage_fingerprints'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('processing_jobs', sa.Column('duration_seconds', sa.Float(), nullable=True))
+    op.create_index('ix_processing_jobs_duration_seconds', 'processing_jobs', ['duration_seconds'])
+
+
+def downgrade():
+    op.drop_index('ix_processing_jobs_duration_seconds', table_name='processing_jobs')
+    with op.batch_alter_table('processing_jobs') as batch_op:
+        batch_op.drop_column('duration_seconds')
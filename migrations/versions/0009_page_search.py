@@ -0,0 +1,60 @@
+"""Full-text search index over document_pages
+
+Postgres gets a generated tsvector column with a GIN index; SQLite an FTS5
+table over the page text, kept in step by triggers. Either way pages are
+indexed in the same transaction that stores them, and existing pages are
+indexed here. See utils/search.py for the queries.
+
+Revision ID: 0009_page_search
+Revises: 0008_job_duration
+Create Date: 2026-10-18 16:05:42.518230
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0009_page_search'
+down_revision = '0008_job_duration'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(
+            "ALTER TABLE document_pages ADD COLUMN search_vector tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED"
+        )
+        op.execute("CREATE INDEX ix_document_pages_search ON document_pages USING GIN (search_vector)")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE document_pages_fts USING fts5("
+            "text, content='document_pages', content_rowid='id', tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER document_pages_fts_insert AFTER INSERT ON document_pages BEGIN "
+            "INSERT INTO document_pages_fts(rowid, text) VALUES (new.id, new.text); END"
+        )
+        op.execute(
+            "CREATE TRIGGER document_pages_fts_delete AFTER DELETE ON document_pages BEGIN "
+            "INSERT INTO document_pages_fts(document_pages_fts, rowid, text) VALUES ('delete', old.id, old.text); END"
+        )
+        op.execute(
+            "CREATE TRIGGER document_pages_fts_update AFTER UPDATE ON document_pages BEGIN "
+            "INSERT INTO document_pages_fts(document_pages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+            "INSERT INTO document_pages_fts(rowid, text) VALUES (new.id, new.text); END"
+        )
+        op.execute("INSERT INTO document_pages_fts(document_pages_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_document_pages_search")
+        op.execute("ALTER TABLE document_pages DROP COLUMN search_vector")
+    elif dialect == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            op.execute(f"DROP TRIGGER document_pages_fts_{trigger}")
+        op.execute("DROP TABLE document_pages_fts")
@@ -0,0 +1,40 @@
+"""Embedding cache for retrieval-based narrative prompts
+
+Revision ID: 0010_embedding_cache
+Revises: 0009_page_search
+Create Date: 2026-10-18 16:41:27.733120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010_embedding_cache'
+down_revision = '0009_page_search'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('embedding_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('cache_key', sa.String(length=64), nullable=False),
+    sa.Column('content_hash', sa.String(length=64), nullable=False),
+    sa.Column('model', sa.String(length=100), nullable=False),
+    sa.Column('dimensions', sa.Integer(), nullable=False),
+    sa.Column('passages', sa.JSON(), nullable=False),
+    sa.Column('vectors', sa.LargeBinary(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_used_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('cache_key')
+    )
+    op.create_index('ix_embedding_cache_content_hash', 'embedding_cache', ['content_hash'])
+    op.create_index('ix_embedding_cache_last_used_at', 'embedding_cache', ['last_used_at'])
+
+
+def downgrade():
+    op.drop_index('ix_embedding_cache_last_used_at', table_name='embedding_cache')
+    op.drop_index('ix_embedding_cache_content_hash', table_name='embedding_cache')
+    op.drop_table('embedding_cache')
@@ -0,0 +1,36 @@
+"""Structured timeline events
+
+Revision ID: 0011_timeline_events
+Revises: 0010_embedding_cache
+Create Date: 2026-10-18 17:52:09.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011_timeline_events'
+down_revision = '0010_embedding_cache'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('event_date', sa.Date(), nullable=True),
+    sa.Column('precision', sa.String(length=5), nullable=True),
+    sa.Column('description', sa.Text(), nullable=False),
+    sa.Column('sources', sa.JSON(), nullable=True),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_timeline_events_project_id_event_date', 'timeline_events', ['project_id', 'event_date'])
+
+
+def downgrade():
+    op.drop_index('ix_timeline_events_project_id_event_date', table_name='timeline_events')
+    op.drop_table('timeline_events')
@@ -0,0 +1,40 @@
+"""OCR cache and per-document extraction coverage
+
+Revision ID: 0012_ocr_coverage
+Revises: 0011_timeline_events
+Create Date: 2026-10-18 18:40:12.501733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0012_ocr_coverage'
+down_revision = '0011_timeline_events'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ocr_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('cache_key', sa.String(length=64), nullable=False),
+    sa.Column('engine', sa.String(length=100), nullable=False),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('cache_key')
+    )
+    with op.batch_alter_table('documents', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('text_pages', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('ocr_pages', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('failed_pages', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('documents', schema=None) as batch_op:
+        batch_op.drop_column('failed_pages')
+        batch_op.drop_column('ocr_pages')
+        batch_op.drop_column('text_pages')
+    op.drop_table('ocr_cache')
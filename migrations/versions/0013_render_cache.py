@@ -0,0 +1,44 @@
+"""Rendered export cache and export jobs
+
+Revision ID: 0013_render_cache
+Revises: 0012_ocr_coverage
+Create Date: 2026-10-18 19:22:47.180254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0013_render_cache'
+down_revision = '0012_ocr_coverage'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('render_cache',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('cache_key', sa.String(length=64), nullable=False),
+    sa.Column('content_hash', sa.String(length=64), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('format', sa.String(length=20), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.Column('size_bytes', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('last_used_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('cache_key')
+    )
+    op.create_index('ix_render_cache_content_hash', 'render_cache', ['content_hash'])
+    op.create_index('ix_render_cache_last_used_at', 'render_cache', ['last_used_at'])
+    with op.batch_alter_table('processing_jobs', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('artifact', sa.String(length=50), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('processing_jobs', schema=None) as batch_op:
+        batch_op.drop_column('artifact')
+    op.drop_index('ix_render_cache_last_used_at', table_name='render_cache')
+    op.drop_index('ix_render_cache_content_hash', table_name='render_cache')
+    op.drop_table('render_cache')
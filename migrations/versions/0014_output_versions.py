@@ -0,0 +1,37 @@
+"""Output version history
+
+Revision ID: 0014_output_versions
+Revises: 0013_render_cache
+Create Date: 2026-10-18 20:05:31.664019
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0014_output_versions'
+down_revision = '0013_render_cache'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('output_versions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('project_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('base_version', sa.Integer(), nullable=True),
+    sa.Column('timeline_hash', sa.String(length=64), nullable=False),
+    sa.Column('narrative_hash', sa.String(length=64), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.Column('size_bytes', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['project_id'], ['projects.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('project_id', 'version')
+    )
+
+
+def downgrade():
+    op.drop_table('output_versions')
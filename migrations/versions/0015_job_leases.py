@@ -0,0 +1,27 @@
+"""Worker leases on running processing jobs
+
+Revision ID: 0015_job_leases
+Revises: 0014_output_versions
+Create Date: 2026-10-18 22:10:04.518236
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0015_job_leases'
+down_revision = '0014_output_versions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('processing_jobs', sa.Column('owner', sa.String(length=255), nullable=True))
+    op.add_column('processing_jobs', sa.Column('lease_expires_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('processing_jobs') as batch_op:
+        batch_op.drop_column('lease_expires_at')
+        batch_op.drop_column('owner')
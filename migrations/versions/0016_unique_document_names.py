@@ -0,0 +1,44 @@
+"""One document per filename in a project
+
+Documents sharing a filename all point at the same storage object, which the
+latest upload replaced, so only the newest row of each name is kept; jobs of
+the others are moved to it.
+
+Revision ID: 0016_unique_document_names
+Revises: 0015_job_leases
+Create Date: 2026-10-18 23:02:41.731904
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0016_unique_document_names'
+down_revision = '0015_job_leases'
+branch_labels = None
+depends_on = None
+
+# Rows with the same (project_id, filename) as a newer row
+_SUPERSEDED = (
+    "SELECT d.id FROM documents d WHERE EXISTS ("
+    "SELECT 1 FROM documents n WHERE n.project_id = d.project_id AND n.filename = d.filename AND n.id > d.id)"
+)
+
+
+def upgrade():
+    op.execute(
+        "UPDATE processing_jobs SET document_id = ("
+        "SELECT MAX(n.id) FROM documents d JOIN documents n "
+        "ON n.project_id = d.project_id AND n.filename = d.filename "
+        "WHERE d.id = processing_jobs.document_id) "
+        f"WHERE document_id IN ({_SUPERSEDED})"
+    )
+    op.execute(f"DELETE FROM document_pages WHERE document_id IN ({_SUPERSEDED})")
+    op.execute(f"DELETE FROM documents WHERE id IN ({_SUPERSEDED})")
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.create_unique_constraint('uq_documents_project_id_filename', ['project_id', 'filename'])
+
+
+def downgrade():
+    with op.batch_alter_table('documents') as batch_op:
+        batch_op.drop_constraint('uq_documents_project_id_filename', type_='unique')
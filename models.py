@@ -1,11 +1,16 @@
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import deferred
+import hashlib
 import logging
 from datetime import datetime
 
 db = SQLAlchemy()
 
+def _sha256(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     
@@ -26,6 +31,7 @@ class User(UserMixin, db.Model):
 
 class Project(db.Model):
     __tablename__ = 'projects'
+    __table_args__ = (db.Index('ix_projects_user_id_archived', 'user_id', 'archived'),)
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -38,26 +44,286 @@ class Project(db.Model):
     def __repr__(self):
         return f'<Project {self.name}>'
 
+def lock_project(project_id):
+    """Hold the project's row lock (on SQLite, the database write lock) until
+    the transaction ends, so two requests can't both check the project's
+    rows and then both write based on what they saw"""
+    Project.query.filter_by(id=project_id).update({'name': Project.name}, synchronize_session=False)
+
 class Document(db.Model):
     __tablename__ = 'documents'
+    __table_args__ = (
+        db.Index('ix_documents_project_id_file_type', 'project_id', 'file_type'),
+        # The storage key is derived from the filename, so two rows would share one object
+        db.UniqueConstraint('project_id', 'filename', name='uq_documents_project_id_filename'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     file_type = db.Column(db.String(50), nullable=False)  # 'outline' or 'supporting'
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Filled in by the background extraction job after upload
+    content_hash = db.Column(db.String(64))
+    page_count = db.Column(db.Integer)
+    extraction_status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    extraction_error = db.Column(db.Text)
+    # Extraction coverage: pages with a text layer, pages read by OCR, and
+    # pages left without text because OCR failed or is not available
+    text_pages = db.Column(db.Integer)
+    ocr_pages = db.Column(db.Integer)
+    failed_pages = db.Column(db.Integer)
+    pages = db.relationship('DocumentPage', backref='document', lazy=True,
+                            order_by='DocumentPage.page_number', cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<Document {self.filename}>'
 
+class DocumentPage(db.Model):
+    __tablename__ = 'document_pages'
+    __table_args__ = (db.UniqueConstraint('document_id', 'page_number'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), nullable=False, index=True)
+    page_number = db.Column(db.Integer, nullable=False)  # 1-based
+    text = db.Column(db.Text, nullable=False, default='')
+
+    def __repr__(self):
+        return f'<DocumentPage {self.document_id}:{self.page_number}>'
+
 class Output(db.Model):
     __tablename__ = 'outputs'
     
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False, unique=True)
-    timeline_content = db.Column(db.Text)
-    narrative_content = db.Column(db.Text)
+    # The large bodies are only loaded when accessed, never by listings
+    timeline_content = deferred(db.Column(db.Text))
+    narrative_content = deferred(db.Column(db.Text))
+    timeline_hash = db.Column(db.String(64))
+    narrative_hash = db.Column(db.String(64))
+    version = db.Column(db.Integer, nullable=False, default=1)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def set_content(self, timeline_content, narrative_content, new_version=True):
+        """Replace the content, keeping hashes and version in step; new_version
+        is False for a draft (a narrative still being streamed) of the next version"""
+        self.timeline_content = timeline_content
+        self.narrative_content = narrative_content
+        self.update_hashes()
+        if new_version:
+            self.version = (self.version or 0) + 1
+        self.updated_at = datetime.utcnow()
+
+    def update_hashes(self):
+        self.timeline_hash = _sha256(self.timeline_content)
+        self.narrative_hash = _sha256(self.narrative_content)
 
     def __repr__(self):
         return f'<Output for Project {self.project_id}>'
+
+class OutputVersion(db.Model):
+    """One saved version of a project's output, as a delta against the version before it"""
+    __tablename__ = 'output_versions'
+    __table_args__ = (db.UniqueConstraint('project_id', 'version'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    base_version = db.Column(db.Integer)  # None: data is a full snapshot
+    timeline_hash = db.Column(db.String(64), nullable=False)
+    narrative_hash = db.Column(db.String(64), nullable=False)
+    data = deferred(db.Column(db.LargeBinary, nullable=False))  # zlib-compressed JSON, see utils/versions.py
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'timeline_hash': self.timeline_hash,
+            'narrative_hash': self.narrative_hash,
+            'stored_as': 'snapshot' if self.base_version is None else 'delta',
+            'size_bytes': self.size_bytes,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+    def __repr__(self):
+        return f'<OutputVersion {self.project_id}:{self.version}>'
+
+class TimelineEvent(db.Model):
+    """One event of a project's timeline, in display order (see utils/timeline.py)"""
+    __tablename__ = 'timeline_events'
+    __table_args__ = (db.Index('ix_timeline_events_project_id_event_date', 'project_id', 'event_date'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    event_date = db.Column(db.Date)  # None for undated outline lines
+    precision = db.Column(db.String(5))  # 'day' or 'month'
+    description = db.Column(db.Text, nullable=False)
+    sources = db.Column(db.JSON)  # filenames of the exhibits reporting the event
+
+    def __repr__(self):
+        return f'<TimelineEvent {self.project_id}:{self.position}>'
+
+class UploadSession(db.Model):
+    """A resumable upload of one large file, sent as a series of chunks"""
+    __tablename__ = 'upload_sessions'
+
+    id = db.Column(db.String(32), primary_key=True)  # random hex token
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    file_type = db.Column(db.String(50), nullable=False)  # 'outline' or 'supporting'
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    # sha256 of the bytes received so far; None once the running hash is lost
+    content_hash = db.Column(db.String(64))
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, complete
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'filename': self.filename,
+            'file_type': self.file_type,
+            'total_size': self.total_size,
+            'received': self.received,
+            'status': self.status
+        }
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received}/{self.total_size}>'
+
+class SummaryCache(db.Model):
+    __tablename__ = 'summary_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha256 of (document sha256, prompt version, model)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    prompt_version = db.Column(db.String(20), nullable=False)
+    model = db.Column(db.String(50), nullable=False)
+    summary = db.Column(db.Text, nullable=False)
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    hit_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<SummaryCache {self.cache_key[:12]}>'
+
+class EmbeddingCache(db.Model):
+    """Retrieval passages of one document text and their embedding vectors"""
+    __tablename__ = 'embedding_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha256 of (document sha256, passage version, embedding model, dimensions)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    model = db.Column(db.String(100), nullable=False)
+    dimensions = db.Column(db.Integer, nullable=False)
+    passages = db.Column(db.JSON, nullable=False)  # [[page_number, token_count, text], ...]
+    vectors = db.Column(db.LargeBinary, nullable=False)  # float32, one row per passage
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<EmbeddingCache {self.cache_key[:12]}>'
+
+class OcrCache(db.Model):
+    """OCR text of one page image, shared by every document containing the page"""
+    __tablename__ = 'ocr_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha256 of (page fingerprint, OCR engine settings)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    engine = db.Column(db.String(100), nullable=False)
+    text = db.Column(db.Text, nullable=False, default='')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<OcrCache {self.cache_key[:12]}>'
+
+class RenderCache(db.Model):
+    """A narrative or timeline rendered as HTML, DOCX or PDF"""
+    __tablename__ = 'render_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # sha256 of (output content hash, kind, format, title, render version)
+    cache_key = db.Column(db.String(64), unique=True, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # narrative, timeline
+    format = db.Column(db.String(20), nullable=False)  # html, docx, pdf, fragment
+    data = deferred(db.Column(db.LargeBinary, nullable=False))
+    size_bytes = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<RenderCache {self.cache_key[:12]}>'
+
+class StageFingerprint(db.Model):
+    """Fingerprint of the inputs a project's pipeline stage last ran with"""
+    __tablename__ = 'stage_fingerprints'
+    __table_args__ = (db.UniqueConstraint('project_id', 'stage'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    stage = db.Column(db.String(50), nullable=False)  # timeline, narrative
+    fingerprint = db.Column(db.String(64), nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StageFingerprint {self.project_id}:{self.stage}>'
+
+class ProcessingJob(db.Model):
+    __tablename__ = 'processing_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'))  # set for 'extract' jobs
+    artifact = db.Column(db.String(50))  # set for 'export' jobs, e.g. 'narrative.pdf'
+    job_type = db.Column(db.String(50), nullable=False, default='process')  # process, extract, export
+    force = db.Column(db.Boolean, nullable=False, default=False)  # ignore stored stage fingerprints
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, succeeded, failed
+    stage = db.Column(db.String(50))  # download, extract, summarize, narrative, save, render
+    progress_current = db.Column(db.Integer, default=0)
+    progress_total = db.Column(db.Integer, default=0)
+    token_usage = db.Column(db.JSON)  # per-stage calls, tokens, retries and timings
+    stage_report = db.Column(db.JSON)  # which pipeline stages were reused vs recomputed
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    owner = db.Column(db.String(255))  # host:pid of the worker running it
+    lease_expires_at = db.Column(db.DateTime)  # renewed by the owner's heartbeat while running
+    duration_seconds = db.Column(db.Float, index=True)  # started to finished, for finding slow runs
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'project_id': self.project_id,
+            'document_id': self.document_id,
+            'artifact': self.artifact,
+            'job_type': self.job_type,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': {
+                'current': self.progress_current,
+                'total': self.progress_total
+            },
+            'token_usage': self.token_usage,
+            'stages': self.stage_report,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_seconds': self.duration_seconds
+        }
+
+    def __repr__(self):
+        return f'<ProcessingJob {self.id} {self.status}>'
@@ -6,6 +6,7 @@ import Projects from './components/Projects'
 import ProjectDetails from './components/ProjectDetails'
 import Timeline from './components/Timeline'
 import Narrative from './components/Narrative'
+import Search from './components/Search'
 import { AuthProvider, useAuth } from './context/AuthContext'
 import './App.css'
 
@@ -28,6 +29,14 @@ function App() {
             </PrivateRoute>
           }
         />
+        <Route
+          path="/search"
+          element={
+            <PrivateRoute>
+              <Search />
+            </PrivateRoute>
+          }
+        />
         <Route
           path="/view/timeline/:projectId"
           element={
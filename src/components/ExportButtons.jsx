@@ -0,0 +1,70 @@
+import React, { useState } from 'react';
+import axios from 'axios';
+
+const FORMATS = [
+  { format: 'pdf', label: 'PDF' },
+  { format: 'docx', label: 'Word' },
+  { format: 'html', label: 'HTML' }
+];
+const POLL_MS = 1000;
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+function saveBlob(response, fallbackName) {
+  const disposition = response.headers['content-disposition'] || '';
+  const match = /filename\*?=(?:UTF-8'')?"?([^";]+)"?/i.exec(disposition);
+  const url = URL.createObjectURL(response.data);
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = match ? decodeURIComponent(match[1]) : fallbackName;
+  link.click();
+  URL.revokeObjectURL(url);
+}
+
+// Large exports are rendered in the background: the server answers 202 with
+// a job, which is polled until the export is ready to download
+function ExportButtons({ projectId, kind, onError }) {
+  const [busy, setBusy] = useState(null);
+
+  const download = async (format) => {
+    const url = `/api/projects/${projectId}/export/${kind}.${format}`;
+    setBusy(format);
+    try {
+      for (;;) {
+        const response = await axios.get(url, { responseType: 'blob' });
+        if (response.status !== 202) {
+          saveBlob(response, `${kind}.${format}`);
+          return;
+        }
+        let job = JSON.parse(await response.data.text()).job;
+        while (job.status === 'queued' || job.status === 'running') {
+          await sleep(POLL_MS);
+          job = (await axios.get(`/api/jobs/${job.id}`)).data.job;
+        }
+        if (job.status === 'failed') {
+          throw new Error(job.error || 'Export failed');
+        }
+      }
+    } catch (error) {
+      let message = error.message;
+      if (error.response?.data instanceof Blob) {
+        message = JSON.parse(await error.response.data.text()).message || message;
+      }
+      onError?.(`Could not export ${kind}: ${message}`);
+    } finally {
+      setBusy(null);
+    }
+  };
+
+  return (
+    <div className="btn-group me-2" role="group" aria-label="Export">
+      {FORMATS.map(({ format, label }) => (
+        <button key={format} onClick={() => download(format)} className="btn btn-outline-primary" disabled={busy !== null}>
+          {busy === format ? 'Exporting...' : label}
+        </button>
+      ))}
+    </div>
+  );
+}
+
+export default ExportButtons;
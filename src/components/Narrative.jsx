@@ -1,28 +1,129 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { useAuth } from '../context/AuthContext';
 import ReactMarkdown from 'react-markdown';
+import ExportButtons from './ExportButtons';
 
 function Narrative() {
   const [narrativeContent, setNarrativeContent] = useState('');
+  // Rendered (and cached) by the server; raw HTML in the markdown is escaped there
+  const [narrativeHtml, setNarrativeHtml] = useState('');
   const [project, setProject] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
+  const [streaming, setStreaming] = useState(false);
+  const [streamStatus, setStreamStatus] = useState('');
+  const [versions, setVersions] = useState([]);
+  const [latestVersion, setLatestVersion] = useState(null);
+  const [selectedVersion, setSelectedVersion] = useState('');
+  const [diff, setDiff] = useState(null);
+  const eventSource = useRef(null);
   const { projectId } = useParams();
   const navigate = useNavigate();
   const { logout } = useAuth();
 
+  const STAGE_LABELS = {
+    download: 'Downloading outline',
+    extract: 'Extracting text',
+    summarize: 'Summarizing documents',
+    embed: 'Indexing documents',
+    narrative: 'Writing narrative'
+  };
+
   useEffect(() => {
     fetchNarrativeContent();
+    fetchVersions();
+    return () => eventSource.current?.close();
   }, [projectId]);
 
+  const fetchVersions = async () => {
+    try {
+      const response = await axios.get(`/api/projects/${projectId}/versions`);
+      setVersions(response.data.versions);
+      setLatestVersion(response.data.latest);
+    } catch (error) {
+      console.error('Error fetching versions:', error);
+    }
+  };
+
+  const compareVersion = async () => {
+    try {
+      setError('');
+      const response = await axios.get(`/api/projects/${projectId}/versions/diff`, {
+        params: { from: selectedVersion, kind: 'narrative' }
+      });
+      setDiff(response.data);
+    } catch (error) {
+      setError(error.response?.data?.message || 'Error comparing versions');
+    }
+  };
+
+  const restoreVersion = async () => {
+    try {
+      setError('');
+      await axios.post(`/api/projects/${projectId}/versions/${selectedVersion}/restore`);
+      setDiff(null);
+      setSelectedVersion('');
+      await fetchNarrativeContent();
+      await fetchVersions();
+    } catch (error) {
+      setError(error.response?.data?.message || 'Error restoring version');
+    }
+  };
+
+  const stopStream = () => {
+    eventSource.current?.close();
+    eventSource.current = null;
+    setStreaming(false);
+    setStreamStatus('');
+  };
+
+  const regenerateNarrative = () => {
+    stopStream();
+    setError('');
+    setNarrativeHtml('');
+    setStreaming(true);
+    setStreamStatus('Starting...');
+
+    let started = false;
+    const source = new EventSource(`/api/projects/${projectId}/narrative/stream`);
+    eventSource.current = source;
+
+    source.addEventListener('progress', (e) => {
+      const { stage, current, total } = JSON.parse(e.data);
+      const label = STAGE_LABELS[stage] || 'Processing';
+      setStreamStatus(total > 1 ? `${label} (${current}/${total})...` : `${label}...`);
+    });
+    source.addEventListener('token', (e) => {
+      const piece = JSON.parse(e.data);
+      if (!started) {
+        started = true;
+        setStreamStatus('Writing narrative...');
+        setNarrativeContent(piece);
+      } else {
+        setNarrativeContent(prev => prev + piece);
+      }
+    });
+    source.addEventListener('done', () => {
+      stopStream();
+      fetchVersions();
+    });
+    source.addEventListener('error', (e) => {
+      // Server-sent 'error' events carry a message; connection failures do not
+      const message = e.data ? JSON.parse(e.data).message : 'Lost connection while generating narrative';
+      setError(message);
+      stopStream();
+    });
+  };
+
   const fetchNarrativeContent = async () => {
     try {
       setLoading(true);
       setError('');
-      const response = await axios.get(`/api/projects/${projectId}/narrative`);
+      const response = await axios.get(`/api/projects/${projectId}/narrative`, { params: { html: 1 } });
       setNarrativeContent(response.data.narrative_content);
+      setNarrativeHtml(response.data.narrative_html || '');
       setProject(response.data.project);
     } catch (error) {
       console.error('Error fetching narrative:', error);
@@ -49,6 +150,12 @@ function Narrative() {
       <div className="d-flex justify-content-between align-items-center mb-4">
         <h1>Narrative: {project?.name}</h1>
         <div>
+          <button onClick={regenerateNarrative} className="btn btn-success me-2" disabled={streaming}>
+            {streaming ? streamStatus : 'Regenerate'}
+          </button>
+          {!streaming && narrativeContent && (
+            <ExportButtons projectId={projectId} kind="narrative" onError={setError} />
+          )}
           <button onClick={() => navigate('/projects')} className="btn btn-secondary me-2">Back to Projects</button>
           <button onClick={() => navigate('/')} className="btn btn-secondary me-2">Home</button>
           <button onClick={logout} className="btn btn-secondary">Logout</button>
@@ -62,10 +169,50 @@ function Narrative() {
       )}
 
       <div className="card">
-        <div className="card-body markdown-content">
-          <ReactMarkdown>{narrativeContent || 'No narrative content available'}</ReactMarkdown>
-        </div>
+        {narrativeHtml ? (
+          <div className="card-body markdown-content" dangerouslySetInnerHTML={{ __html: narrativeHtml }} />
+        ) : (
+          <div className="card-body markdown-content">
+            <ReactMarkdown>{narrativeContent || 'No narrative content available'}</ReactMarkdown>
+          </div>
+        )}
       </div>
+
+      {versions.length > 1 && (
+        <div className="card mt-4">
+          <div className="card-body">
+            <h5 className="card-title">History</h5>
+            <div className="d-flex align-items-center">
+              <select
+                className="form-select w-auto me-2"
+                value={selectedVersion}
+                onChange={(e) => { setSelectedVersion(e.target.value); setDiff(null); }}
+              >
+                <option value="">Earlier version...</option>
+                {versions.filter(v => v.version !== latestVersion).map(v => (
+                  <option key={v.version} value={v.version}>
+                    Version {v.version} ({new Date(v.created_at).toLocaleString()})
+                  </option>
+                ))}
+              </select>
+              <button onClick={compareVersion} className="btn btn-outline-secondary me-2" disabled={!selectedVersion}>
+                Compare with current
+              </button>
+              <button onClick={restoreVersion} className="btn btn-outline-primary" disabled={!selectedVersion || streaming}>
+                Restore
+              </button>
+            </div>
+            {diff && (
+              <div className="mt-3">
+                <p className="text-muted mb-1">
+                  Version {diff.from} to {diff.to}: {diff.added_lines} lines added, {diff.removed_lines} removed
+                </p>
+                <pre className="border rounded p-2 bg-light">{diff.diff || 'No differences'}</pre>
+              </div>
+            )}
+          </div>
+        </div>
+      )}
     </div>
   );
 }
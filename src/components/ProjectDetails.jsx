@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { useNavigate } from 'react-router-dom'
 import { useAuth } from '../context/AuthContext'
 import axios from 'axios'
@@ -8,13 +8,84 @@ function ProjectDetails() {
   const [projectName, setProjectName] = useState('')
   const [error, setError] = useState('')
   const [isProcessing, setIsProcessing] = useState(false)
+  const [job, setJob] = useState(null)
+  const pollTimer = useRef(null)
   const navigate = useNavigate()
   const { logout } = useAuth()
 
+  const STAGE_LABELS = {
+    download: 'Downloading documents',
+    extract: 'Extracting text',
+    summarize: 'Summarizing documents',
+    embed: 'Indexing documents',
+    narrative: 'Writing narrative',
+    save: 'Saving results'
+  }
+
   useEffect(() => {
     fetchCurrentProject()
+    return () => clearTimeout(pollTimer.current)
   }, [])
 
+  useEffect(() => {
+    if (project?.id) {
+      resumeActiveJob(project.id)
+    }
+  }, [project?.id])
+
+  const resumeActiveJob = async (projectId) => {
+    try {
+      const response = await axios.get(`/api/projects/${projectId}/jobs/latest`)
+      const latest = response.data.job
+      if (latest && (latest.status === 'queued' || latest.status === 'running')) {
+        setIsProcessing(true)
+        setJob(latest)
+        pollJob(latest.id)
+      }
+    } catch (error) {
+      console.error('Error fetching processing status:', error)
+    }
+  }
+
+  const pollJob = (jobId) => {
+    clearTimeout(pollTimer.current)
+    pollTimer.current = setTimeout(async () => {
+      try {
+        const response = await axios.get(`/api/jobs/${jobId}`)
+        const current = response.data.job
+        setJob(current)
+        if (current.status === 'succeeded') {
+          setIsProcessing(false)
+          await fetchCurrentProject()
+        } else if (current.status === 'failed') {
+          setIsProcessing(false)
+          setError(current.error || 'Failed to process project')
+        } else {
+          pollJob(jobId)
+        }
+      } catch (error) {
+        console.error('Error polling processing status:', error)
+        setIsProcessing(false)
+        setError('Lost track of processing status')
+      }
+    }, 2000)
+  }
+
+  const describeJob = (current) => {
+    const queue = current?.queue
+    if (!current || current.status === 'queued') {
+      return queue?.jobs_ahead ? `Queued (${queue.jobs_ahead} ahead)...` : 'Queued...'
+    }
+    const label = STAGE_LABELS[current.stage] || 'Processing'
+    const { current: done, total } = current.progress
+    const text = total > 1 ? `${label} (${done}/${total})` : label
+    // Other users' work is sharing the model; say roughly how long we wait
+    if (queue?.queued_calls_for_user && queue.estimated_wait_seconds >= 5) {
+      return `${text}, waiting for model capacity (about ${Math.ceil(queue.estimated_wait_seconds)}s)...`
+    }
+    return `${text}...`
+  }
+
   const fetchCurrentProject = async () => {
     try {
       const response = await axios.get('/api/current_project')
@@ -52,10 +123,56 @@ function ProjectDetails() {
     }
   }
 
+  // Files above this size go through the resumable chunked upload API
+  const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024
+
+  const uploadInChunks = async (file, fileType) => {
+    const start = await axios.post(`/api/projects/${project.id}/uploads`, {
+      filename: file.name,
+      file_type: fileType,
+      size: file.size
+    })
+    const uploadId = start.data.upload.upload_id
+    const chunkSize = start.data.chunk_size
+    let offset = 0
+    let retries = 0
+
+    while (offset < file.size) {
+      try {
+        const response = await axios.put(
+          `/api/uploads/${uploadId}?offset=${offset}`,
+          file.slice(offset, offset + chunkSize),
+          { headers: { 'Content-Type': 'application/octet-stream' } }
+        )
+        offset = response.data.upload.received
+        retries = 0
+      } catch (error) {
+        if (retries >= 3) throw error
+        retries += 1
+        // Resume from whatever the server actually received
+        const status = await axios.get(`/api/uploads/${uploadId}`)
+        offset = status.data.upload.received
+      }
+    }
+
+    await axios.post(`/api/uploads/${uploadId}/complete`)
+  }
+
   const handleOutlineUpload = async (e) => {
     const file = e.target.files[0]
     if (!file) return
 
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+      try {
+        await uploadInChunks(file, 'outline')
+        fetchCurrentProject()
+      } catch (error) {
+        console.error('Error uploading outline:', error)
+        setError('Error uploading outline')
+      }
+      return
+    }
+
     const formData = new FormData()
     formData.append('outline', file)
 
@@ -80,25 +197,33 @@ function ProjectDetails() {
     const files = Array.from(e.target.files)
     if (files.length === 0) return
 
+    const largeFiles = files.filter(file => file.size > CHUNKED_UPLOAD_THRESHOLD)
+    const smallFiles = files.filter(file => file.size <= CHUNKED_UPLOAD_THRESHOLD)
+
     const formData = new FormData()
-    files.forEach(file => {
+    smallFiles.forEach(file => {
       formData.append('documents', file)
     })
 
     try {
-      await axios.post(
-        `/api/projects/${project.id}/upload_documents`,
-        formData,
-        {
-          headers: {
-            'Content-Type': 'multipart/form-data'
+      if (smallFiles.length > 0) {
+        await axios.post(
+          `/api/projects/${project.id}/upload_documents`,
+          formData,
+          {
+            headers: {
+              'Content-Type': 'multipart/form-data'
+            }
           }
-        }
-      )
+        )
+      }
+      for (const file of largeFiles) {
+        await uploadInChunks(file, 'supporting')
+      }
       fetchCurrentProject()
     } catch (error) {
       console.error('Error uploading documents:', error)
-      setError('Error uploading documents')
+      setError(error.response?.data?.message || 'Error uploading documents')
     }
   }
 
@@ -109,14 +234,15 @@ function ProjectDetails() {
     try {
       const response = await axios.post(`/api/projects/${project.id}/process`)
       if (response.data.success) {
-        await fetchCurrentProject()
+        setJob(response.data.job)
+        pollJob(response.data.job.id)
       } else {
         setError('Failed to process project')
+        setIsProcessing(false)
       }
     } catch (error) {
       console.error('Error processing project:', error)
       setError(error.response?.data?.message || 'Error processing project')
-    } finally {
       setIsProcessing(false)
     }
   }
@@ -253,7 +379,7 @@ function ProjectDetails() {
                   className="btn btn-success"
                   disabled={isProcessing}
                 >
-                  {isProcessing ? 'Processing...' : 'Process Project'}
+                  {isProcessing ? describeJob(job) : 'Process Project'}
                 </button>
               </div>
             )}
@@ -6,18 +6,21 @@ import axios from 'axios'
 function Projects() {
   const [activeProjects, setActiveProjects] = useState([])
   const [archivedProjects, setArchivedProjects] = useState([])
+  const [page, setPage] = useState(1)
+  const [pagination, setPagination] = useState(null)
   const navigate = useNavigate()
   const { logout, user } = useAuth()
 
   useEffect(() => {
     fetchProjects()
-  }, [])
+  }, [page])
 
   const fetchProjects = async () => {
     try {
-      const response = await axios.get('/api/projects')
+      const response = await axios.get('/api/projects', { params: { page } })
       setActiveProjects(response.data.active_projects)
       setArchivedProjects(response.data.archived_projects)
+      setPagination(response.data.pagination)
     } catch (error) {
       console.error('Error fetching projects:', error)
     }
@@ -47,6 +50,7 @@ function Projects() {
         <h1>My Projects</h1>
         <div>
           <button onClick={() => navigate('/')} className="btn btn-secondary me-2">Home</button>
+          <button onClick={() => navigate('/search')} className="btn btn-secondary me-2">Search</button>
           <button onClick={logout} className="btn btn-secondary">Logout</button>
         </div>
       </div>
@@ -98,6 +102,31 @@ function Projects() {
           </div>
         ))}
       </div>
+
+      {pagination && (
+        <div className="d-flex justify-content-center align-items-center gap-3 mb-5">
+          <button
+            onClick={() => setPage(page - 1)}
+            className="btn btn-secondary"
+            disabled={page <= 1}
+          >
+            Previous
+          </button>
+          <span>Page {page}</span>
+          <button
+            onClick={() => setPage(page + 1)}
+            className="btn btn-secondary"
+            disabled={
+              page * pagination.per_page >= Math.max(
+                pagination.active_projects_total,
+                pagination.archived_projects_total
+              )
+            }
+          >
+            Next
+          </button>
+        </div>
+      )}
     </div>
   )
 }
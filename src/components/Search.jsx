@@ -0,0 +1,84 @@
+import React, { useState } from 'react'
+import { useNavigate } from 'react-router-dom'
+import axios from 'axios'
+
+const PAGE_SIZE = 20
+
+function Search() {
+  const [query, setQuery] = useState('')
+  const [results, setResults] = useState([])
+  const [hasMore, setHasMore] = useState(false)
+  const [offset, setOffset] = useState(0)
+  const [message, setMessage] = useState('')
+  const [searched, setSearched] = useState(false)
+  const navigate = useNavigate()
+
+  const runSearch = async (newOffset) => {
+    try {
+      const response = await axios.get('/api/search', {
+        params: { q: query, limit: PAGE_SIZE, offset: newOffset }
+      })
+      setResults(response.data.results)
+      setHasMore(response.data.has_more)
+      setOffset(newOffset)
+      setMessage('')
+      setSearched(true)
+    } catch (error) {
+      setResults([])
+      setHasMore(false)
+      setMessage(error.response?.data?.message || 'Search failed')
+    }
+  }
+
+  const handleSubmit = (e) => {
+    e.preventDefault()
+    runSearch(0)
+  }
+
+  return (
+    <div className="container mt-5">
+      <div className="d-flex justify-content-between align-items-center mb-4">
+        <h1>Search Documents</h1>
+        <button onClick={() => navigate('/projects')} className="btn btn-secondary">Projects</button>
+      </div>
+
+      <form onSubmit={handleSubmit} className="d-flex gap-2 mb-4">
+        <input
+          type="search"
+          className="form-control"
+          placeholder='e.g. ESY regression, "extended school year"'
+          value={query}
+          onChange={(e) => setQuery(e.target.value)}
+        />
+        <button type="submit" className="btn btn-primary">Search</button>
+      </form>
+
+      {message && <div className="alert alert-warning">{message}</div>}
+      {searched && !message && results.length === 0 && <p>No matching pages.</p>}
+
+      {results.map(hit => (
+        <div key={`${hit.document_id}-${hit.page_number}`} className="card mb-3">
+          <div className="card-body">
+            <h6 className="card-title mb-1">{hit.filename}, page {hit.page_number}</h6>
+            <p className="text-muted small mb-2">{hit.project_name}</p>
+            {/* Snippets are HTML-escaped by the server apart from <mark> */}
+            <p className="card-text" dangerouslySetInnerHTML={{ __html: hit.snippet }} />
+          </div>
+        </div>
+      ))}
+
+      {(offset > 0 || hasMore) && (
+        <div className="d-flex justify-content-center gap-3 mb-5">
+          <button onClick={() => runSearch(offset - PAGE_SIZE)} className="btn btn-secondary" disabled={offset === 0}>
+            Previous
+          </button>
+          <button onClick={() => runSearch(offset + PAGE_SIZE)} className="btn btn-secondary" disabled={!hasMore}>
+            Next
+          </button>
+        </div>
+      )}
+    </div>
+  )
+}
+
+export default Search
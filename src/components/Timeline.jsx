@@ -3,12 +3,14 @@ import { useParams, useNavigate } from 'react-router-dom';
 import axios from 'axios';
 import { useAuth } from '../context/AuthContext';
 import ReactMarkdown from 'react-markdown';
+import ExportButtons from './ExportButtons';
 
 function Timeline() {
   const [timelineContent, setTimelineContent] = useState('');
   const [project, setProject] = useState(null);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
+  const [range, setRange] = useState({ start: '', end: '' });
   const { projectId } = useParams();
   const navigate = useNavigate();
   const { logout } = useAuth();
@@ -17,11 +19,14 @@ function Timeline() {
     fetchTimelineContent();
   }, [projectId]);
 
-  const fetchTimelineContent = async () => {
+  const fetchTimelineContent = async (dates = range) => {
     try {
       setLoading(true);
       setError('');
-      const response = await axios.get(`/api/projects/${projectId}/timeline`);
+      const params = {};
+      if (dates.start) params.start = dates.start;
+      if (dates.end) params.end = dates.end;
+      const response = await axios.get(`/api/projects/${projectId}/timeline`, { params });
       setTimelineContent(response.data.timeline_content);
       setProject(response.data.project);
     } catch (error) {
@@ -49,12 +54,39 @@ function Timeline() {
       <div className="d-flex justify-content-between align-items-center mb-4">
         <h1>Timeline: {project?.name}</h1>
         <div>
+          <ExportButtons projectId={projectId} kind="timeline" onError={setError} />
           <button onClick={() => navigate('/projects')} className="btn btn-secondary me-2">Back to Projects</button>
           <button onClick={() => navigate('/')} className="btn btn-secondary me-2">Home</button>
           <button onClick={logout} className="btn btn-secondary">Logout</button>
         </div>
       </div>
 
+      <form
+        className="row g-2 align-items-end mb-3"
+        onSubmit={(e) => { e.preventDefault(); fetchTimelineContent(); }}
+      >
+        <div className="col-auto">
+          <label className="form-label" htmlFor="timeline-start">From</label>
+          <input id="timeline-start" type="date" className="form-control" value={range.start}
+            onChange={(e) => setRange({ ...range, start: e.target.value })} />
+        </div>
+        <div className="col-auto">
+          <label className="form-label" htmlFor="timeline-end">To</label>
+          <input id="timeline-end" type="date" className="form-control" value={range.end}
+            onChange={(e) => setRange({ ...range, end: e.target.value })} />
+        </div>
+        <div className="col-auto">
+          <button type="submit" className="btn btn-primary me-2">Filter</button>
+          <button
+            type="button"
+            className="btn btn-outline-secondary"
+            onClick={() => { const all = { start: '', end: '' }; setRange(all); fetchTimelineContent(all); }}
+          >
+            All dates
+          </button>
+        </div>
+      </form>
+
       {error && (
         <div className="alert alert-danger" role="alert">
           {error}
@@ -0,0 +1,153 @@
+"""Fixtures for running the app offline: a throwaway SQLite database, local
+storage and the fake LLM (utils/fake_llm.py)."""
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix='fape-tests-')
+
+# Read at import time by the modules below
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(TMP_DIR, 'app.db')}",
+    'SECRET_KEY': 'tests',
+    'LLM_BACKEND': 'fake',
+    'STORAGE_BACKEND': 'local',
+    'LOCAL_STORAGE_ROOT': os.path.join(TMP_DIR, 'storage'),
+})
+sys.path.insert(0, ROOT)
+
+from app import create_app, upgrade_schema  # noqa: E402
+from models import db, User, Project, Document, DocumentPage  # noqa: E402
+from utils import gpt4_processor  # noqa: E402
+from utils.storage import save_to_storage, generate_storage_key  # noqa: E402
+from utils.fake_llm import FakeOpenAIClient  # noqa: E402
+
+OUTLINE = b"03/01/2019 - Parent requested an evaluation\n04/15/2019 - IEP meeting held\n"
+EXHIBIT_PAGES = [
+    "The district completed its evaluation on March 14, 2019.",
+    "The team agreed to weekly speech therapy at the April meeting.",
+]
+
+POLL_SECONDS = 0.05
+TIMEOUT_SECONDS = 30
+
+def wait_for(condition, timeout=TIMEOUT_SECONDS):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('condition not met in time')
+        time.sleep(POLL_SECONDS)
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app({'TESTING': True})
+    upgrade_schema(app)
+    return app
+
+@pytest.fixture
+def login(app):
+    """login() returns a test client logged in as a new user"""
+    def make():
+        with app.app_context():
+            number = User.query.count() + 1
+            user = User(username=f'user{number}', email=f'user{number}@example.com')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+    return make
+
+@pytest.fixture
+def client(login):
+    """A test client logged in as a new user"""
+    return login()
+
+@pytest.fixture
+def project(app, client):
+    """Id of a project with an outline and one extracted exhibit, ready to process"""
+    with client.session_transaction() as session:
+        user_id = int(session['_user_id'])
+    with app.app_context():
+        project = Project(user_id=user_id, name='Test case')
+        db.session.add(project)
+        db.session.flush()
+        exhibit = Document(project_id=project.id, filename='exhibit.pdf', file_type='supporting',
+                           content_hash=f'{project.id:064x}', page_count=len(EXHIBIT_PAGES),
+                           extraction_status='done')
+        db.session.add_all([Document(project_id=project.id, filename='outline.txt', file_type='outline'), exhibit])
+        db.session.flush()
+        db.session.add_all(DocumentPage(document_id=exhibit.id, page_number=number, text=text)
+                           for number, text in enumerate(EXHIBIT_PAGES, 1))
+        db.session.commit()
+        project_id = project.id
+
+    save_to_storage(io.BytesIO(OUTLINE), generate_storage_key(user_id, project_id, 'outline.txt'))
+    return project_id
+
+@pytest.fixture
+def make_project(app, client):
+    """make_project(folder) uploads a case folder (outline.txt plus PDFs) to a
+    new project, waits for its extraction and returns the project id"""
+    def make(folder):
+        project_id = client.post('/api/projects', json={'name': 'Test case'}).get_json()['project']['id']
+
+        with open(os.path.join(folder, 'outline.txt'), 'rb') as f:
+            response = client.post(f'/api/projects/{project_id}/upload_outline',
+                                   data={'outline': (f, 'outline.txt')})
+        assert response.status_code == 200, response.get_json()
+        pdfs = sorted(name for name in os.listdir(folder) if name.endswith('.pdf'))
+        files = [(open(os.path.join(folder, name), 'rb'), name) for name in pdfs]
+        try:
+            response = client.post(f'/api/projects/{project_id}/upload_documents', data={'documents': files})
+        finally:
+            for f, _ in files:
+                f.close()
+        assert response.status_code == 200, response.get_json()
+
+        def extracted():
+            with app.app_context():
+                return not Document.query.filter(
+                    Document.project_id == project_id,
+                    Document.file_type == 'supporting',
+                    Document.extraction_status.notin_(('done', 'failed'))
+                ).count()
+
+        wait_for(extracted)
+        return project_id
+    return make
+
+@pytest.fixture
+def llm():
+    """The fake client every LLM call goes to during the test"""
+    client = FakeOpenAIClient()
+    gpt4_processor.set_openai_client(client)
+    yield client
+    gpt4_processor.set_openai_client(None)
+
+@pytest.fixture
+def process(client):
+    """process(project_id, force=False) runs a processing job through the
+    queue and returns the finished job"""
+    def run(project_id, force=False):
+        response = client.post(f'/api/projects/{project_id}/process', json={'force': force})
+        assert response.status_code == 202, response.get_json()
+        job_id = response.get_json()['job']['id']
+        job = {}
+
+        def finished():
+            job.update(client.get(f'/api/jobs/{job_id}').get_json()['job'])
+            return job['status'] in ('succeeded', 'failed')
+
+        wait_for(finished)
+        return job
+    return run
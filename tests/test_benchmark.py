@@ -0,0 +1,22 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT
+
+def test_small_case_runs_end_to_end():
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.pipeline', '--cases', 'small', '--llm-latency', '0',
+         '--llm-tokens-per-second', '0', '--llm-output-tokens', '50', '--json'],
+        cwd=ROOT, env={**os.environ, 'NARRATIVE_CONTEXT_MODE': 'summaries'},
+        capture_output=True, text=True, timeout=300, check=True
+    )
+    result, = json.loads(completed.stdout)['results']
+
+    assert result['case'] == 'small'
+    assert result['documents'] == 3 and result['pages'] == 15
+    assert result['process']['cache']['summary_cache_misses'] == 3
+    # The forced rerun summarizes nothing again
+    assert result['rerun']['cache']['summary_cache_hits'] == 3
+    assert 'summarize_chunk' not in result['rerun']['llm']
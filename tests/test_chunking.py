@@ -0,0 +1,56 @@
+from utils import gpt4_processor
+from utils.chunking import PAGE_BREAK, chunk_text, count_tokens
+
+def pages(count, sentences=40):
+    return PAGE_BREAK.join(
+        " ".join(f"Page {page} sentence {n} about the services offered." for n in range(sentences))
+        for page in range(count)
+    )
+
+def test_chunks_stay_under_budget_and_split_on_pages():
+    text = pages(6)
+    page_tokens = count_tokens(text.split(PAGE_BREAK)[0])
+    chunks = chunk_text(text, page_tokens * 2 + 10)
+
+    assert all(count_tokens(chunk) <= page_tokens * 2 + 10 for chunk in chunks)
+    assert len(chunks) == 3
+    assert all(chunk.startswith(f"Page {2 * i} ") for i, chunk in enumerate(chunks))
+
+def test_oversized_pages_split_on_finer_boundaries():
+    text = "\n".join(f"Line {n} of one very long page." for n in range(400))
+    chunks = chunk_text(text, 50)
+
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 50 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+def test_long_documents_are_summarized_by_map_reduce(llm, monkeypatch):
+    monkeypatch.setattr(gpt4_processor, 'SUMMARY_CHUNK_TOKENS', 200)
+    text = pages(8)
+    chunks = chunk_text(text, 200, gpt4_processor.SUMMARY_MODEL)
+    usage = gpt4_processor.TokenUsage()
+
+    summary = gpt4_processor.summarize_text(text, usage)
+
+    stages = usage.to_dict()['stages']
+    assert summary.startswith('## Generated Content')
+    assert stages['summarize_chunk']['calls'] == len(chunks) > 1
+    assert stages['summarize_reduce']['calls'] >= 1
+    assert len(llm.calls) == len(chunks) + stages['summarize_reduce']['calls']
+    # Every map call saw one chunk, within budget
+    map_prompts = [call['messages'][0]['content'] for call in llm.calls[:len(chunks)]]
+    assert sorted(map_prompts) == sorted(gpt4_processor.SUMMARY_PROMPT.format(text=chunk) for chunk in chunks)
+
+def test_narrative_prompt_fits_the_context_window(llm, monkeypatch):
+    monkeypatch.setattr(gpt4_processor, 'NARRATIVE_CONTEXT_TOKENS', 3000)
+    monkeypatch.setattr(gpt4_processor, 'NARRATIVE_OUTPUT_TOKENS', 500)
+    summaries = [pages(1, sentences=n * 30) for n in range(1, 6)]
+
+    timeline, fitted = gpt4_processor._fit_narrative_content("01/02/2020 - Meeting held", summaries)
+
+    content = "Timeline:\n" + timeline + "".join(f"\nDocument {i}:\n{s}\n" for i, s in enumerate(fitted, 1))
+    prompt = gpt4_processor.NARRATIVE_PROMPT.format(content=content)
+    assert count_tokens(prompt) <= 3000 - 500
+    # Only the summaries over their share were condensed
+    assert fitted[0] == summaries[0]
+    assert 1 <= len(llm.calls) < len(summaries)
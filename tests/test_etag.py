@@ -0,0 +1,36 @@
+import gzip
+
+from models import db, Output
+
+def set_narrative(app, project_id, narrative):
+    with app.app_context():
+        output = Output.query.filter_by(project_id=project_id).first()
+        if output is None:
+            output = Output(project_id=project_id)
+            db.session.add(output)
+        output.set_content('03/01/2019 - Evaluation requested', narrative)
+        db.session.commit()
+
+def test_unchanged_narrative_is_answered_with_304(app, client, project):
+    set_narrative(app, project, 'The parent requested an evaluation.')
+    first = client.get(f'/api/projects/{project}/narrative')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    assert first.headers['Cache-Control'] == 'private, no-cache'
+
+    again = client.get(f'/api/projects/{project}/narrative', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+
+    set_narrative(app, project, 'The district completed its evaluation.')
+    changed = client.get(f'/api/projects/{project}/narrative', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert changed.get_json()['narrative_content'] == 'The district completed its evaluation.'
+
+def test_large_bodies_are_gzipped(app, client, project):
+    set_narrative(app, project, 'The team met again. ' * 200)
+    response = client.get(f'/api/projects/{project}/narrative', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert b'The team met again.' in gzip.decompress(response.data)
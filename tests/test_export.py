@@ -0,0 +1,77 @@
+import pytest
+
+from models import db, Output, RenderCache
+from utils import render
+from utils.render import evict_rendered
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Formats rendered (rather than read from the cache), in order"""
+    calls = []
+    original = render.render
+
+    def counted(text, fmt, title):
+        calls.append(fmt)
+        return original(text, fmt, title)
+
+    monkeypatch.setattr(render, 'render', counted)
+    return calls
+
+def set_narrative(app, project_id, narrative):
+    with app.app_context():
+        output = Output.query.filter_by(project_id=project_id).first()
+        if output is None:
+            output = Output(project_id=project_id)
+            db.session.add(output)
+        output.set_content('03/01/2019 - Evaluation requested', narrative)
+        db.session.commit()
+
+def test_unchanged_narrative_is_rendered_once(app, client, project, renders):
+    set_narrative(app, project, '# Summary\n\nThe team met <script>alert(1)</script> in April.')
+    url = f'/api/projects/{project}/export/narrative.html'
+
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.headers['Content-Disposition'].startswith('attachment')
+    assert b'<h1>Summary</h1>' in first.data
+    assert b'<script>' not in first.data and b'&lt;script&gt;' in first.data
+
+    second = client.get(url)
+    assert second.data == first.data
+    assert client.get(url, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert renders == ['html']
+
+    set_narrative(app, project, '# Summary\n\nThe team met again in May.')
+    changed = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert changed.status_code == 200
+    assert b'May' in changed.data
+    assert renders == ['html', 'html']
+
+def test_narrative_html_comes_from_the_render_cache(app, client, project, renders):
+    set_narrative(app, project, 'Plain *emphasis*.')
+    for _ in range(2):
+        response = client.get(f'/api/projects/{project}/narrative?html=1')
+        assert response.get_json()['narrative_html'] == '<p>Plain <em>emphasis</em>.</p>'
+    assert renders == ['fragment']
+
+@pytest.mark.parametrize('fmt, magic', [('docx', b'PK'), ('pdf', b'%PDF')])
+def test_documents_are_exported(app, client, project, fmt, magic):
+    pytest.importorskip({'docx': 'docx', 'pdf': 'fpdf'}[fmt])
+    set_narrative(app, project, '## Events\n\n- Evaluation requested\n- Meeting held')
+    response = client.get(f'/api/projects/{project}/export/narrative.{fmt}')
+    assert response.status_code == 200
+    assert response.data.startswith(magic)
+
+def test_least_recently_used_renders_are_evicted(app, client, project):
+    set_narrative(app, project, f'Narrative of project {project}.')
+    narrative = f'/api/projects/{project}/export/narrative.html'
+    client.get(narrative)
+    client.get(f'/api/projects/{project}/export/timeline.html')
+    # Reading the narrative again makes it the most recently used
+    etag = client.get(narrative).headers['ETag']
+
+    with app.app_context():
+        newest = RenderCache.query.order_by(RenderCache.last_used_at.desc()).first()
+        assert newest.cache_key.startswith(etag.strip('W/"'))
+        assert evict_rendered(max_bytes=newest.size_bytes) >= 1
+        assert [entry.cache_key for entry in RenderCache.query.all()] == [newest.cache_key]
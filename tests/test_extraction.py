@@ -0,0 +1,44 @@
+from benchmarks.cases import make_pdf
+from models import db, Document, Project
+from utils import extraction
+
+def test_pages_are_stored_and_only_empty_ones_go_to_ocr(app, client, monkeypatch):
+    pdf = make_pdf([["First page"], [], ["Third page"], [], ["Fifth page"]])
+    asked = []
+
+    def read_missing_pages(pdf_content, missing, usage=None):
+        asked.append(list(missing))
+        return {1: 'Scanned page'}
+
+    monkeypatch.setattr(extraction, 'read_missing_pages', read_missing_pages)
+    monkeypatch.setattr(extraction, 'EXTRACT_COMMIT_PAGES', 2)
+    project_id = client.post('/api/projects', json={'name': 'Scans'}).get_json()['project']['id']
+
+    with app.app_context():
+        project = db.session.get(Project, project_id)
+        document = Document(project_id=project_id, filename='scans.pdf', file_type='supporting')
+        db.session.add(document)
+        db.session.commit()
+
+        assert extraction.extract_document(document, project.user_id, pdf_content=pdf)
+        assert asked == [[1, 3]]
+        assert [page.text.strip() for page in document.pages] == ['First page', 'Scanned page', 'Third page', '', 'Fifth page']
+        assert (document.page_count, document.text_pages, document.ocr_pages, document.failed_pages) == (5, 3, 1, 1)
+
+def test_a_document_another_worker_is_extracting_is_left_alone(app, client):
+    pdf = make_pdf([["Only page"]])
+    project_id = client.post('/api/projects', json={'name': 'Busy'}).get_json()['project']['id']
+
+    with app.app_context():
+        project = db.session.get(Project, project_id)
+        document = Document(project_id=project_id, filename='busy.pdf', file_type='supporting',
+                            extraction_status='running')
+        db.session.add(document)
+        db.session.commit()
+
+        assert not extraction.extract_document(document, project.user_id, pdf_content=pdf)
+        assert (document.extraction_status, document.pages) == ('running', [])
+
+        # Its own extract job, rerun after the worker died, takes it over
+        assert extraction.extract_document(document, project.user_id, pdf_content=pdf, take_over=True)
+        assert [page.text.strip() for page in document.pages] == ['Only page']
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from models import db, Document, DocumentPage, Output, Project, StageFingerprint
+from utils import pipeline
+from utils.gpt4_processor import SUMMARY_ERROR
+from utils.pipeline import process_project, PipelineError
+
+def run(app, project_id, **kwargs):
+    report = {}
+    with app.app_context():
+        user_id = db.session.get(Project, project_id).user_id
+        process_project(project_id, user_id, report=report, **kwargs)
+    return report
+
+def test_unchanged_project_reuses_every_stage(app, project, llm):
+    first = run(app, project)
+    assert first['narrative'] == 'recomputed'
+    calls = len(llm.calls)
+
+    second = run(app, project)
+    assert second['narrative'] == 'reused'
+    assert len(llm.calls) == calls
+
+    forced = run(app, project, force=True)
+    assert forced['narrative'] == 'recomputed'
+    assert len(llm.calls) > calls
+
+def test_new_exhibit_rewrites_the_narrative(app, project, llm):
+    run(app, project)
+    with app.app_context():
+        db.session.add(Document(project_id=project, filename='letter.pdf', file_type='supporting',
+                                content_hash='f' * 64, extraction_status='done'))
+        db.session.commit()
+
+    assert run(app, project)['narrative'] == 'recomputed'
+
+def test_failed_narrative_is_not_saved(app, project, llm):
+    llm.error = RuntimeError('model overloaded')
+
+    with pytest.raises(PipelineError, match='model overloaded'):
+        run(app, project)
+
+    with app.app_context():
+        assert Output.query.filter_by(project_id=project).first() is None
+        assert StageFingerprint.query.filter_by(project_id=project, stage='narrative').count() == 0
+
+def add_exhibit(app, project_id, filename, status, text=None):
+    with app.app_context():
+        document = Document(project_id=project_id, filename=filename, file_type='supporting',
+                            content_hash=filename.ljust(64, '0'), extraction_status=status)
+        db.session.add(document)
+        if text:
+            db.session.flush()
+            db.session.add(DocumentPage(document_id=document.id, page_number=1, text=text))
+        db.session.commit()
+        return document.id
+
+def test_documents_being_extracted_are_waited_for(app, project, llm, monkeypatch):
+    monkeypatch.setattr(pipeline, 'EXTRACTION_POLL_SECONDS', 0.05)
+    document_id = add_exhibit(app, project, 'late.pdf', 'running', text='The late exhibit.')
+
+    def finish_extraction():
+        time.sleep(0.3)
+        with app.app_context():
+            db.session.get(Document, document_id).extraction_status = 'done'
+            db.session.commit()
+
+    worker = threading.Thread(target=finish_extraction)
+    worker.start()
+    report = run(app, project)
+    worker.join()
+
+    assert report['extract'] == {'reused': 2, 'recomputed': 0, 'skipped': []}
+
+def test_documents_still_being_extracted_are_skipped_and_reported(app, project, llm, monkeypatch):
+    monkeypatch.setattr(pipeline, 'EXTRACTION_WAIT_SECONDS', 0.2)
+    monkeypatch.setattr(pipeline, 'EXTRACTION_POLL_SECONDS', 0.05)
+    document_id = add_exhibit(app, project, 'late.pdf', 'running', text='Half written.')
+
+    report = run(app, project)
+
+    assert report['extract'] == {'reused': 1, 'recomputed': 0, 'skipped': ['late.pdf']}
+    assert report['narrative'] == 'recomputed'
+    with app.app_context():
+        # The other worker's extraction was left alone
+        document = db.session.get(Document, document_id)
+        assert document.extraction_status == 'running'
+        assert [page.text for page in document.pages] == ['Half written.']
+
+def test_failed_summaries_are_left_out_of_the_prompt_and_reported(app, project, llm):
+    add_exhibit(app, project, 'broken.pdf', 'done', text='An exhibit the model chokes on.')
+
+    def reply(prompt):
+        if 'chokes on' in prompt:
+            raise ValueError('bad request')
+    llm.reply = reply
+    report = run(app, project)
+
+    assert report['summarize']['failed'] == ['broken.pdf']
+    narrative_prompt = llm.calls[-1]['messages'][-1]['content']
+    assert 'Document 1:' in narrative_prompt and SUMMARY_ERROR not in narrative_prompt
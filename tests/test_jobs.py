@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+from models import db, Output, Project, ProcessingJob, User
+from utils import jobs
+
+def test_failed_narrative_call_fails_the_job(client, project, llm, process):
+    llm.error = RuntimeError('context_length_exceeded')
+    job = process(project)
+
+    assert job['status'] == 'failed'
+    assert 'context_length_exceeded' in job['error']
+    assert client.get(f'/api/projects/{project}/narrative').status_code == 404
+
+    # Nothing was saved or fingerprinted, so the next run writes the narrative
+    llm.error = None
+    job = process(project)
+
+    assert job['status'] == 'succeeded'
+    assert job['stages']['narrative'] == 'recomputed'
+    narrative = client.get(f'/api/projects/{project}/narrative').get_json()['narrative_content']
+    assert narrative and 'context_length_exceeded' not in narrative
+
+def add_running_job(project_id, owner, lease_expires_at, updated_at=None, job_type='process'):
+    job = ProcessingJob(project_id=project_id, user_id=db.session.get(Project, project_id).user_id,
+                        job_type=job_type, status='running', owner=owner, lease_expires_at=lease_expires_at,
+                        started_at=updated_at or datetime.utcnow(), updated_at=updated_at or datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+def test_only_jobs_whose_lease_ran_out_are_requeued(app, project, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(jobs, '_submit', submitted.append)
+    now = datetime.utcnow()
+    long_ago = now - timedelta(hours=1)
+
+    with app.app_context():
+        # A long job whose worker is alive: no progress for an hour, lease renewed
+        live = add_running_job(project, 'web-1:10', now + timedelta(seconds=60), updated_at=long_ago)
+        expired = add_running_job(project, 'web-2:20', now - timedelta(seconds=1))
+        unleased = add_running_job(project, None, None, updated_at=long_ago)
+        jobs.resume_pending_jobs()
+
+        statuses = {job.id: (job.status, job.owner) for job in ProcessingJob.query.filter(
+            ProcessingJob.id.in_((live, expired, unleased)))}
+        # Keep the requeued jobs from running in later tests
+        ProcessingJob.query.filter(ProcessingJob.id.in_((live, expired, unleased))).delete(synchronize_session=False)
+        db.session.commit()
+    assert statuses == {live: ('running', 'web-1:10'), expired: ('queued', None), unleased: ('queued', None)}
+    assert {expired, unleased} <= set(submitted) and live not in submitted
+
+def test_orphaned_stream_is_failed_and_its_draft_dropped(app, project, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(jobs, '_submit', submitted.append)
+
+    with app.app_context():
+        output = Output(project_id=project, version=0)
+        output.set_content('Timeline', 'Half a narr', new_version=False)
+        db.session.add(output)
+        stream = add_running_job(project, 'web-2:20', datetime.utcnow() - timedelta(seconds=1), job_type='stream')
+        jobs.resume_pending_jobs()
+
+        job = db.session.get(ProcessingJob, stream)
+        assert (job.status, job.lease_expires_at) == ('failed', None)
+        assert Output.query.filter_by(project_id=project).first() is None
+    assert stream not in submitted
+
+def test_heartbeat_renews_only_this_workers_leases(app, project, monkeypatch):
+    monkeypatch.setattr(jobs, '_running', set())
+    past = datetime.utcnow() - timedelta(seconds=1)
+
+    with app.app_context():
+        ours = add_running_job(project, jobs.worker_id(), past)
+        taken_over = add_running_job(project, 'web-2:20', past)
+        jobs._running.update((ours, taken_over))
+
+        assert jobs.renew_leases() == 1
+        leases = {job.id: job.lease_expires_at for job in ProcessingJob.query.filter(
+            ProcessingJob.id.in_((ours, taken_over)))}
+        assert leases[ours] > datetime.utcnow() + timedelta(seconds=jobs.JOB_LEASE_SECONDS - 10)
+        assert leases[taken_over] == past
+
+def test_queued_jobs_are_taken_user_by_user(app):
+    now = datetime.utcnow()
+    with app.app_context():
+        projects = {}
+        for name in ('bulk', 'single', 'busy'):
+            user = User(username=f'{name}-dispatch', email=f'{name}-dispatch@example.com')
+            db.session.add(user)
+            db.session.flush()
+            project = Project(user_id=user.id, name=name)
+            db.session.add(project)
+            db.session.flush()
+            projects[name] = (user.id, project.id)
+
+        def add(name, status='queued', started_at=None):
+            user_id, project_id = projects[name]
+            job = ProcessingJob(project_id=project_id, user_id=user_id, job_type='extract', status=status,
+                                started_at=started_at)
+            db.session.add(job)
+            db.session.flush()
+            return job.id
+
+        # One user queued a batch a while ago and has had a job started since
+        add('bulk', status='succeeded', started_at=now - timedelta(minutes=1))
+        bulk = [add('bulk') for _ in range(3)]
+        # Another is already running a job
+        add('busy', status='running', started_at=now - timedelta(hours=1))
+        busy = add('busy')
+        # A third queued one job last
+        single = add('single')
+        db.session.commit()
+
+        mine = set(bulk + [busy, single])
+        order = [job_id for job_id in db.session.scalars(jobs.select_next_jobs(limit=1000)) if job_id in mine]
+        # Leave no jobs without documents for the workers of later tests
+        ProcessingJob.query.filter(ProcessingJob.id.in_(mine)).delete(synchronize_session=False)
+        db.session.commit()
+    assert order == [single] + bulk + [busy]
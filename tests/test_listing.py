@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, Document, Output, Project
+
+@contextmanager
+def counted_queries(app):
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+def add_projects(app, client, count, archived=False):
+    ids = [client.post('/api/projects', json={'name': f'Case {n}'}).get_json()['project']['id'] for n in range(count)]
+    with app.app_context():
+        for project_id in ids:
+            db.session.get(Project, project_id).archived = archived
+            db.session.add_all(Document(project_id=project_id, filename=f'exhibit{n}.pdf', file_type='supporting')
+                               for n in range(3))
+            db.session.add(Output(project_id=project_id, timeline_content='-', narrative_content='-'))
+        db.session.commit()
+    return ids
+
+def listing_queries(app, client):
+    with counted_queries(app) as statements:
+        response = client.get('/api/projects')
+    assert response.status_code == 200
+    return len(statements), response.get_json()
+
+def test_listing_costs_the_same_queries_for_any_number_of_projects(app, login):
+    small, large = login(), login()
+    add_projects(app, small, 2)
+    add_projects(app, small, 1, archived=True)
+    add_projects(app, large, 12)
+    add_projects(app, large, 3, archived=True)
+
+    small_count, _ = listing_queries(app, small)
+    large_count, listing = listing_queries(app, large)
+
+    assert large_count == small_count
+    assert len(listing['active_projects']) == 12
+    assert len(listing['archived_projects']) == 3
+    assert all(project['has_output'] and len(project['documents']) == 3 for project in listing['active_projects'])
+
+def test_listing_pages_and_filters(app, client):
+    add_projects(app, client, 5)
+    add_projects(app, client, 1, archived=True)
+
+    page = client.get('/api/projects?per_page=2&page=3&archived=false').get_json()
+    assert [project['name'] for project in page['active_projects']] == ['Case 0']
+    assert 'archived_projects' not in page
+    assert page['pagination']['active_projects_total'] == 5
+
+    found = client.get('/api/projects?q=case 3').get_json()
+    assert [project['name'] for project in found['active_projects']] == ['Case 3']
+
+def test_current_project_is_the_newest(app, client):
+    ids = add_projects(app, client, 3)
+    assert client.get('/api/current_project').get_json()['project']['id'] == ids[-1]
+
+def test_signed_out_requests_are_sent_to_the_login_page(app):
+    response = app.test_client().get('/api/projects')
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith('/login?next=')
@@ -0,0 +1,39 @@
+import pytest
+
+from benchmarks.cases import make_pdf
+from models import Project, TimelineEvent
+from utils import gpt4_processor, pipeline
+
+EXHIBIT = 'Evaluation_report.pdf'
+
+def summary_with_dates(prompt):
+    if prompt.startswith('Summarize') and 'independent evaluation' in prompt:
+        return "## Events\n- March 14, 2019: The district completed an independent evaluation\n"
+    return None
+
+@pytest.fixture
+def evaluation_project(make_project, tmp_path):
+    """A project whose only exhibit dates an event the outline does not mention"""
+    (tmp_path / 'outline.txt').write_text("03/01/2019 - Parent requested an independent evaluation\n")
+    (tmp_path / EXHIBIT).write_bytes(make_pdf([[
+        "Evaluation report",
+        "The district completed an independent evaluation on March 14, 2019.",
+    ]]))
+    return make_project(str(tmp_path))
+
+@pytest.mark.parametrize('mode', ['summaries', 'retrieval'])
+def test_timeline_includes_dates_from_the_documents(app, evaluation_project, llm, monkeypatch, mode):
+    monkeypatch.setattr(gpt4_processor, 'NARRATIVE_CONTEXT_MODE', mode)
+    monkeypatch.setattr(pipeline, 'NARRATIVE_CONTEXT_MODE', mode)
+    llm.reply = summary_with_dates
+
+    with app.app_context():
+        user_id = pipeline.db.session.get(Project, evaluation_project).user_id
+        output = pipeline.process_project(evaluation_project, user_id)
+        events = TimelineEvent.query.filter_by(project_id=evaluation_project).order_by(TimelineEvent.position).all()
+
+        assert 'March 14, 2019' in output.timeline_content
+        assert [(str(event.event_date), event.sources) for event in events] == [
+            ('2019-03-01', None),
+            ('2019-03-14', [EXHIBIT]),
+        ]
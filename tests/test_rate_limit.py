@@ -0,0 +1,71 @@
+import threading
+import time
+
+from utils import gpt4_processor, rate_limit
+from utils.rate_limit import FairScheduler
+
+def test_waiting_calls_are_served_round_robin(monkeypatch):
+    granted = []
+
+    class RecordedWaiter(rate_limit._Waiter):
+        # tokens doubles as the call's label; only the requests budget is on
+        def __init__(self, tokens):
+            super().__init__(tokens)
+            grant = self.granted.set
+            self.granted.set = lambda: (granted.append(tokens), grant())
+
+    monkeypatch.setattr(rate_limit, '_Waiter', RecordedWaiter)
+    scheduler = FairScheduler(requests_per_minute=600)
+    scheduler.pause(0.5)
+
+    calls = [(('a', 'p1'), 1), (('a', 'p1'), 2), (('a', 'p1'), 3), (('a', 'p2'), 11),
+             (('b', 'p3'), 101), (('b', 'p3'), 102)]
+    threads = []
+    for queued, (tenant, label) in enumerate(calls, 1):
+        thread = threading.Thread(target=scheduler.acquire, args=(tenant, label))
+        thread.start()
+        threads.append(thread)
+        while scheduler.status()['queued_calls'] < queued:
+            time.sleep(0.001)
+    status = scheduler.status('b')
+    assert (status['queued_calls'], status['queued_calls_for_user'], status['waiting_users']) == (6, 2, 2)
+    assert status['estimated_wait_seconds'] > 0
+    for thread in threads:
+        thread.join(5)
+
+    # User a's big project does not go first: users alternate, and a's
+    # projects take turns within a's share
+    assert granted == [1, 101, 11, 102, 2, 3]
+
+def test_calls_wait_for_tokens_and_settle_the_difference():
+    scheduler = FairScheduler(tokens_per_minute=600)
+
+    first = scheduler.acquire(('a', 'p1'), 600)
+    assert first.waited < 0.05
+    # Only half the estimate was used, so the rest is available again
+    first.settle(300)
+    assert scheduler.acquire(('a', 'p1'), 300).waited < 0.05
+
+    # The bucket is empty and refills at 10 tokens a second
+    assert 0.3 < scheduler.acquire(('b', 'p2'), 5).waited < 2
+
+def test_no_budget_never_waits():
+    scheduler = FairScheduler()
+    assert not scheduler.enabled
+    assert all(scheduler.acquire(('a', 'p1'), 10 ** 9).waited == 0 for _ in range(100))
+
+def test_stream_closed_early_settles_its_reservation(llm, monkeypatch):
+    scheduler = FairScheduler(tokens_per_minute=10 ** 6)
+    monkeypatch.setattr(gpt4_processor, 'scheduler', scheduler)
+    usage = gpt4_processor.TokenUsage()
+
+    pieces = gpt4_processor.stream_narrative('Write the brief.', usage=usage)
+    received = next(pieces) + next(pieces)
+    pieces.close()
+
+    # Only the prompt and the two pieces read are held, not the whole estimate
+    used = 10 ** 6 - scheduler._tokens.level
+    assert used < gpt4_processor.NARRATIVE_OUTPUT_TOKENS / 2
+    stage = usage.to_dict()['stages']['narrative']
+    assert stage['calls'] == 1
+    assert stage['completion_tokens'] == gpt4_processor.count_tokens(received, gpt4_processor.NARRATIVE_MODEL)
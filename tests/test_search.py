@@ -0,0 +1,36 @@
+from models import db, Document
+
+def search(client, query, **params):
+    return client.get('/api/search', query_string={'q': query, **params})
+
+def test_pages_are_found_with_highlighted_snippets(client, project):
+    response = search(client, 'speech therapy')
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [(hit['project_id'], hit['filename'], hit['page_number']) for hit in results] == \
+        [(project, 'exhibit.pdf', 2)]
+    assert '<mark>speech</mark>' in results[0]['snippet']
+
+    # Stemming: "evaluated" matches "evaluation"
+    assert [hit['page_number'] for hit in search(client, 'evaluated').get_json()['results']] == [1]
+
+def test_phrases_must_match_in_order(client, project):
+    assert search(client, '"weekly speech"').get_json()['results']
+    assert search(client, '"speech weekly"').get_json()['results'] == []
+
+def test_documents_being_extracted_are_not_searched(app, client, project):
+    with app.app_context():
+        Document.query.filter_by(project_id=project, filename='exhibit.pdf').update({'extraction_status': 'running'})
+        db.session.commit()
+    assert search(client, 'speech').get_json()['results'] == []
+    assert search(client, 'speech', project_id=project).get_json()['results'] == []
+
+def test_other_users_pages_are_not_searched(login, project):
+    assert search(login(), 'speech').get_json()['results'] == []
+
+def test_query_syntax_is_read_as_words(client, project):
+    # FTS5 operators and stray quotes are searched for, not parsed
+    response = search(client, 'therapy OR NEAR( "<b>')
+    assert response.status_code == 200
+    assert response.get_json()['results'] == []
+    assert search(client, '   ').status_code == 400
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from utils.storage import LocalStorageBackend, S3StorageBackend, StorageBackend, release_content
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalStorageBackend(root=str(tmp_path / 'storage'))
+
+def test_local_round_trip_keeps_the_storage_layout(local, tmp_path):
+    key = 'user_3/project_7/exhibit.pdf'
+    local.upload_file(key, write(tmp_path, 'upload', b'%PDF-1.4 exhibit'))
+
+    assert os.path.exists(tmp_path / 'storage' / '3' / '7' / 'exhibit.pdf')
+    assert local.download(key) == b'%PDF-1.4 exhibit'
+    local.delete(key)
+    assert local.download(key) is None
+    local.delete(key)  # deleting twice is not an error
+
+def test_local_keys_cannot_leave_the_root(local):
+    with pytest.raises(ValueError):
+        local.path_for('user_1/project_1/../../../etc/passwd')
+
+def test_local_mmap_reads_match_the_file(tmp_path):
+    backend = LocalStorageBackend(root=str(tmp_path / 'storage'), use_mmap=True)
+    data = os.urandom(100_000)
+    backend.upload_file('user_1/project_1/big.pdf', write(tmp_path, 'big', data))
+
+    content = backend.download('user_1/project_1/big.pdf')
+    assert bytes(content) == data
+    release_content(content)
+    assert content.closed
+    release_content(b'bytes are left alone')
+    release_content(None)
+
+def test_failed_copy_leaves_no_temp_file(local, tmp_path, monkeypatch):
+    def copy_fails(src, dest):
+        with open(dest, 'wb') as f:
+            f.write(b'partial')
+        raise OSError('disk full')
+    monkeypatch.setattr('utils.storage.shutil.copyfile', copy_fails)
+
+    with pytest.raises(OSError):
+        local.upload_file('user_1/project_1/doc.pdf', write(tmp_path, 'doc', b'%PDF-1.4'))
+
+    assert os.listdir(tmp_path / 'storage' / '1' / '1') == []
+
+def test_backends_must_implement_the_interface():
+    class NoDelete(StorageBackend):
+        def upload_file(self, key, path):
+            pass
+
+        def download(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        NoDelete()
+
+def test_get_many_fetches_every_key_once(local, tmp_path, monkeypatch):
+    keys = [f'user_1/project_2/doc{n}.pdf' for n in range(5)]
+    for n, key in enumerate(keys):
+        local.upload_file(key, write(tmp_path, f'doc{n}', f'document {n}'.encode()))
+    fetched = []
+    download = local.download
+    monkeypatch.setattr(local, 'download', lambda key: fetched.append(key) or download(key))
+
+    contents = local.get_many(keys + keys[:2] + ['user_1/project_2/missing.pdf'])
+
+    assert contents == {**{key: f'document {n}'.encode() for n, key in enumerate(keys)},
+                        'user_1/project_2/missing.pdf': None}
+    assert sorted(fetched) == sorted(contents)
+
+def test_s3_backend_against_a_local_stand_in(tmp_path, monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+    with moto.mock_aws():
+        boto3.client('s3').create_bucket(Bucket='exhibits')
+        backend = S3StorageBackend(bucket='exhibits')
+        keys = [f'user_1/project_1/doc{n}.pdf' for n in range(3)]
+        for n, key in enumerate(keys):
+            backend.upload_file(key, write(tmp_path, f'doc{n}', f'document {n}'.encode()))
+
+        assert backend.download(keys[0]) == b'document 0'
+        assert backend.get_many(keys + ['user_1/project_1/missing.pdf']) == {
+            **{key: f'document {n}'.encode() for n, key in enumerate(keys)},
+            'user_1/project_1/missing.pdf': None,
+        }
+        backend.delete(keys[0])
+        assert backend.download(keys[0]) is None
@@ -0,0 +1,112 @@
+import json
+
+from models import db, Output, ProcessingJob, Project
+from utils import pipeline
+from utils.fake_llm import FakeOpenAIClient
+
+def sse_events(response):
+    """(event, data) pairs of a text/event-stream body, keep-alive comments skipped"""
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+def test_narrative_streams_progress_then_tokens_then_done(app, client, project, llm):
+    response = client.get(f'/api/projects/{project}/narrative/stream')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    events = sse_events(response)
+    kinds = [event for event, _ in events]
+    assert kinds[-1] == 'done'
+    first_token = kinds.index('token')
+    assert set(kinds[:first_token]) == {'progress'}
+    assert set(kinds[first_token:-1]) == {'token'}
+    assert [data['stage'] for _, data in events[:first_token]][-1] == 'narrative'
+
+    narrative = "".join(data for event, data in events if event == 'token')
+    assert narrative.startswith('## Generated Content')
+    assert events[-1][1] == {'length': len(narrative), 'failed': []}
+    with app.app_context():
+        assert Output.query.filter_by(project_id=project).one().narrative_content == narrative
+    assert llm.calls[-1]['stream'] is True
+
+def break_stream_after(llm, monkeypatch, pieces):
+    fake_create = llm.chat.completions.create
+
+    def create(model, messages, stream=False, **kwargs):
+        if not stream:
+            return fake_create(model, messages, **kwargs)
+
+        def broken():
+            yield from list(fake_create(model, messages, stream=True, **kwargs))[:pieces]
+            raise RuntimeError('connection reset')
+        return broken()
+
+    monkeypatch.setattr(llm.chat.completions, 'create', create)
+
+def test_failed_stream_ends_with_an_error_event(client, project, llm, monkeypatch):
+    break_stream_after(llm, monkeypatch, 3)
+    events = sse_events(client.get(f'/api/projects/{project}/narrative/stream'))
+
+    assert [event for event, _ in events if event != 'progress'] == ['token'] * 3 + ['error']
+    assert 'connection reset' in events[-1][1]['message']
+
+def test_stream_is_refused_for_another_users_project(login, project, llm):
+    other = login()
+    assert other.get(f'/api/projects/{project}/narrative/stream').status_code == 403
+    assert not llm.calls
+
+def test_failed_stream_puts_the_previous_version_back(app, client, project, llm, process, monkeypatch):
+    process(project)
+    with app.app_context():
+        before = Output.query.filter_by(project_id=project).one()
+        before = (before.version, before.narrative_content)
+
+    # Save a draft after every piece, then fail
+    monkeypatch.setattr(pipeline, 'STREAM_PERSIST_SECONDS', 0)
+    break_stream_after(llm, monkeypatch, 3)
+    events = sse_events(client.get(f'/api/projects/{project}/narrative/stream'))
+
+    assert events[-1][0] == 'error'
+    with app.app_context():
+        output = Output.query.filter_by(project_id=project).one()
+        assert (output.version, output.narrative_content) == before
+        job = ProcessingJob.query.filter_by(project_id=project, job_type='stream').one()
+        assert job.status == 'failed' and 'connection reset' in job.error
+
+def test_failed_first_stream_leaves_no_output(app, client, project, llm, monkeypatch):
+    monkeypatch.setattr(pipeline, 'STREAM_PERSIST_SECONDS', 0)
+    break_stream_after(llm, monkeypatch, 3)
+    sse_events(client.get(f'/api/projects/{project}/narrative/stream'))
+
+    with app.app_context():
+        assert Output.query.filter_by(project_id=project).first() is None
+
+def test_stream_and_processing_share_one_lock(app, client, project, llm):
+    with app.app_context():
+        job = ProcessingJob(project_id=project, user_id=db.session.get(Project, project).user_id,
+                            job_type='stream', status='running')
+        db.session.add(job)
+        db.session.commit()
+        stream_id = job.id
+
+    # A second stream is refused, and processing reports the stream instead of queueing a run
+    assert client.get(f'/api/projects/{project}/narrative/stream').status_code == 409
+    response = client.post(f'/api/projects/{project}/process')
+    assert response.status_code == 202
+    assert response.get_json()['job']['id'] == stream_id
+
+    with app.app_context():
+        db.session.get(ProcessingJob, stream_id).status = 'succeeded'
+        db.session.commit()
+    events = sse_events(client.get(f'/api/projects/{project}/narrative/stream'))
+    assert events[-1][0] == 'done'
+    with app.app_context():
+        job = ProcessingJob.query.filter_by(job_type='stream').order_by(ProcessingJob.id.desc()).first()
+        assert job.status == 'succeeded'
+        assert job.id != stream_id and job.token_usage
+    # With the stream finished, processing queues again
+    assert client.post(f'/api/projects/{project}/process').get_json()['job']['id'] != stream_id
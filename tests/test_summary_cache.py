@@ -0,0 +1,41 @@
+from models import SummaryCache
+from utils import gpt4_processor, summary_cache
+
+def exhibits(name, count):
+    """(content_hash, text) pairs, as stored for extracted documents"""
+    texts = [f"{name} exhibit {n}: services were reviewed at the annual meeting." for n in range(count)]
+    return [(summary_cache.content_hash(text.encode('utf-8')), text) for text in texts]
+
+def test_unchanged_exhibits_are_summarized_once(app, llm):
+    documents = exhibits('unchanged', 2)
+    with app.app_context():
+        first = gpt4_processor.summarize_documents(documents)
+        assert len(llm.calls) == 2
+
+        # Adding one exhibit sends only that one to the API
+        documents += exhibits('added', 1)
+        before = summary_cache.cache_stats()
+        second = gpt4_processor.summarize_documents(documents)
+        after = summary_cache.cache_stats()
+
+    assert len(llm.calls) == 3
+    assert second[:2] == first
+    assert after['hits'] - before['hits'] == 2
+    assert after['misses'] - before['misses'] == 1
+
+def test_prompt_version_change_misses_the_cache(app, llm, monkeypatch):
+    documents = exhibits('versioned', 1)
+    with app.app_context():
+        gpt4_processor.summarize_documents(documents)
+        monkeypatch.setattr(gpt4_processor, 'SUMMARY_PROMPT_VERSION', 'next')
+        gpt4_processor.summarize_documents(documents)
+
+        assert len(llm.calls) == 2
+        assert SummaryCache.query.filter_by(content_hash=documents[0][0]).count() == 2
+
+def test_failed_summaries_are_not_cached(app, llm, monkeypatch):
+    documents = exhibits('failing', 1)
+    monkeypatch.setattr(gpt4_processor, '_chat_completion', lambda prompt, model=None: 1 / 0)
+    with app.app_context():
+        assert gpt4_processor.summarize_documents(documents) == [gpt4_processor.SUMMARY_ERROR]
+        assert SummaryCache.query.filter_by(content_hash=documents[0][0]).count() == 0
@@ -0,0 +1,162 @@
+import hashlib
+import io
+
+import pytest
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.datastructures import FileStorage
+
+from models import db, Document, Project
+from benchmarks.cases import make_pdf
+from utils import uploads
+from utils.storage import get_from_storage, generate_storage_key
+
+class NoRehash:
+    def write(self, data):
+        raise AssertionError('complete_upload reread the part file')
+
+class BrokenStream(io.BytesIO):
+    def read(self, *args):
+        raise OSError('connection reset')
+
+@pytest.fixture(autouse=True)
+def upload_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(uploads, 'UPLOAD_TMP_DIR', str(tmp_path))
+
+@pytest.mark.parametrize('state_lost', [False, True])
+def test_resumable_upload_hashes_chunks_as_they_arrive(app, project, monkeypatch, state_lost):
+    if not state_lost:
+        monkeypatch.setattr(uploads, '_NullWriter', NoRehash)
+    data = make_pdf([[f"Line {n}" for n in range(40)]] * 3)
+    chunks = [data[start:start + 1000] for start in range(0, len(data), 1000)]
+
+    with app.app_context():
+        user_id = db.session.get(Project, project).user_id
+        upload = uploads.start_upload(user_id, project, 'exhibit.pdf', 'supporting', len(data))
+        offset = 0
+        for number, chunk in enumerate(chunks):
+            if state_lost and number == 1:
+                uploads._running_hashes.clear()  # as if another worker took the rest
+            uploads.append_chunk(upload, offset, io.BytesIO(chunk))
+            offset += len(chunk)
+        content_hash = uploads.complete_upload(upload)
+
+    assert content_hash == hashlib.sha256(data).hexdigest()
+    assert get_from_storage(generate_storage_key(user_id, project, 'exhibit.pdf')) == data
+
+def test_chunk_at_the_wrong_offset_is_refused(app, project):
+    with app.app_context():
+        user_id = db.session.get(Project, project).user_id
+        upload = uploads.start_upload(user_id, project, 'exhibit.pdf', 'supporting', 10)
+        uploads.append_chunk(upload, 0, io.BytesIO(b'12345'))
+
+        with pytest.raises(uploads.UploadError) as error:
+            uploads.append_chunk(upload, 0, io.BytesIO(b'12345'))
+        assert error.value.status == 409
+        with pytest.raises(uploads.UploadError) as error:
+            uploads.append_chunk(upload, 5, io.BytesIO(b'123456'))
+        assert error.value.status == 413
+
+        uploads.append_chunk(upload, 5, io.BytesIO(b'67890'))
+        assert uploads.complete_upload(upload) == hashlib.sha256(b'1234567890').hexdigest()
+
+def test_spooled_files_are_removed_when_one_file_fails(app, client, tmp_path):
+    project_id = client.post('/api/projects', json={'name': 'Uploads'}).get_json()['project']['id']
+    files = [FileStorage(io.BytesIO(b'%PDF-1.4 first'), 'first.pdf'),
+             FileStorage(BrokenStream(), 'broken.pdf'),
+             FileStorage(io.BytesIO(b'%PDF-1.4 third'), 'third.pdf')]
+
+    with app.app_context():
+        user_id = db.session.get(Project, project_id).user_id
+        with pytest.raises(uploads.BulkUploadError):
+            uploads.ingest_documents(user_id, project_id, files)
+
+        assert list(tmp_path.iterdir()) == []
+        assert Document.query.filter_by(project_id=project_id).count() == 0
+
+def stored_keys(app, user_id, project_id, names):
+    with app.app_context():
+        return [name for name in names if get_from_storage(generate_storage_key(user_id, project_id, name))]
+
+def test_interrupted_bulk_upload_is_undone_and_the_interrupt_passes_through(app, client):
+    project_id = client.post('/api/projects', json={'name': 'Interrupted'}).get_json()['project']['id']
+    files = [FileStorage(io.BytesIO(b'%PDF-1.4 first'), 'first.pdf'),
+             FileStorage(io.BytesIO(b'%PDF-1.4 second'), 'second.pdf')]
+
+    def interrupt(document_ids):
+        raise KeyboardInterrupt
+
+    with app.app_context():
+        user_id = db.session.get(Project, project_id).user_id
+        with pytest.raises(KeyboardInterrupt):
+            uploads.ingest_documents(user_id, project_id, files, before_commit=interrupt)
+        assert Document.query.filter_by(project_id=project_id).count() == 0
+    assert stored_keys(app, user_id, project_id, ['first.pdf', 'second.pdf']) == []
+
+def test_name_taken_by_a_concurrent_upload_is_picked_again(app, client, monkeypatch):
+    project_id = client.post('/api/projects', json={'name': 'Racing'}).get_json()['project']['id']
+    with app.app_context():
+        user_id = db.session.get(Project, project_id).user_id
+        db.session.add(Document(project_id=project_id, filename='exhibit.pdf', file_type='supporting',
+                                content_hash='0' * 64))
+        db.session.commit()
+
+    # The first pick misses the other upload's row, as if it had been
+    # committed just after the names were read
+    free_filename = uploads._free_filename
+    picks = []
+
+    def stale_pick(filename, content_hash, taken):
+        picks.append(filename)
+        return filename if len(picks) == 1 else free_filename(filename, content_hash, taken)
+    monkeypatch.setattr(uploads, '_free_filename', stale_pick)
+
+    data = b'%PDF-1.4 racing'
+    with app.app_context():
+        results, document_ids = uploads.ingest_documents(
+            user_id, project_id, [FileStorage(io.BytesIO(data), 'exhibit.pdf')])
+        names = sorted(name for (name,) in db.session.query(Document.filename).filter_by(project_id=project_id))
+
+    stored_as = f"exhibit-{hashlib.sha256(data).hexdigest()[:8]}.pdf"
+    assert len(picks) == 2 and len(document_ids) == 1
+    assert results[0]['status'] == 'stored' and results[0]['stored_as'] == stored_as
+    assert names == sorted(['exhibit.pdf', stored_as])
+
+def test_reuploaded_outline_replaces_its_document(app, client):
+    project_id = client.post('/api/projects', json={'name': 'Outlines'}).get_json()['project']['id']
+    for text in (b'01/01/2020 - First draft\n', b'01/01/2020 - Second draft\n'):
+        response = client.post(f'/api/projects/{project_id}/upload_outline',
+                               data={'outline': (io.BytesIO(text), 'outline.txt')})
+        assert response.status_code == 200
+
+    with app.app_context():
+        documents = Document.query.filter_by(project_id=project_id).all()
+        assert [document.content_hash for document in documents] == [
+            hashlib.sha256(b'01/01/2020 - Second draft\n').hexdigest()]
+
+def test_only_one_of_two_racing_chunks_is_appended(app, project, tmp_path):
+    with app.app_context():
+        user_id = db.session.get(Project, project).user_id
+        upload = uploads.start_upload(user_id, project, 'exhibit.pdf', 'supporting', 10)
+        uploads.append_chunk(upload, 0, io.BytesIO(b'12345'))
+        # A second request that read the session before the first chunk was appended
+        set_committed_value(upload, 'received', 0)
+
+        with pytest.raises(uploads.UploadError) as error:
+            uploads.append_chunk(upload, 0, io.BytesIO(b'abcde'))
+        assert (error.value.status, str(error.value)) == (409, 'Expected offset 5')
+        assert (tmp_path / f'{upload.id}.part').read_bytes() == b'12345'
+        assert [path.name for path in tmp_path.iterdir()] == [f'{upload.id}.part']
+
+def test_an_upload_is_completed_once(app, project):
+    with app.app_context():
+        user_id = db.session.get(Project, project).user_id
+        upload = uploads.start_upload(user_id, project, 'exhibit.pdf', 'supporting', 5)
+        uploads.append_chunk(upload, 0, io.BytesIO(b'12345'))
+        uploads.complete_upload(upload)
+        db.session.commit()
+
+        # A second request that read the session before the first committed
+        set_committed_value(upload, 'status', 'open')
+        with pytest.raises(uploads.UploadError) as error:
+            uploads.complete_upload(upload)
+        assert error.value.status == 409
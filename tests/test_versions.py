@@ -0,0 +1,60 @@
+from utils import versions
+from utils.pipeline import _save_output
+from utils.versions import make_delta, apply_delta
+
+TIMELINE = "".join(f"0{month}/01/2019 - Event {month}\n" for month in range(1, 10))
+
+def narrative(version):
+    """A long narrative whose paragraph `version` changes in each version"""
+    return "".join(f"Paragraph {n}: {'revised in v%d' % version if n == version else 'unchanged'}.\n\n"
+                   for n in range(1, 40))
+
+def save_versions(app, project_id, count):
+    with app.app_context():
+        for version in range(1, count + 1):
+            _save_output(project_id, TIMELINE, narrative(version))
+
+def test_delta_round_trip():
+    base, text = narrative(1), narrative(2)
+    ops = make_delta(base, text)
+    assert apply_delta(base, ops) == text
+    assert sum(len(op) for op in ops if isinstance(op, str)) < len(text) // 10
+
+def test_every_version_is_kept_and_rebuilt(app, client, project, monkeypatch):
+    monkeypatch.setattr(versions, 'OUTPUT_SNAPSHOT_INTERVAL', 4)
+    save_versions(app, project, 9)
+
+    listed = client.get(f'/api/projects/{project}/versions').get_json()
+    assert listed['latest'] == 9
+    stored_as = {entry['version']: entry['stored_as'] for entry in listed['versions']}
+    assert [version for version, kind in sorted(stored_as.items()) if kind == 'snapshot'] == [1, 4, 8]
+    snapshot_size = max(entry['size_bytes'] for entry in listed['versions'] if entry['stored_as'] == 'snapshot')
+    assert all(entry['size_bytes'] < snapshot_size / 2
+               for entry in listed['versions'] if entry['stored_as'] == 'delta')
+
+    for version in range(1, 10):
+        body = client.get(f'/api/projects/{project}/versions/{version}').get_json()
+        assert (body['timeline_content'], body['narrative_content']) == (TIMELINE, narrative(version))
+
+    diff = client.get(f'/api/projects/{project}/versions/diff?from=2&to=3').get_json()
+    assert (diff['added_lines'], diff['removed_lines']) == (2, 2)
+    assert '+Paragraph 3: revised in v3.' in diff['diff']
+
+def test_drafts_are_not_versions(app, client, project):
+    save_versions(app, project, 2)
+    with app.app_context():
+        _save_output(project, TIMELINE, 'Paragraph 1: half writ', partial=True)
+
+    assert client.get(f'/api/projects/{project}/versions').get_json()['latest'] == 2
+    assert client.get(f'/api/projects/{project}/versions/2').get_json()['narrative_content'] == narrative(2)
+    assert client.get(f'/api/projects/{project}/narrative').get_json()['narrative_content'] == \
+        'Paragraph 1: half writ'
+
+def test_restore_saves_an_old_version_as_the_newest(app, client, project, llm):
+    save_versions(app, project, 3)
+
+    response = client.post(f'/api/projects/{project}/versions/1/restore')
+    assert response.get_json() == {'success': True, 'restored': 1, 'version': 4}
+    assert client.get(f'/api/projects/{project}/narrative').get_json()['narrative_content'] == narrative(1)
+    assert client.post(f'/api/projects/{project}/versions/7/restore').status_code == 404
+    assert llm.calls == []
@@ -0,0 +1,56 @@
+"""Async SQLAlchemy sessions for the ASGI server (asgi.py).
+
+The same models and database as the Flask app, reached through an async
+driver, so a request waiting on the database yields the event loop instead
+of holding a thread: postgresql:// becomes postgresql+asyncpg:// and
+sqlite:/// becomes sqlite+aiosqlite:///. The drivers come with the optional
+"asgi" dependencies.
+"""
+import os
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+ASYNC_DB_POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', '20'))
+ASYNC_DB_MAX_OVERFLOW = int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', '20'))
+
+_engine = None
+_sessionmaker = None
+
+def async_database_url(url):
+    """DATABASE_URL with its driver swapped for the async one"""
+    scheme, rest = url.split('://', 1)
+    if scheme not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for database URL scheme {scheme}")
+    url = f"{ASYNC_DRIVERS[scheme]}://{rest}"
+    parts = urlsplit(url)
+    if parts.scheme == 'postgresql+asyncpg' and parts.query:
+        # asyncpg spells libpq's sslmode as ssl
+        query = [('ssl', value) if key == 'sslmode' else (key, value) for key, value in parse_qsl(parts.query)]
+        url = urlunsplit(parts._replace(query=urlencode(query)))
+    return url
+
+def init_async_db(database_url):
+    global _engine, _sessionmaker
+    url = async_database_url(database_url)
+    options = {'pool_pre_ping': True}
+    if not url.startswith('sqlite'):
+        options.update(pool_size=ASYNC_DB_POOL_SIZE, max_overflow=ASYNC_DB_MAX_OVERFLOW)
+    _engine = create_async_engine(url, **options)
+    _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+    return _engine
+
+def async_session():
+    """A new AsyncSession; use as `async with async_session() as session:`"""
+    if _sessionmaker is None:
+        raise RuntimeError("Async database is not initialized; call init_async_db() first")
+    return _sessionmaker()
+
+async def dispose_async_db():
+    if _engine is not None:
+        await _engine.dispose()
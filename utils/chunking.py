@@ -0,0 +1,86 @@
+"""Token counting and token-bounded chunking of extracted document text.
+
+Text is split on the coarsest boundary that keeps each chunk under budget:
+pages (form feeds, as written by get_document_text), then paragraphs, then
+lines, then words.
+"""
+import re
+
+try:
+    import tiktoken
+except ImportError:  # fall back to a character-based estimate
+    tiktoken = None
+
+_encodings = {}
+
+PAGE_BREAK = "\f"
+_SPLITTERS = [
+    (re.compile(r"\f"), "\n"),
+    (re.compile(r"\n\s*\n"), "\n\n"),
+    (re.compile(r"\n"), "\n"),
+    (re.compile(r" +"), " "),
+]
+
+def _encoding(model):
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+def count_tokens(text, model="gpt-4"):
+    if not text:
+        return 0
+    if tiktoken is None:
+        # Roughly four characters per token for English prose
+        return len(text) // 4 + 1
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, max_tokens, model="gpt-4"):
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    if tiktoken is None:
+        return text[:max_tokens * 4]
+    encoding = _encoding(model)
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def _split(text, max_tokens, model, level):
+    if count_tokens(text, model) <= max_tokens:
+        return [text]
+    if level >= len(_SPLITTERS):
+        return [truncate_to_tokens(text, max_tokens, model)]
+
+    pattern, joiner = _SPLITTERS[level]
+    chunks = []
+    current = []
+    current_tokens = 0
+    joiner_tokens = count_tokens(joiner, model)
+    for part in pattern.split(text):
+        if not part.strip():
+            continue
+        part_tokens = count_tokens(part, model)
+        if part_tokens > max_tokens:
+            # Too big on its own: flush and split it on a finer boundary
+            if current:
+                chunks.append(joiner.join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split(part, max_tokens, model, level + 1))
+            continue
+        if current and current_tokens + joiner_tokens + part_tokens > max_tokens:
+            chunks.append(joiner.join(current))
+            current, current_tokens = [], 0
+        current.append(part)
+        current_tokens += part_tokens + (joiner_tokens if len(current) > 1 else 0)
+    if current:
+        chunks.append(joiner.join(current))
+    return chunks
+
+def chunk_text(text, max_tokens, model="gpt-4"):
+    """Split text into chunks of at most max_tokens, preferring page and paragraph boundaries"""
+    text = text.strip()
+    if not text:
+        return []
+    if count_tokens(text, model) <= max_tokens:
+        return [text.replace(PAGE_BREAK, "\n")]
+    return [chunk.strip() for chunk in _split(text, max_tokens, model, 0) if chunk.strip()]
@@ -0,0 +1,114 @@
+"""Text extraction for uploaded documents.
+
+Supporting PDFs are parsed once, in the background after upload, and their
+per-page text is stored in document_pages so processing runs never have to
+parse them again. Pages are written as the parser yields them, so a long
+document is never held in memory whole; pages without a text layer are then
+read with OCR (utils/ocr.py).
+"""
+import os
+import logging
+from sqlalchemy.exc import IntegrityError
+from models import db, Document, DocumentPage
+from utils import metrics
+from utils.file_handler import get_file_content
+from utils.storage import release_content
+from utils.pdf_processor import iter_pdf_pages
+from utils.ocr import read_missing_pages
+from utils.summary_cache import content_hash
+from utils.chunking import PAGE_BREAK
+
+logger = logging.getLogger(__name__)
+
+# Pages written per transaction; each commit is short, so the write lock (a
+# database-wide one on SQLite) is never held for a whole parse
+EXTRACT_COMMIT_PAGES = int(os.environ.get('EXTRACT_COMMIT_PAGES', '64'))
+
+def extract_document(document, user_id, pdf_content=None, usage=None, take_over=False):
+    """Download (unless pdf_content is given), parse and persist the pages of a document.
+
+    Returns True once the document has stored text (including when another
+    worker got there first), False if it could not be extracted or another
+    worker is extracting it now. take_over is for the document's own extract
+    job: it extracts even if an earlier, interrupted attempt left the
+    document running. Download and parse times are recorded on usage (a
+    TokenUsage), if given.
+    """
+    if document.extraction_status == 'done':
+        return True
+
+    # Claim the document in one conditional UPDATE so two workers never
+    # write its pages at the same time
+    claimable = ('pending', 'failed', 'running') if take_over else ('pending', 'failed')
+    claimed = Document.query.filter(
+        Document.id == document.id,
+        Document.extraction_status.in_(claimable)
+    ).update({'extraction_status': 'running', 'extraction_error': None}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return document.extraction_status == 'done'
+
+    downloaded = None
+    try:
+        if pdf_content is None:
+            with metrics.stage('storage_fetch', usage) as timer:
+                pdf_content = downloaded = get_file_content(user_id, document.project_id, document.filename)
+                timer.add(files=1, bytes=len(pdf_content or b''))
+        if not pdf_content:
+            raise ValueError('Could not read document from storage')
+
+        DocumentPage.query.filter_by(document_id=document.id).delete()
+        missing = []
+        page_count = 0
+        with metrics.stage('extract', usage) as timer:
+            for page_count, text in enumerate(iter_pdf_pages(pdf_content), 1):
+                db.session.add(DocumentPage(document_id=document.id, page_number=page_count, text=text))
+                if not text.strip():
+                    missing.append(page_count - 1)
+                if page_count % EXTRACT_COMMIT_PAGES == 0:
+                    db.session.commit()
+            db.session.commit()
+            timer.add(documents=1, pages=page_count, bytes=len(pdf_content))
+
+        # Scanned pages come back empty; read only those with OCR
+        ocr_text = read_missing_pages(pdf_content, missing, usage)
+        if ocr_text:
+            pages = DocumentPage.query.filter(
+                DocumentPage.document_id == document.id,
+                DocumentPage.page_number.in_([index + 1 for index in ocr_text])
+            )
+            for page in pages:
+                page.text = ocr_text[page.page_number - 1]
+        pdf_hash = content_hash(pdf_content)
+    except IntegrityError:
+        # A concurrent extraction of the same document is writing its pages;
+        # leave the document to it
+        db.session.rollback()
+        db.session.refresh(document)
+        return document.extraction_status == 'done'
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error extracting document {document.id}: {str(e)}")
+        DocumentPage.query.filter_by(document_id=document.id).delete()
+        document.extraction_status = 'failed'
+        document.extraction_error = str(e)
+        db.session.commit()
+        return False
+    finally:
+        release_content(downloaded)
+
+    document.content_hash = pdf_hash
+    document.page_count = page_count
+    document.text_pages = page_count - len(missing)
+    document.ocr_pages = len(ocr_text)
+    document.failed_pages = len(missing) - len(ocr_text)
+    document.extraction_status = 'done'
+    db.session.commit()
+
+    logger.info(f"Extracted {page_count} pages from document {document.id} "
+                f"({document.ocr_pages} by OCR, {document.failed_pages} without text)")
+    return True
+
+def get_document_text(document):
+    """Stored text of an extracted document, pages joined in order by form feeds"""
+    return PAGE_BREAK.join(page.text for page in document.pages)
@@ -0,0 +1,157 @@
+"""Local stand-in for the OpenAI client, used in tests and offline runs.
+
+Set LLM_BACKEND=fake to make utils.gpt4_processor use it instead of the real API;
+FAKE_LLM_LATENCY, FAKE_LLM_TOKENS_PER_SECOND and FAKE_LLM_OUTPUT_TOKENS then
+set its simulated speed and answer length.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from types import SimpleNamespace
+from utils.retrieval import hashed_embedding
+
+class FakeChatCompletions:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model, messages, stream=False, **kwargs):
+        content, usage = self._answer(model, messages, stream, kwargs)
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+
+        if stream:
+            return self._stream(content, usage, kwargs.get('stream_options') or {})
+
+        if self.owner.tokens_per_second:
+            time.sleep(usage.completion_tokens / self.owner.tokens_per_second)
+        return _completion(content, usage)
+
+    def _answer(self, model, messages, stream, kwargs):
+        self.owner.calls.append({'model': model, 'messages': messages, 'stream': stream, 'kwargs': kwargs})
+        if self.owner.error is not None:
+            raise self.owner.error
+        prompt = "\n".join(m.get('content', '') for m in messages)
+        content = self.owner.reply(prompt) if self.owner.reply else None
+        if content is None:
+            digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:12]
+            content = f"## Generated Content\n\n- Fake {model} response ({digest}) for a {len(prompt)} character prompt\n"
+            content += self.owner.filler(prompt, kwargs.get('max_tokens'))
+        usage = SimpleNamespace(
+            prompt_tokens=len(prompt) // 4,
+            completion_tokens=len(content) // 4,
+            total_tokens=len(prompt) // 4 + len(content) // 4
+        )
+        return content, usage
+
+    def _piece_delay(self, piece):
+        if self.owner.token_delay:
+            return self.owner.token_delay
+        if self.owner.tokens_per_second:
+            return max(len(piece) // 4, 1) / self.owner.tokens_per_second
+        return 0
+
+    def _stream(self, content, usage, stream_options):
+        # Emit word-sized deltas like the real API does
+        for piece in _PIECE.findall(content):
+            delay = self._piece_delay(piece)
+            if delay:
+                time.sleep(delay)
+            yield _delta(piece)
+        if stream_options.get('include_usage'):
+            yield SimpleNamespace(choices=[], usage=usage)
+
+class FakeAsyncChatCompletions(FakeChatCompletions):
+    """The same answers as FakeChatCompletions, waited for with asyncio.sleep"""
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        content, usage = self._answer(model, messages, stream, kwargs)
+        if self.owner.latency:
+            await asyncio.sleep(self.owner.latency)
+
+        if stream:
+            return self._astream(content, usage, kwargs.get('stream_options') or {})
+
+        if self.owner.tokens_per_second:
+            await asyncio.sleep(usage.completion_tokens / self.owner.tokens_per_second)
+        return _completion(content, usage)
+
+    async def _astream(self, content, usage, stream_options):
+        for piece in _PIECE.findall(content):
+            delay = self._piece_delay(piece)
+            if delay:
+                await asyncio.sleep(delay)
+            yield _delta(piece)
+        if stream_options.get('include_usage'):
+            yield SimpleNamespace(choices=[], usage=usage)
+
+_PIECE = re.compile(r"\S+\s*|\s+")
+
+def _completion(content, usage):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(role='assistant', content=content))],
+        usage=usage
+    )
+
+def _delta(piece):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content=piece))],
+        usage=None
+    )
+
+class FakeEmbeddings:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model, input, dimensions=256, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.owner.calls.append({'model': model, 'input': texts, 'kwargs': kwargs})
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+        tokens = sum(len(text) // 4 for text in texts)
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=hashed_embedding(text, dimensions)) for i, text in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=tokens, total_tokens=tokens)
+        )
+
+class FakeOpenAIClient:
+    """Mimics the parts of openai.OpenAI the app uses, with deterministic output.
+
+    latency is slept once per call, as time to first token. After that the
+    answer takes completion tokens / tokens_per_second (if set), or
+    token_delay per streamed delta. output_tokens pads each answer to about
+    that many tokens (capped by max_tokens) so prompts built from answers
+    grow like real ones. error, if set, is raised by every chat completion,
+    as a failing API would; reply, if set, is called with each prompt and
+    the answer is whatever it returns other than None.
+    """
+
+    def __init__(self, latency=0.0, token_delay=0.0, tokens_per_second=0.0, output_tokens=0, error=None,
+                 reply=None):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error = error
+        self.reply = reply
+        self.calls = []
+        self.chat = SimpleNamespace(completions=FakeChatCompletions(self))
+        self.embeddings = FakeEmbeddings(self)
+
+    def filler(self, prompt, max_tokens=None):
+        tokens = min(self.output_tokens, max_tokens or self.output_tokens)
+        if tokens <= 0:
+            return ""
+        # Reuse words from the prompt so the answer looks like a summary of it
+        words = re.findall(r"[A-Za-z0-9.,]+", prompt) or ["event"]
+        lines = []
+        for start in range(0, tokens * 3 // 4, 12):
+            lines.append("- " + " ".join(words[(start + i) % len(words)] for i in range(12)))
+        return "\n".join(lines) + "\n"
+
+class FakeAsyncOpenAIClient(FakeOpenAIClient):
+    """Mimics openai.AsyncOpenAI's chat completions; see FakeOpenAIClient"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat = SimpleNamespace(completions=FakeAsyncChatCompletions(self))
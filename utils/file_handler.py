@@ -1,24 +1,36 @@
-from utils.storage import save_to_storage, get_from_storage, generate_storage_key
+from utils.storage import save_to_storage, get_from_storage, get_many_from_storage, generate_storage_key
+from utils.timeline import build_events, render_markdown
 import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 def save_uploaded_file(file, filename, user_id, project_id):
-    """Save uploaded file to Replit Object Storage"""
+    """Stream an uploaded file to the configured storage backend; returns its sha256 or None"""
     storage_key = generate_storage_key(user_id, project_id, filename)
     return save_to_storage(file, storage_key)
 
 def get_file_content(user_id, project_id, filename):
-    """Get file content from Replit Object Storage"""
+    """File content from the configured storage backend, or None; pass it to
+    release_content() once done with it"""
     storage_key = generate_storage_key(user_id, project_id, filename)
     return get_from_storage(storage_key)
 
-def process_outline(outline_content):
+def get_many_file_contents(user_id, project_id, filenames):
+    """Fetch several files of a project concurrently; returns {filename: bytes or None}"""
+    keys = {filename: generate_storage_key(user_id, project_id, filename) for filename in filenames}
+    contents = get_many_from_storage(keys.values())
+    return {filename: contents.get(key) for filename, key in keys.items()}
+
+def outline_events(outline_content, filenames=(), summaries=None):
+    """Timeline events of an outline plus the given exhibits; None if unreadable"""
     try:
-        timeline_content = "# Timeline of Events\n\n"
-        content_str = outline_content.decode('utf-8')
-        for line in content_str.splitlines():
-            if line.strip():
-                timeline_content += f"- {line.strip()}\n"
-        return timeline_content
+        return build_events(str(outline_content, 'utf-8'), filenames, summaries)
     except Exception as e:
-        print(f"Error processing outline: {e}")
+        logger.error(f"Error processing outline: {e}")
         return None
+
+def process_outline(outline_content, filenames=(), summaries=None):
+    """Chronological markdown timeline of an outline plus the given exhibits"""
+    events = outline_events(outline_content, filenames, summaries)
+    return render_markdown(events) if events is not None else None
@@ -1,14 +1,304 @@
 import os
-from openai import OpenAI
+import asyncio
+import random
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils import summary_cache, retrieval, metrics
+from utils.rate_limit import scheduler
+from utils.chunking import chunk_text, count_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# 'openai' (the real API) or 'fake' (utils/fake_llm.py, for tests and offline runs)
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "openai")
 
-def summarize_text(text):
-    if not text.strip():
-        return "No readable text content found in document."
-        
-    prompt = f"""Summarize the following text, extracting key events and dates. Format the output in markdown:
+# Fan-out and retry settings for the per-document summaries
+SUMMARY_CONCURRENCY = int(os.environ.get("SUMMARY_CONCURRENCY", "8"))
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "120"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "5"))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "60"))
+# Completion length assumed when reserving rate limit capacity for a call
+# without max_tokens; the reservation is corrected once the call returns
+LLM_COMPLETION_ESTIMATE = int(os.environ.get("LLM_COMPLETION_ESTIMATE", "600"))
+
+SUMMARY_MODEL = "gpt-4"
+NARRATIVE_MODEL = "gpt-4"
+# Bump whenever the summary prompt changes so cached summaries are not reused
+SUMMARY_PROMPT_VERSION = "2"
+# Likewise for the narrative prompt, so unchanged projects are not regenerated
+NARRATIVE_PROMPT_VERSION = "1"
+
+# Token budgets. Chunks are sized so a chunk plus the summary prompt and its
+# answer fit the model context; the narrative prompt is trimmed to fit
+# NARRATIVE_CONTEXT_TOKENS minus the room reserved for the answer.
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("SUMMARY_CHUNK_TOKENS", "5000"))
+NARRATIVE_CONTEXT_TOKENS = int(os.environ.get("NARRATIVE_CONTEXT_TOKENS", "8192"))
+NARRATIVE_OUTPUT_TOKENS = int(os.environ.get("NARRATIVE_OUTPUT_TOKENS", "2000"))
+SUMMARY_ERROR = "Error in summarization"
+NO_TEXT_SUMMARY = "No readable text content found in document."
+
+# How the narrative prompt gets its evidence: 'summaries' summarizes every
+# document and fits all the summaries in; 'retrieval' puts the passages best
+# matching each timeline entry in a fixed-size prompt (utils/retrieval.py).
+# Retrieval is opt-in: it embeds every document, through the API unless
+# EMBEDDING_BACKEND=local
+NARRATIVE_CONTEXT_MODE = os.environ.get("NARRATIVE_CONTEXT_MODE", "summaries")
+# 'api' embeds with EMBEDDING_MODEL through the completion client; 'local'
+# uses the hashed stand-in in utils/retrieval.py and makes no calls
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "api")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", "256"))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "256"))
+
+def embedding_model():
+    """Name of the model vectors come from, as recorded in caches and fingerprints"""
+    return "local" if EMBEDDING_BACKEND == "local" else EMBEDDING_MODEL
+
+# The openai package takes longer to import than the rest of the app put
+# together, so it is only loaded when a real client is first needed
+_retryable_errors = None
+
+def retryable_errors():
+    """Transient API errors worth retrying"""
+    global _retryable_errors
+    if _retryable_errors is None:
+        import openai
+        _retryable_errors = (
+            openai.RateLimitError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        )
+    return _retryable_errors
+
+openai_client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    """The configured completion client, created on first use and shared afterwards"""
+    global openai_client
+    if openai_client is None:
+        with _client_lock:
+            if openai_client is None:
+                if LLM_BACKEND == "fake":
+                    from utils.fake_llm import FakeOpenAIClient
+                    openai_client = FakeOpenAIClient(
+                        latency=float(os.environ.get("FAKE_LLM_LATENCY", "0")),
+                        tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", "0")),
+                        output_tokens=int(os.environ.get("FAKE_LLM_OUTPUT_TOKENS", "0"))
+                    )
+                else:
+                    from openai import OpenAI
+                    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    return openai_client
+
+def set_openai_client(client):
+    """Swap the client used for all completions (e.g. a FakeOpenAIClient in tests)"""
+    global openai_client
+    openai_client = client
+
+async_openai_client = None
+
+def get_async_openai_client():
+    """The asyncio counterpart of get_openai_client, for the ASGI server's
+    streaming calls; created on first use from the event loop's thread"""
+    global async_openai_client
+    if async_openai_client is None:
+        if LLM_BACKEND == "fake":
+            from utils.fake_llm import FakeAsyncOpenAIClient
+            async_openai_client = FakeAsyncOpenAIClient(
+                latency=float(os.environ.get("FAKE_LLM_LATENCY", "0")),
+                tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", "0")),
+                output_tokens=int(os.environ.get("FAKE_LLM_OUTPUT_TOKENS", "0"))
+            )
+        else:
+            from openai import AsyncOpenAI
+            async_openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    return async_openai_client
+
+def set_async_openai_client(client):
+    global async_openai_client
+    async_openai_client = client
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before the next attempt, honouring Retry-After when sent"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX)
+        except ValueError:
+            pass
+    delay = min(LLM_BACKOFF_BASE * (2 ** attempt), LLM_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+class TokenUsage:
+    """Thread-safe per-stage tally of calls, tokens and latency for one run.
+
+    stages holds the LLM calls; timings the other timed stages (storage
+    fetch, extraction, whole-document summaries) recorded by metrics.stage().
+    tenant, a (user_id, project_id) pair, is who the run's LLM calls are
+    scheduled for (see utils/rate_limit.py).
+    """
+
+    def __init__(self, tenant=None):
+        self.tenant = tenant
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.timings = {}
+        self.counters = {}
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record(self, stage, prompt_tokens, completion_tokens, seconds, retries=0):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {
+                'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'seconds': 0.0, 'retries': 0
+            })
+            entry['calls'] += 1
+            entry['prompt_tokens'] += prompt_tokens
+            entry['completion_tokens'] += completion_tokens
+            entry['seconds'] = round(entry['seconds'] + seconds, 3)
+            entry['retries'] += retries
+
+    def record_stage(self, stage, seconds, **amounts):
+        with self._lock:
+            entry = self.timings.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] = round(entry['seconds'] + seconds, 3)
+            entry['max_seconds'] = round(max(entry['max_seconds'], seconds), 3)
+            for field, amount in amounts.items():
+                entry[field] = entry.get(field, 0) + amount
+
+    def to_dict(self):
+        with self._lock:
+            stages = {stage: dict(entry) for stage, entry in self.stages.items()}
+            timings = {stage: dict(entry) for stage, entry in self.timings.items()}
+            counters = dict(self.counters)
+        return {
+            'stages': stages,
+            'timings': timings,
+            'counters': counters,
+            'prompt_tokens': sum(entry['prompt_tokens'] for entry in stages.values()),
+            'completion_tokens': sum(entry['completion_tokens'] for entry in stages.values())
+        }
+
+def _record_call(usage, stage, model, prompt, content, reported, seconds, retries):
+    """Tokens and latency of one successful call, to the run's usage and the process metrics"""
+    if usage is None and not metrics.METRICS_ENABLED:
+        return
+    prompt_tokens = getattr(reported, 'prompt_tokens', None) or count_tokens(prompt, model)
+    completion_tokens = getattr(reported, 'completion_tokens', None) or count_tokens(content, model)
+    if usage is not None:
+        usage.record(stage, prompt_tokens, completion_tokens, seconds, retries)
+    metrics.LLM_SECONDS.observe(seconds, stage=stage, model=model)
+    metrics.LLM_TOKENS.inc(prompt_tokens, stage=stage, kind='prompt')
+    metrics.LLM_TOKENS.inc(completion_tokens, stage=stage, kind='completion')
+
+def _reserve(usage, stage, tokens):
+    """Wait for this run's turn and rate limit capacity for one call"""
+    reservation = scheduler.acquire(usage.tenant if usage is not None else None, tokens)
+    _record_wait(usage, stage, reservation)
+    return reservation
+
+async def _reserve_async(usage, stage, tokens):
+    reservation = await scheduler.acquire_async(usage.tenant if usage is not None else None, tokens)
+    _record_wait(usage, stage, reservation)
+    return reservation
+
+def _record_wait(usage, stage, reservation):
+    if reservation.waited >= 0.001:
+        if usage is not None:
+            usage.record_stage('llm_queue', reservation.waited)
+        metrics.LLM_QUEUE_SECONDS.observe(reservation.waited, stage=stage)
+
+def _reported_tokens(reported):
+    if reported is None:
+        return None
+    return (getattr(reported, 'prompt_tokens', 0) or 0) + (getattr(reported, 'completion_tokens', 0) or 0)
+
+def _retry_or_raise(error, attempt, stage, can_retry=True):
+    """Sleep before the next attempt, or re-raise once retries are exhausted"""
+    time.sleep(_next_retry(error, attempt, stage, can_retry))
+
+def _next_retry(error, attempt, stage, can_retry):
+    """Seconds to wait before retrying, or re-raise once retries are exhausted"""
+    if not can_retry or attempt == LLM_MAX_RETRIES:
+        metrics.LLM_FAILURES.inc(stage=stage)
+        raise error
+    delay = _retry_delay(error, attempt)
+    if getattr(error, 'status_code', None) == 429:
+        # Over the API's limit: hold everyone's calls, not just this one
+        scheduler.pause(delay)
+    metrics.LLM_RETRIES.inc(stage=stage)
+    logger.warning(f"Retrying {stage} call in {delay:.1f}s after: {str(error)}")
+    return delay
+
+def _chat_completion(prompt, model="gpt-4", usage=None, stage='completion', max_tokens=None):
+    """Single-prompt chat completion with a timeout and backoff on transient errors"""
+    options = {'max_tokens': max_tokens} if max_tokens else {}
+    estimate = count_tokens(prompt, model) + (max_tokens or LLM_COMPLETION_ESTIMATE)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        reservation = _reserve(usage, stage, estimate)
+        try:
+            started = time.monotonic()
+            response = get_openai_client().chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=LLM_TIMEOUT_SECONDS,
+                **options
+            )
+            content = response.choices[0].message.content
+            reported = getattr(response, 'usage', None)
+            reservation.settle(_reported_tokens(reported))
+            _record_call(usage, stage, model, prompt, content, reported, time.monotonic() - started, attempt)
+            return content
+        except retryable_errors() as e:
+            _retry_or_raise(e, attempt, stage)
+        except Exception:
+            metrics.LLM_FAILURES.inc(stage=stage)
+            raise
+
+def _embedding_request(texts, usage=None, stage='embed'):
+    """One batch of embeddings, retried on transient errors like _chat_completion"""
+    estimate = sum(len(text) // 4 + 1 for text in texts)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        reservation = _reserve(usage, stage, estimate)
+        try:
+            started = time.monotonic()
+            response = get_openai_client().embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=texts,
+                dimensions=EMBEDDING_DIMENSIONS,
+                timeout=LLM_TIMEOUT_SECONDS
+            )
+            reported = getattr(response, 'usage', None)
+            reservation.settle(_reported_tokens(reported))
+            _record_call(usage, stage, EMBEDDING_MODEL, "\n".join(texts), "", reported,
+                         time.monotonic() - started, attempt)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except retryable_errors() as e:
+            _retry_or_raise(e, attempt, stage)
+        except Exception:
+            metrics.LLM_FAILURES.inc(stage=stage)
+            raise
+
+def embed_texts(texts, usage=None, stage='embed'):
+    """Unit-length EMBEDDING_DIMENSIONS vectors for texts, in order"""
+    if EMBEDDING_BACKEND == "local":
+        return [retrieval.hashed_embedding(text, EMBEDDING_DIMENSIONS) for text in texts]
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        vectors.extend(_embedding_request(texts[start:start + EMBEDDING_BATCH_SIZE], usage, stage))
+    return vectors
+
+SUMMARY_PROMPT = """Summarize the following text, extracting key events and dates. Format the output in markdown:
     - Use '##' for main sections
     - Use bullet points for events
     - Use bold text for dates
@@ -16,36 +306,243 @@ def summarize_text(text):
     
     Text to summarize:
     {text}"""
+
+REDUCE_PROMPT = """The following are summaries of consecutive parts of one document. Combine them into a single summary of the whole document, keeping every key event and date and removing repetition. Format the output in markdown:
+    - Use '##' for main sections
+    - Use bullet points for events
+    - Use bold text for dates
+    - Use italics for important names or terms
     
-    try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4",  # Changed from gpt-4o-mini to gpt-4
-            messages=[{"role": "user", "content": prompt}]
+    Partial summaries:
+    {text}"""
+
+# Shared pool for chunk-level calls; document-level fan-out uses its own pool
+# so a document waiting on its chunks can never starve them of workers
+_chunk_executor = None
+_chunk_executor_lock = threading.Lock()
+
+def get_chunk_executor():
+    """The chunk-level pool, created on first use like the client"""
+    global _chunk_executor
+    if _chunk_executor is None:
+        with _chunk_executor_lock:
+            if _chunk_executor is None:
+                _chunk_executor = ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY,
+                                                     thread_name_prefix='summarize-chunk')
+    return _chunk_executor
+
+def _map_chunks(template, chunks, usage, stage):
+    futures = [
+        get_chunk_executor().submit(
+            _chat_completion, template.format(text=chunk), SUMMARY_MODEL, usage, stage
         )
-        summary = response.choices[0].message.content
-        return summary
-    except Exception as e:
-        print(f"Error in GPT-4 API call: {str(e)}")
-        return "Error in summarization"
-
-def generate_narrative(timeline_content, pdf_contents):
-    try:
-        # First, summarize all PDF contents
-        summaries = []
-        for pdf_content in pdf_contents:
-            # Extract text from PDF content
-            from utils.pdf_processor import extract_text_from_pdf
-            text = extract_text_from_pdf(pdf_content)
-            if text.strip():
-                summary = summarize_text(text)
-                summaries.append(summary)
-        
-        # Combine timeline and summaries for narrative generation
-        combined_content = f"Timeline:\n{timeline_content}\n\nSupporting Documents:\n"
-        for i, summary in enumerate(summaries, 1):
-            combined_content += f"\nDocument {i}:\n{summary}\n"
-        
-        prompt = f"""Generate a coherent legal brief narrative based on the following timeline and supporting documents. Format the output in markdown:
+        for chunk in chunks
+    ]
+    return [future.result() for future in futures]
+
+def _settle_partial(reservation, usage, stage, model, prompt, received, started, attempt):
+    """Settle and record a streamed call that ended before the model finished;
+    the API reports usage only at the end, so the tokens are counted here"""
+    content = "".join(received)
+    reservation.settle(count_tokens(prompt, model) + count_tokens(content, model))
+    _record_call(usage, stage, model, prompt, content, None, time.monotonic() - started, attempt)
+
+def _chat_completion_stream(prompt, model="gpt-4", usage=None, stage='completion', max_tokens=None):
+    """Streaming variant of _chat_completion yielding content deltas.
+
+    Transient errors are retried only until the first delta arrives; after
+    that a failure is raised to the caller, who has already seen output.
+    """
+    options = {'max_tokens': max_tokens} if max_tokens else {}
+    estimate = count_tokens(prompt, model) + (max_tokens or LLM_COMPLETION_ESTIMATE)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        reservation = _reserve(usage, stage, estimate)
+        started = time.monotonic()
+        received = []
+        reported = None
+        stream = None
+        finished = False
+        try:
+            stream = get_openai_client().chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=LLM_TIMEOUT_SECONDS,
+                stream=True,
+                stream_options={"include_usage": True},
+                **options
+            )
+            for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    reported = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    received.append(delta)
+                    yield delta
+            finished = True
+            break
+        except retryable_errors() as e:
+            _retry_or_raise(e, attempt, stage, can_retry=not received)
+        except Exception:
+            metrics.LLM_FAILURES.inc(stage=stage)
+            raise
+        finally:
+            if not finished and received:
+                # Closed early by the consumer, or failed part way: stop the
+                # response and settle for the tokens used so far
+                if hasattr(stream, 'close'):
+                    stream.close()
+                _settle_partial(reservation, usage, stage, model, prompt, received, started, attempt)
+
+    reservation.settle(_reported_tokens(reported))
+    _record_call(usage, stage, model, prompt, "".join(received), reported, time.monotonic() - started, attempt)
+
+async def _chat_completion_stream_async(prompt, model="gpt-4", usage=None, stage='completion', max_tokens=None):
+    """_chat_completion_stream on the async client: waiting for the model,
+    the rate limiter and retries never holds a thread"""
+    options = {'max_tokens': max_tokens} if max_tokens else {}
+    estimate = count_tokens(prompt, model) + (max_tokens or LLM_COMPLETION_ESTIMATE)
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        reservation = await _reserve_async(usage, stage, estimate)
+        started = time.monotonic()
+        received = []
+        reported = None
+        stream = None
+        finished = False
+        try:
+            stream = await get_async_openai_client().chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=LLM_TIMEOUT_SECONDS,
+                stream=True,
+                stream_options={"include_usage": True},
+                **options
+            )
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    reported = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    received.append(delta)
+                    yield delta
+            finished = True
+            break
+        except retryable_errors() as e:
+            await asyncio.sleep(_next_retry(e, attempt, stage, can_retry=not received))
+        except Exception:
+            metrics.LLM_FAILURES.inc(stage=stage)
+            raise
+        finally:
+            if not finished and received:
+                # As in _chat_completion_stream; settle first, as closing may
+                # be cut short if the task is being cancelled
+                _settle_partial(reservation, usage, stage, model, prompt, received, started, attempt)
+                close = getattr(stream, 'aclose', None) or getattr(stream, 'close', None)
+                if close:
+                    await close()
+
+    reservation.settle(_reported_tokens(reported))
+    _record_call(usage, stage, model, prompt, "".join(received), reported, time.monotonic() - started, attempt)
+
+def summarize_text(text, usage=None):
+    """Summarize a document of any length.
+
+    Text that fits in one SUMMARY_CHUNK_TOKENS chunk is summarized in a single
+    call. Longer text is split on page/paragraph boundaries, the chunks are
+    summarized in parallel, and the partial summaries are combined
+    hierarchically until a single summary remains.
+    """
+    if not text.strip():
+        return NO_TEXT_SUMMARY
+
+    with metrics.stage('summarize_document', usage) as timer:
+        timer.add(bytes=len(text))
+        try:
+            chunks = chunk_text(text, SUMMARY_CHUNK_TOKENS, SUMMARY_MODEL)
+            timer.add(chunks=len(chunks))
+            if len(chunks) == 1:
+                return _chat_completion(SUMMARY_PROMPT.format(text=chunks[0]), SUMMARY_MODEL, usage, 'summarize')
+
+            summaries = _map_chunks(SUMMARY_PROMPT, chunks, usage, 'summarize_chunk')
+            while len(summaries) > 1:
+                groups = chunk_text("\f".join(summaries), SUMMARY_CHUNK_TOKENS, SUMMARY_MODEL)
+                if len(groups) >= len(summaries):
+                    # Partial summaries too large to pair up; merge them two at a time
+                    groups = ["\n\n".join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+                    groups = [truncate_to_tokens(group, SUMMARY_CHUNK_TOKENS, SUMMARY_MODEL) for group in groups]
+                summaries = _map_chunks(REDUCE_PROMPT, groups, usage, 'summarize_reduce')
+            return summaries[0]
+        except Exception as e:
+            timer.add(errors=1)
+            logger.error(f"Error summarizing document: {str(e)}")
+            return SUMMARY_ERROR
+
+def summarize_documents(documents, progress=None, max_workers=None, usage=None):
+    """Summarize every document concurrently, keeping the input order.
+
+    documents is a list of (content_hash, text) pairs, content_hash being the
+    sha256 of the original PDF. Summaries already in the summary cache are
+    reused and only the remaining documents are sent to the API. Documents
+    without readable text are dropped. progress, if given, is called from the
+    calling thread as progress('summarize', done, total).
+    """
+    documents = [(document_hash, text) for document_hash, text in documents if text.strip()]
+    total = len(documents)
+    if progress:
+        progress('summarize', 0, total)
+    if not documents:
+        return []
+
+    cache_keys = [
+        summary_cache.make_cache_key(document_hash, SUMMARY_PROMPT_VERSION, SUMMARY_MODEL)
+        for document_hash, _ in documents
+    ]
+    cached = summary_cache.get_cached_summaries(cache_keys)
+
+    results = [cached.get(key) for key in cache_keys]
+    pending = [i for i, key in enumerate(cache_keys) if key not in cached]
+    done = total - len(pending)
+    if progress and done:
+        progress('summarize', done, total)
+    if usage is not None:
+        usage.count('summary_cache_hits', done)
+        usage.count('summary_cache_misses', len(pending))
+    metrics.SUMMARY_CACHE.inc(done, result='hit')
+    metrics.SUMMARY_CACHE.inc(len(pending), result='miss')
+
+    if pending:
+        workers = max(1, min(max_workers or SUMMARY_CONCURRENCY, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='summarize') as executor:
+            futures = {
+                executor.submit(summarize_text, documents[i][1], usage): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                summary = future.result()
+                results[i] = summary
+                if summary != SUMMARY_ERROR:
+                    summary_cache.store_summary(
+                        cache_keys[i], documents[i][0], SUMMARY_PROMPT_VERSION, SUMMARY_MODEL, summary
+                    )
+                elif usage is not None:
+                    usage.count('summary_errors')
+                done += 1
+                if progress:
+                    progress('summarize', done, total)
+        summary_cache.evict_summaries()
+
+    return results
+
+CONDENSE_PROMPT = """Condense the following document summary to at most {words} words, keeping the most important events, dates and names. Keep the markdown formatting.
+    
+    Summary:
+    {text}"""
+
+NARRATIVE_PROMPT = """Generate a coherent legal brief narrative based on the following timeline and supporting documents. Format the output in markdown:
         - Use '##' for main sections (Background, Analysis, Conclusion)
         - Use '###' for subsections
         - Use bullet points for key events
@@ -54,16 +551,230 @@ def generate_narrative(timeline_content, pdf_contents):
         - Use blockquotes for direct quotes from documents
         
         Content to process:
-        {combined_content}
+        {content}
         
         Write a clear and professional narrative that incorporates all relevant information chronologically."""
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4",  # Changed from gpt-4o to gpt-4
-            messages=[{"role": "user", "content": prompt}]
+
+def _allocate_budget(sizes, budget):
+    """Water-filling split of budget: items under their fair share keep their
+    size and the slack is shared among the larger ones."""
+    allocation = [0] * len(sizes)
+    remaining = budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending[0]
+        if sizes[i] <= share:
+            allocation[i] = sizes[i]
+            remaining -= sizes[i]
+            pending.pop(0)
+        else:
+            for j in pending:
+                allocation[j] = share
+            break
+    return allocation
+
+def _fit_narrative_content(timeline_content, summaries, usage=None):
+    """Trim the timeline and summaries so the narrative prompt plus its answer
+    fit in NARRATIVE_CONTEXT_TOKENS. Oversized summaries are condensed by the
+    model first and hard-truncated only as a last resort."""
+    budget = (NARRATIVE_CONTEXT_TOKENS - NARRATIVE_OUTPUT_TOKENS
+              - count_tokens(NARRATIVE_PROMPT.format(content=''), NARRATIVE_MODEL))
+    timeline_content = truncate_to_tokens(timeline_content, budget // 2, NARRATIVE_MODEL)
+    # Headers: "Timeline:", "Supporting Documents:" and "Document N:" per summary
+    budget -= count_tokens(timeline_content, NARRATIVE_MODEL) + 10 + 6 * len(summaries)
+
+    sizes = [count_tokens(summary, NARRATIVE_MODEL) for summary in summaries]
+    if sum(sizes) <= budget:
+        return timeline_content, summaries
+
+    allocation = _allocate_budget(sizes, max(budget, 0))
+    futures = {
+        i: get_chunk_executor().submit(
+            _chat_completion,
+            CONDENSE_PROMPT.format(words=int(allocation[i] * 0.7), text=summary),
+            SUMMARY_MODEL, usage, 'condense'
         )
-        narrative = response.choices[0].message.content
-        return narrative
-    except Exception as e:
-        print(f"Error generating narrative: {str(e)}")
-        return f"Error generating narrative: {str(e)}"
+        for i, summary in enumerate(summaries)
+        if sizes[i] > allocation[i] and allocation[i] > 0
+    }
+    fitted = []
+    for i, summary in enumerate(summaries):
+        if i in futures:
+            try:
+                summary = futures[i].result()
+            except Exception as e:
+                logger.error(f"Error condensing summary: {str(e)}")
+        fitted.append(truncate_to_tokens(summary, allocation[i], NARRATIVE_MODEL))
+    return timeline_content, fitted
+
+def _embed_document(text, usage=None):
+    passages = retrieval.document_passages(text)
+    with metrics.stage('embed_document', usage) as timer:
+        timer.add(bytes=len(text), chunks=len(passages))
+        vectors = embed_texts([passage[2] for passage in passages], usage, 'embed')
+    return passages, retrieval.pack_vectors(vectors)
+
+def embed_documents(documents, progress=None, max_workers=None, usage=None):
+    """Index the passages of every document for retrieval.
+
+    documents is a list of (content_hash, text) pairs as for
+    summarize_documents; document N in the prompt is documents[N - 1].
+    Passages and vectors are cached per document, so only new exhibits are
+    embedded. progress, if given, is called as progress('embed', done, total).
+    Returns a retrieval.VectorIndex whose payloads are
+    (document_number, page_number, tokens, text).
+    """
+    total = len(documents)
+    if progress:
+        progress('embed', 0, total)
+    model = embedding_model()
+    cache_keys = [
+        retrieval.make_cache_key(document_hash, model, EMBEDDING_DIMENSIONS)
+        for document_hash, _ in documents
+    ]
+    results = retrieval.get_cached_embeddings(cache_keys)
+    pending = [i for i, key in enumerate(cache_keys) if key not in results and documents[i][1].strip()]
+    done = total - len(pending)
+    if progress and done:
+        progress('embed', done, total)
+    if usage is not None:
+        usage.count('embedding_cache_hits', len(results))
+        usage.count('embedding_cache_misses', len(pending))
+
+    if pending:
+        workers = max(1, min(max_workers or SUMMARY_CONCURRENCY, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='embed') as executor:
+            futures = {executor.submit(_embed_document, documents[i][1], usage): i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                passages, vectors = future.result()
+                results[cache_keys[i]] = (passages, vectors)
+                retrieval.store_embeddings(cache_keys[i], documents[i][0], model,
+                                           EMBEDDING_DIMENSIONS, passages, vectors)
+                done += 1
+                if progress:
+                    progress('embed', done, total)
+        retrieval.evict_embeddings()
+
+    index = retrieval.VectorIndex(EMBEDDING_DIMENSIONS)
+    for number, key in enumerate(cache_keys, 1):
+        if key in results:
+            passages, vectors = results[key]
+            index.add(vectors, [(number, page, tokens, text) for page, tokens, text in passages])
+    return index
+
+def narrative_prompt_from_index(timeline_content, index, usage=None, evidence=None):
+    """Assemble the narrative prompt from the passages best matching each timeline entry.
+
+    The timeline takes at most a third of the context budget and the
+    evidence the rest, so the prompt size does not depend on how many
+    documents the project has. evidence, if given, is extended with a
+    (document_number, text) pair per passage used.
+    """
+    budget = (NARRATIVE_CONTEXT_TOKENS - NARRATIVE_OUTPUT_TOKENS
+              - count_tokens(NARRATIVE_PROMPT.format(content=''), NARRATIVE_MODEL))
+    timeline_content = truncate_to_tokens(timeline_content, budget // 3, NARRATIVE_MODEL)
+    budget -= count_tokens(timeline_content, NARRATIVE_MODEL) + 10
+
+    entries = retrieval.timeline_entries(timeline_content)
+    selected = {}
+    if entries and len(index):
+        with metrics.stage('retrieve', usage) as timer:
+            queries = embed_texts(entries, usage, 'embed_query')
+            # Evidence is grouped under an "Entry:" line naming its timeline entry
+            headers = [count_tokens(entry, NARRATIVE_MODEL) + 4 for entry in entries]
+            selected = retrieval.select_evidence(index, queries, max(budget, 0),
+                                                 header_tokens=headers, passage_overhead=10)
+            timer.add(queries=len(entries), passages=sum(len(passages) for passages in selected.values()))
+
+    parts = [f"Timeline:\n{timeline_content}\n\nSupporting Evidence:\n"]
+    for position, entry in enumerate(entries):
+        if position not in selected:
+            continue
+        parts.append(f"\nEntry: {entry}\n")
+        for number, page, _, text in sorted(selected[position]):
+            parts.append(f"[Document {number}, page {page}] {text}\n")
+            if evidence is not None:
+                evidence.append((number, text))
+    return NARRATIVE_PROMPT.format(content="".join(parts))
+
+def build_narrative_prompt(timeline_content, documents, progress=None, usage=None, evidence=None, failed=None):
+    """Assemble the budgeted narrative prompt, by retrieval or from document
+    summaries depending on NARRATIVE_CONTEXT_MODE.
+
+    evidence, if given, is extended with a (document_number, text) pair per
+    retrieved passage or document summary the prompt was built from, where
+    document N is documents[N - 1]. failed, if given, is extended with the
+    numbers of the documents left out because their summary failed.
+    """
+    if NARRATIVE_CONTEXT_MODE == "retrieval":
+        index = embed_documents(documents, progress=progress, usage=usage)
+        if progress:
+            progress('narrative', 0, 1)
+        return narrative_prompt_from_index(timeline_content, index, usage, evidence)
+
+    summaries = summarize_documents(documents, progress=progress, usage=usage)
+    # summarize_documents drops documents without text
+    numbers = [number for number, (_, text) in enumerate(documents, 1) if text.strip()]
+    if evidence is not None:
+        evidence.extend((number, summary) for number, summary in zip(numbers, summaries) if summary != SUMMARY_ERROR)
+    if progress:
+        progress('narrative', 0, 1)
+    failed_positions = []
+    prompt = narrative_prompt_from_summaries(timeline_content, summaries, usage, failed=failed_positions)
+    if failed is not None:
+        failed.extend(numbers[position - 1] for position in failed_positions)
+    return prompt
+
+def narrative_prompt_from_summaries(timeline_content, summaries, usage=None, failed=None):
+    """Assemble the narrative prompt from existing summaries, fitted to the
+    context budget. Failed summaries (SUMMARY_ERROR) are left out; failed, if
+    given, is extended with their 1-based positions in summaries."""
+    # Documents keep their numbers, so the narrative's references to them stay right
+    numbers = [i for i, summary in enumerate(summaries, 1) if summary != SUMMARY_ERROR]
+    if len(numbers) < len(summaries):
+        failed_positions = [i for i, summary in enumerate(summaries, 1) if summary == SUMMARY_ERROR]
+        logger.warning(f"Writing the narrative without {len(failed_positions)} document(s) whose summary failed")
+        if failed is not None:
+            failed.extend(failed_positions)
+        summaries = [summaries[i - 1] for i in numbers]
+    timeline_content, summaries = _fit_narrative_content(timeline_content, summaries, usage)
+
+    # Combine timeline and summaries for narrative generation
+    parts = [f"Timeline:\n{timeline_content}\n\nSupporting Documents:\n"]
+    for i, summary in zip(numbers, summaries):
+        parts.append(f"\nDocument {i}:\n{summary}\n")
+    return NARRATIVE_PROMPT.format(content="".join(parts))
+
+def generate_narrative(timeline_content, documents, progress=None, usage=None, evidence=None, failed=None):
+    """Gather evidence from each document and build the narrative.
+
+    documents is a list of (content_hash, text) pairs; see summarize_documents.
+    evidence and failed are as for build_narrative_prompt.
+
+    progress, if given, is called as progress(stage, current, total) so callers
+    such as the job queue can report how far along the run is. usage, if
+    given, is a TokenUsage that collects per-stage token counts and latency,
+    and counts documents whose summary failed as summary_errors. Errors from
+    the narrative call itself are raised.
+    """
+    prompt = build_narrative_prompt(timeline_content, documents, progress=progress, usage=usage, evidence=evidence,
+                                    failed=failed)
+    return _chat_completion(prompt, NARRATIVE_MODEL, usage, 'narrative', max_tokens=NARRATIVE_OUTPUT_TOKENS)
+
+def write_narrative(timeline_content, summaries, usage=None):
+    """Narrative from already-summarized documents; errors are raised"""
+    prompt = narrative_prompt_from_summaries(timeline_content, summaries, usage)
+    return _chat_completion(prompt, NARRATIVE_MODEL, usage, 'narrative', max_tokens=NARRATIVE_OUTPUT_TOKENS)
+
+def stream_narrative(prompt, usage=None):
+    """The narrative for a prompt from build_narrative_prompt, yielded piece
+    by piece as the model produces it. Errors are raised."""
+    yield from _chat_completion_stream(prompt, NARRATIVE_MODEL, usage, 'narrative', max_tokens=NARRATIVE_OUTPUT_TOKENS)
+
+async def stream_narrative_async(prompt, usage=None):
+    """Async generator of the narrative for a prompt from build_narrative_prompt"""
+    async for piece in _chat_completion_stream_async(prompt, NARRATIVE_MODEL, usage, 'narrative',
+                                                     max_tokens=NARRATIVE_OUTPUT_TOKENS):
+        yield piece
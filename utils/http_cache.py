@@ -0,0 +1,72 @@
+"""Conditional GET and compression for large JSON responses and downloads.
+
+Outputs carry a content hash, so an ETag can be checked before the body is
+loaded from the database; a matching If-None-Match costs a 304 and nothing
+else. Bodies are compressed with brotli when the client accepts it and the
+brotli package is installed, gzip otherwise.
+"""
+import gzip
+import hashlib
+import json
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Below this size compression is not worth the CPU
+COMPRESS_MIN_BYTES = 1024
+# Clients may keep a copy but must revalidate it every time
+CACHE_CONTROL = 'private, no-cache'
+
+def make_etag(*parts):
+    return hashlib.sha256(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+def not_modified(etag):
+    """A 304 response if the client already has this version, else None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        _set_cache_headers(response, etag)
+        return response
+    return None
+
+def _set_cache_headers(response, etag):
+    # Weak, because the same content is served with different encodings
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+
+def _choose_encoding(accepted):
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def compress(body, accepted):
+    """(body, encoding) of body compressed for accepted, the client's
+    Accept-Encoding as a werkzeug Accept; encoding is None if left as is"""
+    encoding = _choose_encoding(accepted) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding == 'br':
+        body = brotli.compress(body, quality=5)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=6)
+    return body, encoding
+
+def cached_json_response(payload, etag):
+    """JSON response with an ETag, compressed if the client supports it"""
+    body, encoding = compress(json.dumps(payload).encode('utf-8'), request.accept_encodings)
+
+    response = Response(body, mimetype='application/json')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    _set_cache_headers(response, etag)
+    return response
+
+def file_response(data, mimetype, etag, filename):
+    """A download with an ETag; pair with not_modified() for conditional GETs"""
+    response = Response(data, mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    _set_cache_headers(response, etag)
+    return response
@@ -0,0 +1,435 @@
+"""Background processing jobs.
+
+Jobs are rows in the processing_jobs table, so they outlive the web process:
+a local thread pool runs them and, when a process starts serving, any job
+that was queued (or left running by a process that died) is picked up again.
+A worker holds a lease on each job it runs and renews it while the job runs,
+so only jobs whose worker has stopped renewing are taken over. Workers take
+queued jobs user by user in turn rather than first come, first served, so
+one user's batch of uploads does not hold up everyone else's runs.
+"""
+import os
+import socket
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, func, case
+from models import db, Document, Output, ProcessingJob, lock_project
+from utils.pipeline import process_project, discard_draft, PipelineError
+from utils.extraction import extract_document
+from utils.gpt4_processor import TokenUsage
+from utils.rate_limit import scheduler
+from utils.render import render_output
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+# A running job's lease is renewed every JOB_HEARTBEAT_SECONDS for another
+# JOB_LEASE_SECONDS; a job whose lease ran out is assumed to be orphaned
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '120'))
+JOB_HEARTBEAT_SECONDS = float(os.environ.get('JOB_HEARTBEAT_SECONDS', '30'))
+
+# Job types that write a project's Output; at most one of them is queued or
+# running per project. 'stream' jobs record narrative streams, which run in
+# the request that started them rather than on the pool.
+OUTPUT_JOB_TYPES = ('process', 'stream')
+
+# Queued jobs a worker looks at each time it picks the next one to run
+JOB_DISPATCH_CANDIDATES = 20
+
+_app = None
+_executor = None
+_max_workers = None
+_start_lock = threading.Lock()
+# Ids of the jobs this process is running, whose leases the heartbeat renews
+_running = set()
+_running_lock = threading.Lock()
+
+def init_job_queue(app, max_workers=None):
+    """Attach the job queue to the app.
+
+    The worker pool starts, and unfinished jobs are resumed, when the app
+    handles its first request. CLI commands such as flask db upgrade and
+    gunicorn's pre-fork master therefore never run jobs; each serving worker
+    process does.
+    """
+    global _app, _max_workers
+    _app = app
+    _max_workers = max_workers or JOB_WORKERS
+    app.before_request(start_job_queue)
+
+def start_job_queue():
+    """Start the worker pool if it is not running yet; the ASGI server calls
+    this when it starts serving, the Flask app before its first request"""
+    global _executor
+    if _executor is not None:
+        return
+    with _start_lock:
+        if _executor is not None:
+            return
+        _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix='job-worker')
+    # Resume in the background so the first request is not held up
+    threading.Thread(target=_resume_in_background, name='job-resume', daemon=True).start()
+    threading.Thread(target=_heartbeat, name='job-heartbeat', daemon=True).start()
+
+def _resume_in_background():
+    with _app.app_context():
+        try:
+            resume_pending_jobs()
+        except Exception as e:
+            logger.error(f"Error resuming queued jobs: {str(e)}")
+        finally:
+            db.session.remove()
+
+def _heartbeat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _app.app_context():
+            try:
+                renew_leases()
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {str(e)}")
+            finally:
+                db.session.remove()
+
+def worker_id():
+    """The lease owner name of this process"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def _lease_expiry():
+    return datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+def renew_leases():
+    """Extend the leases of the jobs this process is running; returns how many were renewed"""
+    with _running_lock:
+        job_ids = list(_running)
+    if not job_ids:
+        return 0
+    renewed = ProcessingJob.query.filter(
+        ProcessingJob.id.in_(job_ids),
+        ProcessingJob.status == 'running',
+        ProcessingJob.owner == worker_id()
+    ).update({'lease_expires_at': _lease_expiry()}, synchronize_session=False)
+    db.session.commit()
+    return renewed
+
+def _expired_jobs(now):
+    return ProcessingJob.query.filter(
+        ProcessingJob.status == 'running',
+        db.or_(
+            ProcessingJob.lease_expires_at < now,
+            # Claimed before jobs had leases
+            db.and_(ProcessingJob.lease_expires_at.is_(None),
+                    ProcessingJob.updated_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+        )
+    )
+
+def resume_pending_jobs():
+    now = datetime.utcnow()
+    # A stream's reader is gone with its worker, so it is not rerun: its
+    # draft is dropped and the job marked failed
+    for job in _expired_jobs(now).filter(ProcessingJob.job_type == 'stream').all():
+        logger.warning(f"Failing orphaned narrative stream {job.id}, last held by {job.owner}")
+        discard_draft(job.project_id)
+        finish_stream_job(job.id, 'Interrupted: the server stopped while streaming')
+    for job in _expired_jobs(now).all():
+        logger.warning(f"Requeueing orphaned job {job.id}, last held by {job.owner}")
+    # Conditional, so a job whose lease was renewed meanwhile keeps running
+    _expired_jobs(now).update({'status': 'queued', 'owner': None, 'lease_expires_at': None},
+                              synchronize_session=False)
+    db.session.commit()
+
+    pending = ProcessingJob.query.filter_by(status='queued').order_by(ProcessingJob.id).all()
+    for job in pending:
+        _submit(job.id)
+    if pending:
+        logger.info(f"Resumed {len(pending)} queued job(s)")
+
+def get_active_output_job(project_id):
+    """The project's queued or running process or stream job, if any"""
+    return ProcessingJob.query.filter(
+        ProcessingJob.project_id == project_id,
+        ProcessingJob.job_type.in_(OUTPUT_JOB_TYPES),
+        ProcessingJob.status.in_(('queued', 'running'))
+    ).order_by(ProcessingJob.id.desc()).first()
+
+def enqueue_project_processing(project_id, user_id, force=False):
+    """Queue a run of the pipeline, or return the process or stream job
+    already writing the project's output"""
+    lock_project(project_id)
+    job = get_active_output_job(project_id)
+    if job:
+        db.session.commit()
+        return job
+    job = ProcessingJob(project_id=project_id, user_id=user_id, job_type='process', force=force)
+    db.session.add(job)
+    db.session.commit()
+    _submit(job.id)
+    return job
+
+def start_stream_job(project_id, user_id):
+    """Record a narrative stream as a running job of this worker; returns its
+    id, or None if a process or stream job is already queued or running"""
+    lock_project(project_id)
+    if get_active_output_job(project_id):
+        db.session.commit()
+        return None
+    now = datetime.utcnow()
+    job = ProcessingJob(project_id=project_id, user_id=user_id, job_type='stream', status='running',
+                        stage='narrative', started_at=now, updated_at=now, owner=worker_id(),
+                        lease_expires_at=_lease_expiry())
+    db.session.add(job)
+    db.session.commit()
+    with _running_lock:
+        _running.add(job.id)
+    return job.id
+
+def finish_stream_job(job_id, error=None, usage=None):
+    """Mark a stream job succeeded, or failed with error; usage is its TokenUsage"""
+    with _running_lock:
+        _running.discard(job_id)
+    job = db.session.get(ProcessingJob, job_id)
+    job.status = 'failed' if error else 'succeeded'
+    job.error = error
+    if usage is not None:
+        job.token_usage = usage.to_dict()
+    job.finished_at = datetime.utcnow()
+    job.updated_at = job.finished_at
+    job.duration_seconds = (job.finished_at - job.started_at).total_seconds()
+    job.lease_expires_at = None
+    db.session.commit()
+    metrics.JOB_SECONDS.observe(job.duration_seconds, job_type=job.job_type, status=job.status)
+
+def enqueue_document_extraction(document, user_id):
+    job = ProcessingJob(
+        project_id=document.project_id,
+        user_id=user_id,
+        document_id=document.id,
+        job_type='extract'
+    )
+    db.session.add(job)
+    db.session.commit()
+    _submit(job.id)
+    return job
+
+def enqueue_export(project_id, user_id, artifact):
+    """Queue rendering of an export such as 'narrative.pdf', or return the
+    export job for it that is already queued or running"""
+    job = ProcessingJob.query.filter(
+        ProcessingJob.project_id == project_id,
+        ProcessingJob.job_type == 'export',
+        ProcessingJob.artifact == artifact,
+        ProcessingJob.status.in_(('queued', 'running'))
+    ).first()
+    if job:
+        return job
+    job = ProcessingJob(project_id=project_id, user_id=user_id, job_type='export', artifact=artifact)
+    db.session.add(job)
+    db.session.commit()
+    _submit(job.id)
+    return job
+
+def add_extraction_jobs(project_id, user_id, document_ids):
+    """Insert extract jobs for several documents in one statement, in the
+    caller's transaction; pass the returned ids to submit_jobs() once committed"""
+    if not document_ids:
+        return []
+    now = datetime.utcnow()
+    return db.session.scalars(
+        insert(ProcessingJob).returning(ProcessingJob.id, sort_by_parameter_order=True),
+        [{
+            'project_id': project_id,
+            'user_id': user_id,
+            'document_id': document_id,
+            'job_type': 'extract',
+            'created_at': now,
+            'updated_at': now
+        } for document_id in document_ids]
+    ).all()
+
+def submit_jobs(job_ids):
+    for job_id in job_ids:
+        _submit(job_id)
+
+def get_latest_job(project_id, job_type='process'):
+    return db.session.scalar(select_latest_job(project_id, job_type))
+
+def select_latest_job(project_id, job_type='process'):
+    return select(ProcessingJob).filter_by(
+        project_id=project_id,
+        job_type=job_type
+    ).order_by(ProcessingJob.id.desc()).limit(1)
+
+def get_slowest_jobs(user_id, job_type='process', limit=20):
+    """Finished runs of a user's projects, longest first"""
+    return ProcessingJob.query.filter(
+        ProcessingJob.user_id == user_id,
+        ProcessingJob.job_type == job_type,
+        ProcessingJob.duration_seconds.isnot(None)
+    ).order_by(ProcessingJob.duration_seconds.desc()).limit(limit).all()
+
+def job_status(job, jobs_ahead=None):
+    """job.to_dict() plus, while it is unfinished, where it stands in line:
+    the jobs queued before it and the shared LLM call queue (see
+    utils/rate_limit.py) with the estimated wait for this user's calls.
+    jobs_ahead is counted with select_jobs_ahead() unless given."""
+    data = job.to_dict()
+    if job.status in ('queued', 'running'):
+        queue = scheduler.status(job.user_id)
+        if job.status == 'queued':
+            queue['jobs_ahead'] = jobs_ahead if jobs_ahead is not None else db.session.scalar(select_jobs_ahead(job))
+        data['queue'] = queue
+    return data
+
+def select_jobs_ahead(job):
+    return select(func.count(ProcessingJob.id)).where(
+        ProcessingJob.status == 'queued',
+        ProcessingJob.id < job.id
+    )
+
+# Handlers take (job, progress, results); anything put in results is saved on
+# the job when it finishes, even if the handler fails and the session is
+# rolled back.
+
+def _run_extract(job, progress, results):
+    document = db.session.get(Document, job.document_id)
+    if document is None:
+        raise PipelineError('Document not found')
+    usage = TokenUsage(tenant=(job.user_id, job.project_id))
+    progress('extract', 0, 1)
+    try:
+        if not extract_document(document, job.user_id, usage=usage, take_over=True):
+            raise PipelineError(f'Could not extract text from {document.filename}')
+    finally:
+        results['token_usage'] = usage.to_dict()
+    progress('extract', 1, 1)
+
+def _run_process(job, progress, results):
+    usage = TokenUsage(tenant=(job.user_id, job.project_id))
+    report = {}
+    try:
+        process_project(job.project_id, job.user_id, progress=progress, usage=usage,
+                        force=job.force, report=report)
+    finally:
+        results['token_usage'] = usage.to_dict()
+        results['stage_report'] = report
+
+def _run_export(job, progress, results):
+    output = Output.query.filter_by(project_id=job.project_id).first()
+    if output is None:
+        raise PipelineError('No output found')
+    if output.timeline_hash is None or output.narrative_hash is None:
+        output.update_hashes()
+    kind, fmt = job.artifact.split('.')
+    progress('render', 0, 1)
+    render_output(output, kind, fmt, output.project.name)
+    progress('render', 1, 1)
+
+JOB_HANDLERS = {
+    'process': _run_process,
+    'extract': _run_extract,
+    'export': _run_export,
+}
+
+def select_next_jobs(limit=JOB_DISPATCH_CANDIDATES):
+    """Ids of queued jobs in the order workers take them: users with the
+    fewest running jobs first, then the user who least recently had a job
+    started, then oldest first"""
+    users = select(
+        ProcessingJob.user_id,
+        func.sum(case((ProcessingJob.status == 'running', 1), else_=0)).label('running'),
+        func.max(ProcessingJob.started_at).label('last_started')
+    ).group_by(ProcessingJob.user_id).subquery()
+    return select(ProcessingJob.id).join(users, users.c.user_id == ProcessingJob.user_id).where(
+        ProcessingJob.status == 'queued'
+    ).order_by(users.c.running, users.c.last_started.asc().nulls_first(), ProcessingJob.id).limit(limit)
+
+def _submit(job_id):
+    """Have a worker run queued jobs. job_id must already be committed as
+    queued, but the worker runs whichever queued job is next in turn (see
+    select_next_jobs), so this one may be run by another worker"""
+    if _executor is None:
+        raise RuntimeError("Job queue has not been started; jobs can only be queued while serving requests")
+    _executor.submit(_run_queued_jobs)
+
+def _claim(job_id):
+    """Atomically move a queued job to running so only one worker executes it"""
+    now = datetime.utcnow()
+    claimed = ProcessingJob.query.filter_by(id=job_id, status='queued').update({
+        'status': 'running',
+        'started_at': now,
+        'updated_at': now,
+        'owner': worker_id(),
+        'lease_expires_at': _lease_expiry(),
+        'error': None
+    })
+    db.session.commit()
+    if claimed != 1:
+        return False
+    with _running_lock:
+        _running.add(job_id)
+    return True
+
+def _claim_next():
+    """Claim the next queued job in turn; returns its id, or None once none are left"""
+    while True:
+        job_ids = db.session.scalars(select_next_jobs()).all()
+        if not job_ids:
+            return None
+        for job_id in job_ids:
+            if _claim(job_id):
+                return job_id
+
+def _run_queued_jobs():
+    """Run queued jobs, each time the next one in turn, until none are left.
+    Draining the queue, rather than running one job per _submit, means no
+    job is left queued while a worker is free, whichever process queued it."""
+    while True:
+        with _app.app_context():
+            try:
+                job_id = _claim_next()
+            finally:
+                db.session.remove()
+        if job_id is None:
+            return
+        _run_job(job_id)
+
+def _run_job(job_id):
+    with _app.app_context():
+        job = db.session.get(ProcessingJob, job_id)
+
+        def progress(stage, current=0, total=0):
+            job.stage = stage
+            job.progress_current = current
+            job.progress_total = total
+            job.updated_at = datetime.utcnow()
+            db.session.commit()
+
+        results = {}
+        try:
+            JOB_HANDLERS[job.job_type](job, progress, results)
+            job.status = 'succeeded'
+        except PipelineError as e:
+            db.session.rollback()
+            job.status = 'failed'
+            job.error = str(e)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error running job {job_id}: {str(e)}")
+            job.status = 'failed'
+            job.error = f'Server error: {str(e)}'
+        finally:
+            with _running_lock:
+                _running.discard(job_id)
+            for field, value in results.items():
+                setattr(job, field, value)
+            job.finished_at = datetime.utcnow()
+            job.updated_at = job.finished_at
+            job.duration_seconds = (job.finished_at - job.started_at).total_seconds()
+            job.lease_expires_at = None
+            db.session.commit()
+            metrics.JOB_SECONDS.observe(job.duration_seconds, job_type=job.job_type, status=job.status)
+            db.session.remove()
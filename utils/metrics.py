@@ -0,0 +1,194 @@
+"""Process-wide pipeline metrics in the Prometheus text format.
+
+Counters and histograms live in memory in this process and are served by
+/metrics. Set METRICS_ENABLED=0 to turn them off; every recording call then
+returns immediately, so the instrumentation costs a flag check.
+
+Per-run numbers (what one processing job spent where) are kept separately on
+the run's TokenUsage and saved with the job; stage() records to both.
+"""
+import os
+import bisect
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+# If set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Seconds; LLM calls and large extractions run to minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(key)} {_format_value(value)}"
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    samples = Counter.samples
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label key -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = _label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', _format_value(float(bound)))])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(key)} {cumulative}"
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+def counter(name, documentation):
+    return _register(Counter(name, documentation))
+
+def gauge(name, documentation):
+    return _register(Gauge(name, documentation))
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, buckets))
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = histogram('brief_stage_seconds', 'Time spent in each pipeline stage')
+STAGE_BYTES = counter('brief_stage_bytes_total', 'Bytes handled by each pipeline stage')
+STAGE_PAGES = counter('brief_stage_pages_total', 'PDF pages handled by each pipeline stage')
+LLM_SECONDS = histogram('brief_llm_request_seconds', 'Latency of successful LLM calls')
+LLM_TOKENS = counter('brief_llm_tokens_total', 'LLM tokens used, by stage and kind (prompt/completion)')
+LLM_RETRIES = counter('brief_llm_retries_total', 'LLM calls retried after a transient error')
+LLM_FAILURES = counter('brief_llm_failures_total', 'LLM calls that failed after all retries')
+LLM_QUEUE_SECONDS = histogram('brief_llm_queue_seconds', 'Time LLM calls waited for rate limit capacity')
+LLM_QUEUE_DEPTH = gauge('brief_llm_queue_depth', 'LLM calls waiting for rate limit capacity')
+SUMMARY_CACHE = counter('brief_summary_cache_total', 'Document summary cache lookups, by result (hit/miss)')
+OCR_PAGES = counter('brief_ocr_pages_total', 'Pages without a text layer, by OCR result (cached/read/failed/unavailable)')
+JOB_SECONDS = histogram('brief_job_seconds', 'Wall time of background jobs, by type and final status')
+
+class StageTimer:
+    """Times a block as one pipeline stage; see stage()"""
+
+    __slots__ = ('name', 'usage', 'amounts', 'started')
+
+    def __init__(self, name, usage):
+        self.name = name
+        self.usage = usage
+        self.amounts = {}
+
+    def add(self, **amounts):
+        """Count bytes, pages etc. handled by this stage"""
+        for field, amount in amounts.items():
+            self.amounts[field] = self.amounts.get(field, 0) + amount
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.started
+        if self.usage is not None:
+            self.usage.record_stage(self.name, seconds, **self.amounts)
+        if METRICS_ENABLED:
+            STAGE_SECONDS.observe(seconds, stage=self.name)
+            if 'bytes' in self.amounts:
+                STAGE_BYTES.inc(self.amounts['bytes'], stage=self.name)
+            if 'pages' in self.amounts:
+                STAGE_PAGES.inc(self.amounts['pages'], stage=self.name)
+        return False
+
+def stage(name, usage=None):
+    """Context manager timing a pipeline stage.
+
+        with metrics.stage('storage_fetch', usage) as timer:
+            data = get_from_storage(key)
+            timer.add(bytes=len(data))
+
+    The duration and amounts go to the process metrics and, if usage (a
+    TokenUsage) is given, to that run's per-stage timings.
+    """
+    return StageTimer(name, usage)
@@ -0,0 +1,187 @@
+"""OCR for PDF pages that have no text layer (scans, faxes, photographed pages).
+
+After a PDF is parsed, only the pages that came back without text are
+rendered to images and read with Tesseract, in a pool of worker processes
+like the one pdf_processor uses for large PDFs. Results are cached by a
+fingerprint of the page's drawing content (content stream and embedded
+images) together with the engine settings, so a scanned page is read once,
+ever, whichever document it turns up in again.
+
+Needs the optional "ocr" dependencies (pytesseract and pypdfium2) and the
+tesseract binary. Without them, or with OCR_ENGINE=off, pages without a text
+layer are left empty and counted as failed in the document's coverage.
+"""
+import os
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from models import db, OcrCache
+from utils import metrics
+from utils.pdf_processor import PDF_WORKER_START_METHOD, _open_reader
+from utils.summary_cache import cache_enabled
+
+try:
+    import pytesseract
+    import pypdfium2
+except ImportError:  # OCR is turned off
+    pytesseract = pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+OCR_ENGINE = os.environ.get('OCR_ENGINE', 'tesseract').lower()  # tesseract or off
+OCR_LANGUAGE = os.environ.get('OCR_LANGUAGE', 'eng')
+OCR_DPI = int(os.environ.get('OCR_DPI', '300'))
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', str(os.cpu_count() or 1)))
+OCR_PAGE_TIMEOUT = int(os.environ.get('OCR_PAGE_TIMEOUT', '120'))
+
+# Nested form XObjects are followed this deep when fingerprinting a page
+_MAX_XOBJECT_DEPTH = 3
+
+# Per-worker-process document, set up once by _init_worker
+_worker_pdf = None
+
+@lru_cache(maxsize=1)
+def engine_key():
+    """Engine, version and settings the cached text depends on, or None if OCR is unavailable"""
+    if OCR_ENGINE == 'off':
+        return None
+    if pytesseract is None or pypdfium2 is None:
+        logger.warning("OCR unavailable: install the 'ocr' extra (pytesseract, pypdfium2)")
+        return None
+    try:
+        version = pytesseract.get_tesseract_version()
+    except Exception as e:
+        logger.warning(f"OCR unavailable: {str(e)}")
+        return None
+    return f"tesseract-{version}:{OCR_LANGUAGE}:{OCR_DPI}"
+
+def _hash_resources(resources, digest, depth):
+    xobjects = resources.get('/XObject') if resources else None
+    if not xobjects:
+        return
+    xobjects = xobjects.get_object()
+    for name in sorted(xobjects):
+        xobject = xobjects[name].get_object()
+        digest.update(name.encode('utf-8'))
+        # The stream as stored (still compressed), so nothing is decoded
+        digest.update(getattr(xobject, '_data', b'') or b'')
+        if xobject.get('/Subtype') == '/Form' and depth < _MAX_XOBJECT_DEPTH:
+            _hash_resources(xobject.get('/Resources'), digest, depth + 1)
+
+def page_fingerprint(page):
+    """sha256 of what a PyPDF2 page draws: its geometry, content stream and images"""
+    digest = hashlib.sha256()
+    digest.update(f"{list(page.mediabox)}:{page.get('/Rotate', 0)}".encode('utf-8'))
+    contents = page.get_contents()
+    if contents is not None:
+        digest.update(contents.get_data())
+    resources = page.get('/Resources')
+    _hash_resources(resources.get_object() if resources else None, digest, 0)
+    return digest.hexdigest()
+
+def make_cache_key(fingerprint, engine):
+    return hashlib.sha256(f"{fingerprint}:{engine}".encode('utf-8')).hexdigest()
+
+def _read_page(pdf, index):
+    """OCR text of page index (0-based) of a pypdfium2 document, or None on error"""
+    try:
+        image = pdf[index].render(scale=OCR_DPI / 72).to_pil()
+        return pytesseract.image_to_string(image, lang=OCR_LANGUAGE, timeout=OCR_PAGE_TIMEOUT).strip()
+    except Exception as e:
+        logger.warning(f"OCR failed for page {index + 1}: {str(e)}")
+        return None
+
+def _init_worker(pdf_content):
+    global _worker_pdf
+    # One tesseract thread per worker; the pool provides the parallelism
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    _worker_pdf = pypdfium2.PdfDocument(pdf_content)
+
+def _read_worker_page(index):
+    return _read_page(_worker_pdf, index)
+
+def read_pages(pdf_content, indexes, workers=None):
+    """{index: text or None} for the given 0-based page indexes"""
+    workers = OCR_WORKERS if workers is None else workers
+    pdf_content = pdf_content if isinstance(pdf_content, bytes) else bytes(pdf_content)
+    if workers <= 1 or len(indexes) == 1:
+        pdf = pypdfium2.PdfDocument(pdf_content)
+        try:
+            return {index: _read_page(pdf, index) for index in indexes}
+        finally:
+            pdf.close()
+
+    # Each worker opens the PDF once in its initializer, so only page
+    # numbers and text cross the process boundary afterwards
+    executor = ProcessPoolExecutor(
+        max_workers=min(workers, len(indexes)),
+        mp_context=multiprocessing.get_context(PDF_WORKER_START_METHOD),
+        initializer=_init_worker,
+        initargs=(pdf_content,)
+    )
+    try:
+        return dict(zip(indexes, executor.map(_read_worker_page, indexes)))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _cached_text(cache_keys):
+    if not cache_keys or not cache_enabled():
+        return {}
+    found = dict(db.session.query(OcrCache.cache_key, OcrCache.text).filter(OcrCache.cache_key.in_(set(cache_keys))))
+    # Don't hold a transaction open while the pages are read
+    db.session.rollback()
+    return found
+
+def _store_text(engine, texts):
+    """Cache {cache_key: text}; commits"""
+    if not texts or not cache_enabled():
+        return
+    try:
+        db.session.add_all(OcrCache(cache_key=key, engine=engine, text=text) for key, text in texts.items())
+        db.session.commit()
+    except Exception as e:
+        # Most likely a concurrent extraction stored the same page first
+        db.session.rollback()
+        logger.warning(f"Could not cache OCR text of {len(texts)} pages: {str(e)}")
+
+def read_missing_pages(pdf_content, missing, usage=None):
+    """OCR text of the pages of a PDF that came back from iter_pdf_pages empty.
+
+    missing is the list of their 0-based indexes. Returns {index: text} for
+    the pages OCR read, which may be blank; pages left out are failed, because
+    OCR errored or is not available.
+    """
+    if not missing:
+        return {}
+    engine = engine_key()
+    if engine is None:
+        metrics.OCR_PAGES.inc(len(missing), result='unavailable')
+        return {}
+
+    with metrics.stage('ocr', usage) as timer:
+        reader = _open_reader(pdf_content)
+        keys = {index: make_cache_key(page_fingerprint(reader.pages[index]), engine) for index in missing}
+        cached = _cached_text(keys.values())
+        # Identical pages within the document (e.g. blank separators) are read once
+        to_read = {}
+        for index in missing:
+            if keys[index] not in cached:
+                to_read.setdefault(keys[index], index)
+
+        read = read_pages(pdf_content, list(to_read.values())) if to_read else {}
+        fresh = {key: read[index] for key, index in to_read.items() if read[index] is not None}
+        _store_text(engine, fresh)
+        texts = {**cached, **fresh}
+        found = {index: texts[keys[index]] for index in missing if keys[index] in texts}
+        timer.add(pages=len(to_read))
+
+    hits = len(missing) - len(to_read)
+    if usage is not None:
+        usage.count('ocr_cache_hits', hits)
+        usage.count('ocr_cache_misses', len(to_read))
+    metrics.OCR_PAGES.inc(hits, result='cached')
+    metrics.OCR_PAGES.inc(len(fresh), result='read')
+    metrics.OCR_PAGES.inc(len(missing) - len(found), result='failed')
+    return found
@@ -1,48 +1,86 @@
 import os
-import PyPDF2
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from utils.gpt4_processor import summarize_text
+
+logger = logging.getLogger(__name__)
+
+# Parallel extraction settings. Small PDFs are parsed in-process; larger ones
+# are split into page ranges that are parsed by a pool of worker processes.
+PDF_EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_CHUNK = int(os.environ.get("PDF_PAGES_PER_CHUNK", "16"))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "32"))
+# forkserver avoids forking the multi-threaded web/job process
+PDF_WORKER_START_METHOD = os.environ.get("PDF_WORKER_START_METHOD", "forkserver")
+
+# Per-worker-process reader, set up once by _init_worker
+_worker_reader = None
+
+def _extract_page(page):
+    try:
+        return page.extract_text() or ""
+    except Exception as e:
+        logger.warning(f"Error extracting text from page: {e}")
+        return ""
+
+def _open_reader(pdf_content):
+    # Imported here so processes that never parse a PDF do not pay for it
+    import PyPDF2
+    # A memory-mapped file (see LocalStorageBackend) can be read in place
+    if hasattr(pdf_content, 'seek'):
+        pdf_content.seek(0)
+        return PyPDF2.PdfReader(pdf_content)
+    return PyPDF2.PdfReader(BytesIO(pdf_content))
+
+def _init_worker(pdf_content):
+    global _worker_reader
+    _worker_reader = _open_reader(pdf_content)
+
+def _extract_page_range(start, stop):
+    return [_extract_page(_worker_reader.pages[i]) for i in range(start, stop)]
+
+def iter_pdf_pages(pdf_content, workers=None, chunk_size=None):
+    """Yield the text of each page of a PDF, in order, as soon as it is available.
+
+    Pages whose text cannot be extracted come back as empty strings so page
+    numbers stay aligned. Raises if the PDF itself cannot be parsed.
+    """
+    workers = PDF_EXTRACT_WORKERS if workers is None else workers
+    chunk_size = chunk_size or PDF_PAGES_PER_CHUNK
+
+    pdf_reader = _open_reader(pdf_content)
+    page_count = len(pdf_reader.pages)
+
+    if workers <= 1 or page_count < max(PDF_PARALLEL_MIN_PAGES, chunk_size * 2):
+        for page in pdf_reader.pages:
+            yield _extract_page(page)
+        return
+
+    # Each worker parses the PDF once in its initializer, so only page ranges
+    # and page text cross the process boundary afterwards.
+    ranges = [(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+    executor = ProcessPoolExecutor(
+        max_workers=min(workers, len(ranges)),
+        mp_context=multiprocessing.get_context(PDF_WORKER_START_METHOD),
+        initializer=_init_worker,
+        initargs=(pdf_content if isinstance(pdf_content, bytes) else bytes(pdf_content),)
+    )
+    try:
+        futures = [executor.submit(_extract_page_range, start, stop) for start, stop in ranges]
+        for future in futures:
+            yield from future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def extract_pages_from_pdf(pdf_content, workers=None):
+    """Extract the text of each page from PDF content as a list"""
+    return list(iter_pdf_pages(pdf_content, workers=workers))
 
 def extract_text_from_pdf(pdf_content):
     """Extract text from PDF content"""
     try:
-        # Create a BytesIO object from the PDF content
-        pdf_file = BytesIO(pdf_content)
-        # Create PDF reader object
-        pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        # Extract text from each page
-        for page in pdf_reader.pages:
-            try:
-                text += page.extract_text() + "\n"
-            except Exception as e:
-                print(f"Error extracting text from page: {e}")
-                continue
-        return text
+        return "".join(f"{page_text}\n" for page_text in iter_pdf_pages(pdf_content))
     except Exception as e:
-        print(f"Error processing PDF: {e}")
+        logger.error(f"Error processing PDF: {e}")
         return ""
-
-def process_pdfs():
-    input_folder = 'inputs'
-    pdf_files = [f for f in os.listdir(input_folder) if f.endswith('.pdf')]
-    
-    for pdf_file in pdf_files:
-        file_path = os.path.join(input_folder, pdf_file)
-        
-        try:
-            with open(file_path, 'rb') as file:
-                pdf_content = file.read()
-                text = extract_text_from_pdf(pdf_content)
-                summary = summarize_text(text)
-                update_timeline(pdf_file, summary)
-        except Exception as e:
-            print(f"Error processing {pdf_file}: {str(e)}")
-
-def update_timeline(pdf_file, summary):
-    timeline_path = 'timeline.md'
-    
-    with open(timeline_path, 'a') as timeline:
-        timeline.write(f"\n## Events from {pdf_file}\n")
-        timeline.write(summary)
-        timeline.write(f"\n[Reference: {pdf_file}]\n")
@@ -0,0 +1,537 @@
+import os
+import queue
+import asyncio
+import hashlib
+import threading
+import time
+import logging
+from datetime import datetime
+from models import db, Document, Output, StageFingerprint
+from utils import metrics
+from utils.file_handler import get_file_content, get_many_file_contents, outline_events
+from utils.storage import release_content
+from utils.extraction import extract_document, get_document_text
+from utils.timeline import (
+    TIMELINE_VERSION, events_from_passage, events_from_summary, merge_events, render_markdown, save_events
+)
+from utils import versions
+from utils.gpt4_processor import (
+    generate_narrative, stream_narrative, stream_narrative_async, build_narrative_prompt, embedding_model, TokenUsage,
+    SUMMARY_PROMPT_VERSION, SUMMARY_MODEL, NARRATIVE_PROMPT_VERSION, NARRATIVE_MODEL, NARRATIVE_CONTEXT_TOKENS,
+    NARRATIVE_CONTEXT_MODE, EMBEDDING_DIMENSIONS
+)
+from utils.retrieval import PASSAGE_VERSION, RETRIEVAL_PASSAGE_TOKENS, RETRIEVAL_PASSAGES_PER_ENTRY
+
+logger = logging.getLogger(__name__)
+
+# How often a streaming run writes the partial narrative to the database
+STREAM_PERSIST_SECONDS = float(os.environ.get('STREAM_PERSIST_SECONDS', '2'))
+STREAM_KEEPALIVE_SECONDS = float(os.environ.get('STREAM_KEEPALIVE_SECONDS', '15'))
+# How long a run waits for documents another worker is extracting; any still
+# running after that are left out of the run and reported as skipped
+EXTRACTION_WAIT_SECONDS = float(os.environ.get('EXTRACTION_WAIT_SECONDS', '60'))
+EXTRACTION_POLL_SECONDS = 1.0
+
+# Report key for the per-document stage feeding the narrative prompt
+CONTEXT_STAGE = 'embed' if NARRATIVE_CONTEXT_MODE == 'retrieval' else 'summarize'
+
+class PipelineError(Exception):
+    """A processing failure whose message is safe to show to the user"""
+
+def _noop_progress(stage, current=0, total=0):
+    pass
+
+# Stages whose results are fingerprinted, in pipeline order
+STAGES = ('timeline', 'narrative')
+
+def fingerprint(*parts):
+    return hashlib.sha256(":".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+def _stored_fingerprints(project_id):
+    return {
+        row.stage: row.fingerprint
+        for row in StageFingerprint.query.filter_by(project_id=project_id).all()
+    }
+
+def _store_fingerprints(project_id, fingerprints):
+    existing = {row.stage: row for row in StageFingerprint.query.filter_by(project_id=project_id).all()}
+    for stage, value in fingerprints.items():
+        row = existing.get(stage) or StageFingerprint(project_id=project_id, stage=stage)
+        row.fingerprint = value
+        row.updated_at = datetime.utcnow()
+        db.session.add(row)
+
+class ProjectInputs:
+    """Everything the narrative stage needs, plus how each input was obtained.
+
+    fingerprints holds the input fingerprint of each stage; report records,
+    per stage, whether its result was reused or recomputed. events is the
+    rebuilt timeline, or None if the stored one is current. filenames names
+    the document of each entry in documents.
+    """
+
+    def __init__(self, timeline_content, events, documents, filenames, fingerprints, stored_fingerprints, report):
+        self.timeline_content = timeline_content
+        self.events = events
+        self.documents = documents
+        self.filenames = filenames
+        self.fingerprints = fingerprints
+        self.stored_fingerprints = stored_fingerprints
+        self.report = report
+
+    def is_current(self, stage):
+        return self.stored_fingerprints.get(stage) == self.fingerprints[stage]
+
+    def names_of(self, numbers):
+        """Filenames of documents by their 1-based number in documents"""
+        return [self.filenames[number - 1] for number in numbers]
+
+    def add_evidence_events(self, evidence):
+        """Merge the dates found in the narrative's evidence, (document_number,
+        text) pairs from build_narrative_prompt, into a rebuilt timeline"""
+        if self.events is None:
+            return
+        events_from = events_from_passage if NARRATIVE_CONTEXT_MODE == 'retrieval' else events_from_summary
+        found = [event for number, text in evidence for event in events_from(text, self.filenames[number - 1])]
+        if found:
+            self.events = merge_events(self.events + found)
+            self.timeline_content = render_markdown(self.events)
+
+def _wait_for_extractions(docs, progress):
+    """Wait up to EXTRACTION_WAIT_SECONDS for documents another worker is
+    extracting; returns those still running after that"""
+    deadline = time.monotonic() + EXTRACTION_WAIT_SECONDS
+    running = list(docs)
+    while running:
+        progress('extract', len(docs) - len(running), len(docs))
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(EXTRACTION_POLL_SECONDS)
+        # End the transaction so the other worker's commits are visible
+        db.session.commit()
+        running = [doc for doc in running if doc.extraction_status == 'running']
+    return running
+
+def _prepare_inputs(project_id, user_id, progress, force=False, usage=None):
+    """Load the outline and supporting text of a project.
+
+    The timeline is only rebuilt when the outline or the documents changed
+    since the last run (or force is set); supporting documents reuse their
+    stored text. Download
+    and extraction times are recorded on usage, if given.
+    """
+    report = {}
+    stored = {} if force else _stored_fingerprints(project_id)
+
+    # Get outline content; a re-uploaded outline replaces the earlier one
+    outline_doc = Document.query.filter_by(
+        project_id=project_id,
+        file_type='outline'
+    ).order_by(Document.id.desc()).first()
+    if not outline_doc:
+        raise PipelineError('Outline document not found')
+
+    supporting_docs = Document.query.filter_by(
+        project_id=project_id,
+        file_type='supporting'
+    ).all()
+
+    # Supporting documents are normally extracted right after upload; catch up
+    # on any whose background extraction has not started yet (or failed).
+    # Documents being extracted right now are left to their worker
+    pending_docs = [doc for doc in supporting_docs if doc.extraction_status in ('pending', 'failed')]
+    contents = {}
+    if pending_docs:
+        progress('download', 0, len(pending_docs))
+        with metrics.stage('storage_fetch', usage) as timer:
+            contents = get_many_file_contents(user_id, project_id, [doc.filename for doc in pending_docs])
+            timer.add(files=len(pending_docs), bytes=sum(len(content) for content in contents.values() if content))
+        progress('download', len(pending_docs), len(pending_docs))
+    try:
+        for i, doc in enumerate(pending_docs):
+            progress('extract', i, len(pending_docs))
+            pdf_content = contents.pop(doc.filename, None)
+            try:
+                extract_document(doc, user_id, pdf_content=pdf_content, usage=usage)
+            finally:
+                release_content(pdf_content)
+    finally:
+        for pdf_content in contents.values():
+            release_content(pdf_content)
+    progress('extract', len(pending_docs), len(pending_docs))
+
+    skipped = _wait_for_extractions([doc for doc in supporting_docs if doc.extraction_status == 'running'],
+                                    progress)
+    if skipped:
+        logger.warning(f"Processing project {project_id} without {len(skipped)} document(s) still being extracted")
+    report['extract'] = {
+        'reused': len(supporting_docs) - len(pending_docs) - len(skipped),
+        'recomputed': len(pending_docs),
+        'skipped': sorted(doc.filename for doc in skipped)
+    }
+
+    extracted_docs = [doc for doc in supporting_docs if doc.extraction_status == 'done']
+    documents = [(doc.content_hash, get_document_text(doc)) for doc in extracted_docs]
+    if not any(text.strip() for _, text in documents):
+        raise PipelineError('No readable supporting documents found')
+
+    if NARRATIVE_CONTEXT_MODE == 'retrieval':
+        context_version = (embedding_model(), EMBEDDING_DIMENSIONS, PASSAGE_VERSION,
+                           RETRIEVAL_PASSAGE_TOKENS, RETRIEVAL_PASSAGES_PER_ENTRY)
+    else:
+        context_version = (SUMMARY_PROMPT_VERSION, SUMMARY_MODEL)
+
+    # Exhibit filenames carry dates, and so do the summaries or passages the
+    # narrative is built from, so they are all timeline inputs too
+    filenames = sorted(doc.filename for doc in supporting_docs)
+
+    def timeline_fingerprint_of(outline_hash):
+        return fingerprint(outline_hash, TIMELINE_VERSION, *filenames, NARRATIVE_CONTEXT_MODE, *context_version,
+                           *(document_hash for document_hash, _ in documents))
+
+    timeline_fingerprint = None
+    if outline_doc.content_hash:
+        timeline_fingerprint = timeline_fingerprint_of(outline_doc.content_hash)
+
+    events = None
+    output = Output.query.filter_by(project_id=project_id).first()
+    if output and timeline_fingerprint and stored.get('timeline') == timeline_fingerprint:
+        timeline_content = output.timeline_content
+        report['timeline'] = 'reused'
+    else:
+        progress('download', 0, 1)
+        with metrics.stage('storage_fetch', usage) as timer:
+            outline_content = get_file_content(user_id, project_id, outline_doc.filename)
+            timer.add(files=1, bytes=len(outline_content or b''))
+        if not outline_content:
+            raise PipelineError('Could not read outline content')
+        progress('download', 1, 1)
+        try:
+            if not outline_doc.content_hash:
+                # Uploaded before hashes were recorded
+                outline_doc.content_hash = hashlib.sha256(outline_content).hexdigest()
+                timeline_fingerprint = timeline_fingerprint_of(outline_doc.content_hash)
+
+            # Parse, order and merge the outline and exhibit events; the dates in
+            # the documents' evidence are added once it has been gathered
+            events = outline_events(outline_content, filenames)
+        finally:
+            release_content(outline_content)
+        if events is None:
+            raise PipelineError('Error processing outline')
+        timeline_content = render_markdown(events)
+        report['timeline'] = 'recomputed'
+
+    fingerprints = {
+        'timeline': timeline_fingerprint,
+        'narrative': fingerprint(
+            timeline_fingerprint,
+            NARRATIVE_PROMPT_VERSION, NARRATIVE_MODEL, NARRATIVE_CONTEXT_TOKENS
+        )
+    }
+    return ProjectInputs(timeline_content, events, documents, [doc.filename for doc in extracted_docs],
+                         fingerprints, stored, report)
+
+def _save_output(project_id, timeline_content, narrative_content, fingerprints=None, events=None, partial=False):
+    """Save new content as the project's next output version; partial
+    content (a narrative still streaming) is saved as a draft of it"""
+    output = Output.query.filter_by(project_id=project_id).first()
+    if not output:
+        output = Output(project_id=project_id, version=0)
+        db.session.add(output)
+    if partial:
+        versions.record_unversioned(output)
+        output.set_content(timeline_content, narrative_content, new_version=False)
+    else:
+        previous = versions.previous_content(output)
+        output.set_content(timeline_content, narrative_content)
+        versions.record_version(output, previous)
+    if events is not None:
+        save_events(project_id, events)
+    if fingerprints:
+        _store_fingerprints(project_id, fingerprints)
+    # A partial narrative, or a timeline and narrative written around failed
+    # summaries, must never be mistaken for up-to-date ones
+    stale = ['narrative'] if fingerprints is None else [stage for stage in STAGES if stage not in fingerprints]
+    if stale:
+        StageFingerprint.query.filter(
+            StageFingerprint.project_id == project_id,
+            StageFingerprint.stage.in_(stale)
+        ).delete(synchronize_session=False)
+
+    db.session.commit()
+    return output
+
+def restore_output(project_id, version):
+    """Save an earlier version's content as the project's newest version"""
+    output = Output.query.filter_by(project_id=project_id).first()
+    if not output:
+        raise versions.VersionError('No output found')
+    timeline_content, narrative_content = versions.get_version(output, version)
+    output = _save_output(project_id, timeline_content, narrative_content)
+    # Neither stage's stored result now matches its fingerprint
+    StageFingerprint.query.filter_by(project_id=project_id).delete()
+    db.session.commit()
+    return output
+
+def discard_draft(project_id):
+    """Put the project's latest version back in its Output, in place of the
+    draft of a narrative stream that failed or was cut off"""
+    output = Output.query.filter_by(project_id=project_id).first()
+    if output is None:
+        return
+    previous = versions.previous_content(output)
+    if previous is None:
+        # The draft of the project's first version; there is nothing to go back to
+        db.session.delete(output)
+    else:
+        output.set_content(*previous, new_version=False)
+    db.session.commit()
+
+def _narrative_fingerprints(inputs, usage):
+    """The fingerprints to store with a new narrative. A narrative written
+    while some document summaries failed gets no narrative fingerprint, nor
+    does a timeline rebuilt from them, so the next run writes them again
+    instead of reusing them."""
+    if usage.to_dict()['counters'].get('summary_errors'):
+        rebuilt = {'narrative'} if inputs.events is None else {'timeline', 'narrative'}
+        return {stage: value for stage, value in inputs.fingerprints.items() if stage not in rebuilt}
+    return inputs.fingerprints
+
+def _context_report(usage, failed):
+    """Per-document work behind the narrative prompt: summaries or passage
+    embeddings, and the documents left out because their summary failed"""
+    counters = usage.to_dict()['counters']
+    prefix = 'embedding' if NARRATIVE_CONTEXT_MODE == 'retrieval' else 'summary'
+    return {
+        'reused': counters.get(f'{prefix}_cache_hits', 0),
+        'recomputed': counters.get(f'{prefix}_cache_misses', 0),
+        'failed': failed
+    }
+
+def process_project(project_id, user_id, progress=None, usage=None, force=False, report=None):
+    """Build the timeline and narrative for a project and save them to its Output.
+
+    Runs outside of a request (from the job queue), so everything it needs is
+    passed in explicitly. progress is called as progress(stage, current, total);
+    usage, if given, is a TokenUsage that collects LLM token counts per stage.
+
+    Stages whose input fingerprints match the last run are skipped unless
+    force is set; if report is given it is filled with what was reused and
+    what was recomputed.
+    """
+    progress = progress or _noop_progress
+    usage = usage if usage is not None else TokenUsage(tenant=(user_id, project_id))
+    report = report if report is not None else {}
+
+    inputs = _prepare_inputs(project_id, user_id, progress, force=force, usage=usage)
+    report.update(inputs.report)
+
+    if inputs.is_current('narrative'):
+        # Same outline, same documents, same prompts: nothing to regenerate
+        report[CONTEXT_STAGE] = {'reused': len(inputs.documents), 'recomputed': 0, 'failed': []}
+        report['narrative'] = 'reused'
+        return Output.query.filter_by(project_id=project_id).first()
+
+    # Generate narrative using GPT-4
+    evidence = []
+    failed = []
+    try:
+        narrative_content = generate_narrative(inputs.timeline_content, inputs.documents, progress=progress,
+                                               usage=usage, evidence=evidence, failed=failed)
+    except Exception as e:
+        logger.error(f"Error generating narrative: {str(e)}")
+        raise PipelineError(f'Error generating narrative: {str(e)}') from e
+    finally:
+        report[CONTEXT_STAGE] = _context_report(usage, inputs.names_of(failed))
+    if not narrative_content:
+        raise PipelineError('Error generating narrative')
+    report['narrative'] = 'recomputed'
+    inputs.add_evidence_events(evidence)
+
+    # Save output
+    progress('save', 0, 1)
+    with metrics.stage('save', usage):
+        output = _save_output(project_id, inputs.timeline_content, narrative_content,
+                              _narrative_fingerprints(inputs, usage), inputs.events)
+    progress('save', 1, 1)
+    return output
+
+def stream_project_narrative(app, project_id, user_id, usage=None, on_finish=None):
+    """Run the pipeline on a background thread, yielding its events.
+
+    Yields ('progress', {...}) while preparing and summarizing, ('token', text)
+    for each piece of the narrative as the model produces it, and finally
+    ('done', {...}) or ('error', {...}). The partial narrative is written to
+    the project's Output as a draft every STREAM_PERSIST_SECONDS, and the
+    run finishes and saves even if the consumer stops reading (e.g. the
+    browser goes away); if it fails, the draft is replaced by the latest
+    version again. A ('ping', {}) event is yielded after
+    STREAM_KEEPALIVE_SECONDS of silence. on_finish, if given, is called in
+    the app context once the run has ended, with None or the error message.
+    """
+    usage = usage if usage is not None else TokenUsage(tenant=(user_id, project_id))
+    events = queue.Queue()
+
+    def progress(stage, current=0, total=0):
+        events.put(('progress', {'stage': stage, 'current': current, 'total': total}))
+
+    def run():
+        with app.app_context():
+            drafted = False
+            error = None
+            try:
+                # The user asked for a fresh narrative, so that stage always
+                # runs; the timeline and summaries are still reused if current
+                inputs = _prepare_inputs(project_id, user_id, progress, usage=usage)
+                evidence = []
+                failed = []
+                prompt = build_narrative_prompt(inputs.timeline_content, inputs.documents, progress=progress,
+                                                usage=usage, evidence=evidence, failed=failed)
+                inputs.add_evidence_events(evidence)
+                pieces = []
+                last_saved = time.monotonic()
+                for piece in stream_narrative(prompt, usage=usage):
+                    pieces.append(piece)
+                    events.put(('token', piece))
+                    if time.monotonic() - last_saved >= STREAM_PERSIST_SECONDS:
+                        _save_output(project_id, inputs.timeline_content, "".join(pieces), partial=True)
+                        drafted = True
+                        last_saved = time.monotonic()
+
+                narrative_content = "".join(pieces)
+                if not narrative_content:
+                    raise PipelineError('Error generating narrative')
+                # Rebuilt timeline events go in with the finished version only
+                _save_output(project_id, inputs.timeline_content, narrative_content,
+                             _narrative_fingerprints(inputs, usage), inputs.events)
+            except PipelineError as e:
+                db.session.rollback()
+                error = str(e)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error streaming narrative: {str(e)}")
+                error = f'Server error: {str(e)}'
+            try:
+                if error and drafted:
+                    discard_draft(project_id)
+                if on_finish:
+                    on_finish(error)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error finishing narrative stream: {str(e)}")
+            finally:
+                db.session.remove()
+            # Only once the run's job is settled, so a new one can start
+            events.put(('error', {'message': error}) if error else
+                       ('done', {'length': len(narrative_content), 'failed': inputs.names_of(failed)}))
+
+    threading.Thread(target=run, name=f'narrative-stream-{project_id}', daemon=True).start()
+
+    while True:
+        try:
+            event = events.get(timeout=STREAM_KEEPALIVE_SECONDS)
+        except queue.Empty:
+            # Nothing new (e.g. long summaries); let proxies know we are alive
+            yield ('ping', {})
+            continue
+        yield event
+        if event[0] in ('done', 'error'):
+            return
+
+# Runs of stream_project_narrative_async, kept referenced until they finish
+_stream_tasks = set()
+
+def run_in_app_context(app, func, *args, **kwargs):
+    """Call func on a worker thread's own session, in the app context"""
+    with app.app_context():
+        try:
+            return func(*args, **kwargs)
+        except BaseException:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+async def stream_project_narrative_async(app, project_id, user_id, usage=None, on_finish=None):
+    """stream_project_narrative for the ASGI server, yielding the same events.
+
+    The narrative is streamed from the async client on the event loop, so a
+    run waiting on the model holds no thread. Preparing the inputs and the
+    prompt (database, storage and embedding calls), each save and on_finish
+    still run the sync code on the loop's worker threads. The run is a task
+    of its own, so it finishes and saves even if the consumer stops reading.
+    """
+    usage = usage if usage is not None else TokenUsage(tenant=(user_id, project_id))
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def progress(stage, current=0, total=0):
+        # Called from worker threads
+        loop.call_soon_threadsafe(events.put_nowait, ('progress', {'stage': stage, 'current': current, 'total': total}))
+
+    def prepare():
+        inputs = _prepare_inputs(project_id, user_id, progress, usage=usage)
+        evidence = []
+        failed = []
+        prompt = build_narrative_prompt(inputs.timeline_content, inputs.documents, progress=progress, usage=usage,
+                                        evidence=evidence, failed=failed)
+        inputs.add_evidence_events(evidence)
+        # Keep anything backfilled while preparing (e.g. the outline's hash)
+        db.session.commit()
+        return inputs, prompt, inputs.names_of(failed)
+
+    def save(*args, **kwargs):
+        return run_in_app_context(app, _save_output, project_id, *args, **kwargs)
+
+    def finish(error, drafted):
+        if error and drafted:
+            discard_draft(project_id)
+        if on_finish:
+            on_finish(error)
+
+    async def run():
+        drafted = False
+        error = None
+        try:
+            inputs, prompt, failed = await asyncio.to_thread(run_in_app_context, app, prepare)
+            pieces = []
+            last_saved = time.monotonic()
+            async for piece in stream_narrative_async(prompt, usage=usage):
+                pieces.append(piece)
+                events.put_nowait(('token', piece))
+                if time.monotonic() - last_saved >= STREAM_PERSIST_SECONDS:
+                    await asyncio.to_thread(save, inputs.timeline_content, "".join(pieces), partial=True)
+                    drafted = True
+                    last_saved = time.monotonic()
+
+            narrative_content = "".join(pieces)
+            if not narrative_content:
+                raise PipelineError('Error generating narrative')
+            await asyncio.to_thread(save, inputs.timeline_content, narrative_content,
+                                    _narrative_fingerprints(inputs, usage), inputs.events)
+        except PipelineError as e:
+            error = str(e)
+        except Exception as e:
+            logger.error(f"Error streaming narrative: {str(e)}")
+            error = f'Server error: {str(e)}'
+        try:
+            await asyncio.to_thread(run_in_app_context, app, finish, error, drafted)
+        except Exception as e:
+            logger.error(f"Error finishing narrative stream: {str(e)}")
+        events.put_nowait(('error', {'message': error}) if error else
+                          ('done', {'length': len(narrative_content), 'failed': failed}))
+
+    task = asyncio.create_task(run(), name=f'narrative-stream-{project_id}')
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+
+    while True:
+        try:
+            event = await asyncio.wait_for(events.get(), STREAM_KEEPALIVE_SECONDS)
+        except asyncio.TimeoutError:
+            yield ('ping', {})
+            continue
+        yield event
+        if event[0] in ('done', 'error'):
+            return
@@ -0,0 +1,222 @@
+"""Rate limiting and fair scheduling of LLM calls across users and projects.
+
+Every completion and embedding call first takes a reservation from the
+process-wide scheduler: one request from the requests-per-minute bucket and
+its estimated tokens from the tokens-per-minute bucket. Both buckets refill
+continuously. When they are empty, calls wait in line instead of running
+into the API's rate limits, and the line is served round robin: one call per
+waiting user in turn, and within a user one call per project in turn. A
+40-document project therefore shares capacity with a one-document project
+instead of going first.
+
+Estimates are settled with the real token count once a call returns, so the
+tokens bucket tracks actual usage (it may go below zero after an underestimate,
+which simply delays the next call). A rate-limit response from the API pauses
+the whole line for the retry delay.
+
+Budgets are per process: with several worker processes sharing one API key,
+set LLM_REQUESTS_PER_MINUTE and LLM_TOKENS_PER_MINUTE to the key's limits
+divided by the number of processes. 0 turns a budget off.
+"""
+import os
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from utils import metrics
+
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get('LLM_REQUESTS_PER_MINUTE', '500'))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get('LLM_TOKENS_PER_MINUTE', '80000'))
+
+# Calls made outside any job (e.g. the batch CLI) share this tenant
+DEFAULT_TENANT = (None, None)
+
+# Waiters re-check the buckets at least this often
+_MAX_SLEEP_SECONDS = 1.0
+
+class TokenBucket:
+    """per_minute units, refilled continuously"""
+
+    __slots__ = ('capacity', 'rate', 'level', 'updated')
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        """Seconds until amount is available"""
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+class _Waiter:
+    __slots__ = ('tokens', 'granted')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.granted = threading.Event()
+
+class Reservation:
+    """Capacity taken for one call; settle() it with the tokens actually used"""
+
+    __slots__ = ('scheduler', 'tokens', 'waited')
+
+    def __init__(self, scheduler, tokens, waited):
+        self.scheduler = scheduler
+        self.tokens = tokens
+        self.waited = waited
+
+    def settle(self, actual_tokens):
+        if actual_tokens is not None:
+            self.scheduler._adjust_tokens(actual_tokens - self.tokens)
+
+class FairScheduler:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self._lock = threading.Lock()
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        # user -> project -> waiters, each ring in service order
+        self._line = OrderedDict()
+        self._depth = 0
+        self._paused_until = 0.0
+        self._next_delay = 0.0
+
+    @property
+    def enabled(self):
+        return self._requests is not None or self._tokens is not None
+
+    def acquire(self, tenant, tokens):
+        """Wait for capacity for one call of about tokens tokens.
+
+        tenant is a (user_id, project_id) pair. Returns a Reservation; the
+        wait is never abandoned, so a busy period delays calls but does not
+        fail them.
+        """
+        if not self.enabled:
+            return Reservation(self, tokens, 0.0)
+        started = time.monotonic()
+        waiter = self._enqueue(tenant, tokens)
+        while not waiter.granted.is_set():
+            waiter.granted.wait(self._poll_interval())
+            with self._lock:
+                self._dispatch()
+        return Reservation(self, tokens, time.monotonic() - started)
+
+    async def acquire_async(self, tenant, tokens):
+        """acquire() for coroutines: the wait sleeps on the event loop instead
+        of blocking a thread, in the same line as every other call"""
+        if not self.enabled:
+            return Reservation(self, tokens, 0.0)
+        started = time.monotonic()
+        waiter = self._enqueue(tenant, tokens)
+        while not waiter.granted.is_set():
+            await asyncio.sleep(self._poll_interval())
+            with self._lock:
+                self._dispatch()
+        return Reservation(self, tokens, time.monotonic() - started)
+
+    def _enqueue(self, tenant, tokens):
+        user, project = tenant or DEFAULT_TENANT
+        waiter = _Waiter(tokens)
+        with self._lock:
+            self._line.setdefault(user, OrderedDict()).setdefault(project, deque()).append(waiter)
+            self._depth += 1
+            self._dispatch()
+        return waiter
+
+    def _poll_interval(self):
+        return min(max(self._next_delay, 0.005), _MAX_SLEEP_SECONDS)
+
+    def _dispatch(self):
+        """Grant calls round robin while the buckets allow; call with the lock held"""
+        now = time.monotonic()
+        for bucket in (self._requests, self._tokens):
+            if bucket is not None:
+                bucket.refill(now)
+        while self._line:
+            if now < self._paused_until:
+                self._next_delay = self._paused_until - now
+                break
+            user, projects = next(iter(self._line.items()))
+            project, waiters = next(iter(projects.items()))
+            waiter = waiters[0]
+            # A call larger than the whole budget goes once the bucket is full
+            cost = min(waiter.tokens, self._tokens.capacity) if self._tokens is not None else 0
+            delay = max(self._requests.delay(1) if self._requests is not None else 0.0,
+                        self._tokens.delay(cost) if self._tokens is not None else 0.0)
+            if delay > 0:
+                self._next_delay = delay
+                break
+            if self._requests is not None:
+                self._requests.level -= 1
+            if self._tokens is not None:
+                self._tokens.level -= waiter.tokens
+            waiters.popleft()
+            self._depth -= 1
+            waiter.granted.set()
+
+            # Next turn goes to this user's next project, then to the next user
+            if waiters:
+                projects.move_to_end(project)
+            else:
+                del projects[project]
+            if projects:
+                self._line.move_to_end(user)
+            else:
+                del self._line[user]
+        metrics.LLM_QUEUE_DEPTH.set(self._depth)
+
+    def _adjust_tokens(self, amount):
+        if self._tokens is None or not amount:
+            return
+        with self._lock:
+            self._tokens.level -= amount
+
+    def pause(self, seconds):
+        """Hold every waiting call for seconds, e.g. after the API returned 429"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def status(self, user_id=None):
+        """Queue depth and a rough wait estimate for user_id's next call.
+
+        Under round robin every other waiting user gets about as many turns
+        as user_id has calls queued (at least one), so that many calls, and
+        their tokens, go before user_id's queue is through.
+        """
+        with self._lock:
+            now = time.monotonic()
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.refill(now)
+            sizes = {
+                user: (sum(len(waiters) for waiters in projects.values()),
+                       sum(waiter.tokens for waiters in projects.values() for waiter in waiters))
+                for user, projects in self._line.items()
+            }
+            own_calls = sizes.get(user_id, (0, 0))[0]
+            turns = max(own_calls, 1)
+            calls_ahead, tokens_ahead = 0, 0
+            for user, (calls, tokens) in sizes.items():
+                share = min(calls, turns) if user != user_id else calls
+                calls_ahead += share
+                tokens_ahead += tokens * share // calls if calls else 0
+            wait = max(0.0, self._paused_until - now)
+            if self._requests is not None:
+                wait = max(wait, (calls_ahead - self._requests.level) / self._requests.rate)
+            if self._tokens is not None:
+                wait = max(wait, (tokens_ahead - self._tokens.level) / self._tokens.rate)
+            return {
+                'queued_calls': self._depth,
+                'queued_calls_for_user': own_calls,
+                'waiting_users': len(self._line),
+                'estimated_wait_seconds': round(max(wait, 0.0), 1)
+            }
+
+scheduler = FairScheduler(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
@@ -0,0 +1,277 @@
+"""Server-side rendering and export of a project's narrative and timeline.
+
+Markdown output is converted once to HTML with the markdown package and from
+that HTML to a standalone HTML page, a DOCX (python-docx) or a PDF (fpdf2).
+Rendered artifacts are cached in the render_cache table keyed by the
+output's content hash, the format, the title and RENDER_VERSION, so an
+unchanged brief is rendered once and every later view or download is a
+lookup. The cache is least-recently-used, bounded by total size.
+
+DOCX and PDF need the optional "export" dependencies; HTML needs nothing
+beyond the app's own. Raw HTML in the model's markdown is escaped, never
+passed through, so the HTML can be shown in the browser as it is.
+"""
+import os
+import re
+import html
+import hashlib
+import logging
+from datetime import datetime
+from html.parser import HTMLParser
+from io import BytesIO
+import markdown
+from sqlalchemy.orm import undefer
+from models import db, RenderCache
+from utils.summary_cache import cache_enabled
+
+try:
+    import docx
+except ImportError:  # DOCX export unavailable
+    docx = None
+
+try:
+    import fpdf
+except ImportError:  # PDF export unavailable
+    fpdf = None
+
+logger = logging.getLogger(__name__)
+
+# Uncached DOCX/PDF exports of longer markdown are rendered by a background job
+EXPORT_BACKGROUND_MIN_CHARS = int(os.environ.get('EXPORT_BACKGROUND_MIN_CHARS', '50000'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+# A TrueType font for PDFs; without one the core Helvetica font is used and
+# characters outside Latin-1 are replaced
+EXPORT_PDF_FONT = os.environ.get('EXPORT_PDF_FONT')
+# Bump when any renderer changes so cached artifacts are rebuilt
+RENDER_VERSION = '1'
+
+KINDS = ('narrative', 'timeline')
+MIMETYPES = {
+    'html': 'text/html; charset=utf-8',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'pdf': 'application/pdf',
+}
+# The HTML fragment shown in the app; cached like the exports but not downloadable
+FRAGMENT = 'fragment'
+
+_HTML_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: Georgia, "Times New Roman", serif; line-height: 1.5; max-width: 46em; margin: 2em auto; padding: 0 1em; }}
+h1, h2, h3 {{ line-height: 1.2; }}
+blockquote {{ margin-left: 0; padding-left: 1em; border-left: 3px solid #ccc; color: #444; }}
+@media print {{ body {{ margin: 0; max-width: none; }} }}
+</style>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+# Typographic characters the core PDF fonts lack, spelled in Latin-1
+_LATIN1_FOLDS = str.maketrans({
+    '‘': "'", '’': "'", '“': '"', '”': '"', '–': '-', '—': '--',
+    '…': '...', '•': '\xb7', '−': '-',
+})
+_UNSAFE_FILENAME = re.compile(r'[^A-Za-z0-9._ -]+')
+
+class ExportUnavailable(Exception):
+    """The format's optional dependency is not installed"""
+
+def format_available(fmt):
+    if fmt == 'docx':
+        return docx is not None
+    if fmt == 'pdf':
+        return fpdf is not None
+    return fmt in ('html', FRAGMENT)
+
+def markdown_to_html(text):
+    """HTML fragment for markdown text, with any raw HTML in it escaped"""
+    md = markdown.Markdown(extensions=['sane_lists'])
+    md.preprocessors.deregister('html_block')
+    md.inlinePatterns.deregister('html')
+    return md.convert(text or '')
+
+def render_html(title, fragment):
+    return _HTML_PAGE.format(title=html.escape(title), body=fragment).encode('utf-8')
+
+class _DocxBuilder(HTMLParser):
+    """Adds the paragraphs of a markdown HTML fragment to a python-docx Document"""
+
+    _HEADINGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+    def __init__(self, document):
+        super().__init__()
+        self.document = document
+        self.paragraph = None
+        self.lists = []
+        self.items = 0
+        self.quotes = 0
+        self.bold = self.italic = self.code = 0
+
+    def _list_style(self):
+        level = min(len(self.lists), 3)
+        base = 'List Number' if self.lists[-1] == 'ol' else 'List Bullet'
+        return base if level == 1 else f'{base} {level}'
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('ul', 'ol'):
+            self.lists.append(tag)
+        elif tag == 'li':
+            self.items += 1
+            self.paragraph = self.document.add_paragraph(style=self._list_style())
+        elif tag in self._HEADINGS:
+            self.paragraph = self.document.add_heading(level=int(tag[1]))
+        elif tag == 'p' and not self.items:
+            self.paragraph = self.document.add_paragraph(style='Quote' if self.quotes else None)
+        elif tag == 'blockquote':
+            self.quotes += 1
+        elif tag in ('strong', 'b'):
+            self.bold += 1
+        elif tag in ('em', 'i'):
+            self.italic += 1
+        elif tag == 'code':
+            self.code += 1
+        elif tag == 'br' and self.paragraph is not None:
+            self.paragraph.add_run().add_break()
+
+    def handle_endtag(self, tag):
+        if tag in ('ul', 'ol'):
+            self.lists.pop()
+        elif tag == 'li':
+            self.items -= 1
+            self.paragraph = None
+        elif tag in self._HEADINGS or (tag == 'p' and not self.items):
+            self.paragraph = None
+        elif tag == 'blockquote':
+            self.quotes -= 1
+        elif tag in ('strong', 'b'):
+            self.bold -= 1
+        elif tag in ('em', 'i'):
+            self.italic -= 1
+        elif tag == 'code':
+            self.code -= 1
+
+    def handle_data(self, data):
+        if self.paragraph is None:
+            if not data.strip():
+                return
+            self.paragraph = self.document.add_paragraph()
+        run = self.paragraph.add_run(data.replace('\n', ' '))
+        run.bold = bool(self.bold) or None
+        run.italic = bool(self.italic) or None
+        if self.code:
+            run.font.name = 'Courier New'
+
+def render_docx(title, fragment):
+    if docx is None:
+        raise ExportUnavailable("DOCX export needs the 'export' extra (python-docx)")
+    document = docx.Document()
+    document.core_properties.title = title
+    _DocxBuilder(document).feed(fragment)
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def render_pdf(title, fragment):
+    if fpdf is None:
+        raise ExportUnavailable("PDF export needs the 'export' extra (fpdf2)")
+    pdf = fpdf.FPDF(format='Letter')
+    pdf.set_title(title)
+    pdf.set_margins(25, 25)
+    pdf.set_auto_page_break(True, margin=25)
+    if EXPORT_PDF_FONT:
+        pdf.add_font('Export', fname=EXPORT_PDF_FONT)
+        pdf.set_font('Export', size=11)
+        font_family = 'Export'
+    else:
+        fragment = fragment.translate(_LATIN1_FOLDS).encode('latin-1', 'replace').decode('latin-1')
+        pdf.set_font('Helvetica', size=11)
+        font_family = 'Helvetica'
+    pdf.add_page()
+    pdf.write_html(fragment, font_family=font_family)
+    return bytes(pdf.output())
+
+_RENDERERS = {
+    FRAGMENT: lambda title, fragment: fragment.encode('utf-8'),
+    'html': render_html,
+    'docx': render_docx,
+    'pdf': render_pdf,
+}
+
+def render(text, fmt, title):
+    """Bytes of markdown text rendered as fmt"""
+    return _RENDERERS[fmt](title, markdown_to_html(text))
+
+def make_render_key(content_hash, kind, fmt, title):
+    return hashlib.sha256(f"{content_hash}:{kind}:{fmt}:{title}:{RENDER_VERSION}".encode('utf-8')).hexdigest()
+
+def export_filename(title, kind, fmt):
+    name = _UNSAFE_FILENAME.sub('', title).strip() or 'brief'
+    return f"{name} - {kind}.{fmt}"
+
+def get_rendered(cache_key):
+    """Cached bytes for cache_key, or None; marks the entry used"""
+    if not cache_enabled():
+        return None
+    entry = RenderCache.query.options(undefer(RenderCache.data)).filter_by(cache_key=cache_key).first()
+    if entry is None:
+        return None
+    entry.last_used_at = datetime.utcnow()
+    db.session.commit()
+    return entry.data
+
+def store_rendered(cache_key, content_hash, kind, fmt, data):
+    if not cache_enabled():
+        return
+    try:
+        db.session.add(RenderCache(
+            cache_key=cache_key,
+            content_hash=content_hash,
+            kind=kind,
+            format=fmt,
+            data=data,
+            size_bytes=len(data)
+        ))
+        db.session.commit()
+    except Exception as e:
+        # Most likely a concurrent request rendered the same artifact first
+        db.session.rollback()
+        logger.warning(f"Could not cache rendered {kind}.{fmt} {cache_key[:12]}: {str(e)}")
+        return
+    evict_rendered()
+
+def evict_rendered(max_bytes=None):
+    """Drop the least recently used artifacts beyond max_bytes in total"""
+    max_bytes = RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    total, stale = 0, []
+    rows = db.session.query(RenderCache.id, RenderCache.size_bytes).order_by(RenderCache.last_used_at.desc())
+    for entry_id, size in rows:
+        total += size
+        if total > max_bytes:
+            stale.append(entry_id)
+    if stale:
+        RenderCache.query.filter(RenderCache.id.in_(stale)).delete(synchronize_session=False)
+        logger.info(f"Evicted {len(stale)} rendered exports")
+    db.session.commit()
+    return len(stale)
+
+def output_hash(output, kind):
+    return output.timeline_hash if kind == 'timeline' else output.narrative_hash
+
+def output_text(output, kind):
+    return output.timeline_content if kind == 'timeline' else output.narrative_content
+
+def render_output(output, kind, fmt, title):
+    """(cache key, bytes) of an Output's narrative or timeline as fmt, from the cache if rendered before"""
+    content_hash = output_hash(output, kind)
+    cache_key = make_render_key(content_hash, kind, fmt, title)
+    data = get_rendered(cache_key)
+    if data is None:
+        data = render(output_text(output, kind), fmt, title)
+        store_rendered(cache_key, content_hash, kind, fmt, data)
+    return cache_key, data
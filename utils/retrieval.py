@@ -0,0 +1,213 @@
+"""Passage retrieval for the narrative prompt.
+
+Rather than summarizing every exhibit and pasting all the summaries into the
+narrative prompt, each document is split into short passages (a page or part
+of one) which are embedded once and cached by the document's sha256. When a
+narrative is written, every timeline entry is embedded as a query and only
+the best-matching passages are put in the prompt, up to a fixed token budget,
+so the prompt stays the same size however many exhibits a project has.
+
+Vectors are kept as packed float32 (array('f')), both in the cache and in the
+per-run VectorIndex. numpy is used for scoring when installed; without it a
+pure-Python dot product does the same job, only slower.
+"""
+import os
+import re
+import heapq
+import hashlib
+import logging
+import math
+import zlib
+from array import array
+from datetime import datetime, timedelta
+from models import db, EmbeddingCache
+from utils.chunking import PAGE_BREAK, chunk_text, count_tokens
+from utils.summary_cache import cache_enabled
+
+try:
+    import numpy
+except ImportError:  # scored with plain Python instead
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_PASSAGE_TOKENS = int(os.environ.get('RETRIEVAL_PASSAGE_TOKENS', '150'))
+RETRIEVAL_PASSAGES_PER_ENTRY = int(os.environ.get('RETRIEVAL_PASSAGES_PER_ENTRY', '3'))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', '5000'))
+EMBEDDING_CACHE_MAX_AGE_DAYS = int(os.environ.get('EMBEDDING_CACHE_MAX_AGE_DAYS', '90'))
+# Bump when document_passages changes so cached passages are rebuilt
+PASSAGE_VERSION = '1'
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were with".split()
+)
+
+def hashed_embedding(text, dimensions):
+    """Local stand-in for an embedding model: hashed word and bigram counts.
+
+    Deterministic and dependency-free, so tests and offline runs retrieve
+    passages that share vocabulary with the query without calling an API.
+    """
+    words = [word for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+    vector = [0.0] * dimensions
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vector[h % dimensions] += 1.0 if h & 0x80000000 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+def document_passages(text):
+    """Split extracted text into [page_number, tokens, text] passages of at most RETRIEVAL_PASSAGE_TOKENS"""
+    passages = []
+    for page_number, page in enumerate(text.split(PAGE_BREAK), 1):
+        for chunk in chunk_text(page, RETRIEVAL_PASSAGE_TOKENS):
+            passages.append([page_number, count_tokens(chunk), chunk])
+    return passages
+
+def pack_vectors(vectors):
+    packed = array('f')
+    for vector in vectors:
+        packed.extend(vector)
+    return packed.tobytes()
+
+def timeline_entries(timeline_content):
+    """The events of a timeline built by process_outline, one per '- ' line"""
+    return [line[2:].strip() for line in timeline_content.splitlines() if line.startswith('- ') and line[2:].strip()]
+
+class VectorIndex:
+    """Unit vectors and their payloads, searched by dot product (cosine similarity)"""
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.payloads = []
+        self._vectors = array('f')
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def add(self, vectors, payloads):
+        """Add vectors, given as packed float32 bytes or as lists of floats"""
+        if isinstance(vectors, (bytes, bytearray, memoryview)):
+            self._vectors.frombytes(vectors)
+        else:
+            for vector in vectors:
+                self._vectors.extend(vector)
+        self.payloads.extend(payloads)
+        if len(self._vectors) != len(self.payloads) * self.dimensions:
+            raise ValueError('vector count does not match payload count')
+
+    def search(self, queries, k):
+        """For each query vector, [(score, position), ...] of the k best matches, best first"""
+        k = min(k, len(self.payloads))
+        if not queries or k <= 0:
+            return [[] for _ in queries]
+        if numpy is not None:
+            matrix = numpy.frombuffer(self._vectors, dtype=numpy.float32).reshape(-1, self.dimensions)
+            scores = numpy.asarray(queries, dtype=numpy.float32) @ matrix.T
+            top = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for row, positions in zip(scores, top):
+                ranked = sorted(positions.tolist(), key=lambda position: -row[position])
+                results.append([(float(row[position]), position) for position in ranked])
+            return results
+
+        d = self.dimensions
+        rows = [self._vectors[start:start + d] for start in range(0, len(self._vectors), d)]
+        return [
+            heapq.nlargest(k, ((sum(a * b for a, b in zip(query, row)), position) for position, row in enumerate(rows)))
+            for query in queries
+        ]
+
+def select_evidence(index, query_vectors, budget, per_entry=None, header_tokens=None, passage_overhead=0):
+    """Pick passages for each query within a total token budget.
+
+    Passages are taken round by round: every query's best passage first (the
+    strongest matches across all queries first), then every query's second
+    best, and so on up to per_entry each, so each timeline entry gets some
+    evidence before any gets more. A passage is used at most once. Payloads
+    are (document_number, page_number, tokens, text). A passage costs its
+    tokens plus passage_overhead (its citation), and a query's first passage
+    also header_tokens[query] (the line naming the entry). Returns
+    {query_position: [payload, ...]}.
+    """
+    per_entry = RETRIEVAL_PASSAGES_PER_ENTRY if per_entry is None else per_entry
+    # Extra candidates make up for passages already taken by other entries
+    matches = index.search(query_vectors, per_entry * 3)
+    candidates = sorted(
+        (rank, -score, query, position)
+        for query, ranked in enumerate(matches)
+        for rank, (score, position) in enumerate(ranked)
+        if score > 0
+    )
+
+    selected = {}
+    used = set()
+    for _, _, query, position in candidates:
+        if position in used or len(selected.get(query, ())) >= per_entry:
+            continue
+        tokens = index.payloads[position][2] + passage_overhead
+        if header_tokens and query not in selected:
+            tokens += header_tokens[query]
+        if tokens > budget:
+            continue
+        budget -= tokens
+        used.add(position)
+        selected.setdefault(query, []).append(index.payloads[position])
+    return selected
+
+def make_cache_key(document_hash, model, dimensions):
+    return hashlib.sha256(f"{document_hash}:{PASSAGE_VERSION}:{model}:{dimensions}".encode('utf-8')).hexdigest()
+
+def get_cached_embeddings(cache_keys):
+    """Return {cache_key: (passages, packed vectors)} for every key that is cached, marking them used"""
+    keys = set(cache_keys)
+    if not keys or not cache_enabled():
+        return {}
+
+    entries = EmbeddingCache.query.filter(EmbeddingCache.cache_key.in_(keys)).all()
+    now = datetime.utcnow()
+    found = {}
+    for entry in entries:
+        entry.last_used_at = now
+        found[entry.cache_key] = (entry.passages, entry.vectors)
+    db.session.commit()
+    return found
+
+def store_embeddings(cache_key, document_hash, model, dimensions, passages, vectors):
+    if not cache_enabled():
+        return
+    try:
+        db.session.add(EmbeddingCache(
+            cache_key=cache_key,
+            content_hash=document_hash,
+            model=model,
+            dimensions=dimensions,
+            passages=passages,
+            vectors=vectors
+        ))
+        db.session.commit()
+    except Exception as e:
+        # Most likely a concurrent run stored the same key first
+        db.session.rollback()
+        logger.warning(f"Could not cache embeddings {cache_key[:12]}: {str(e)}")
+
+def evict_embeddings(max_entries=None, max_age_days=None):
+    """Drop entries unused for max_age_days, then the least recently used beyond max_entries"""
+    if not cache_enabled():
+        return 0
+    max_entries = EMBEDDING_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    max_age_days = EMBEDDING_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    evicted = EmbeddingCache.query.filter(EmbeddingCache.last_used_at < cutoff).delete(synchronize_session=False)
+
+    overflow = EmbeddingCache.query.count() - max_entries
+    if overflow > 0:
+        oldest = db.session.query(EmbeddingCache.id).order_by(EmbeddingCache.last_used_at).limit(overflow).subquery()
+        evicted += EmbeddingCache.query.filter(EmbeddingCache.id.in_(db.select(oldest.c.id))).delete(synchronize_session=False)
+
+    db.session.commit()
+    if evicted:
+        logger.info(f"Evicted {evicted} cached document embeddings")
+    return evicted
@@ -0,0 +1,148 @@
+"""Full-text search over the extracted pages of a user's documents.
+
+The index lives in the database and is maintained there (see migration
+0009_page_search): a GIN-indexed tsvector column on Postgres, an FTS5 table
+on SQLite. Pages are indexed as extraction stores them, so there is no
+separate indexing step to run or fall behind.
+
+Queries accept plain words (all must match, with stemming) and "quoted
+phrases". Hits are single pages, best first, each with a snippet in which
+matches are wrapped in <mark>; the rest of the snippet is HTML-escaped.
+"""
+import html
+import os
+import re
+from models import db
+
+SEARCH_SNIPPET_WORDS = int(os.environ.get('SEARCH_SNIPPET_WORDS', '24'))
+MAX_SEARCH_RESULTS = 100
+MAX_QUERY_TERMS = 16
+
+# Index objects created by hand in migrations rather than from the models
+SEARCH_INDEX_OBJECTS = ('search_vector', 'ix_document_pages_search', 'document_pages_fts')
+
+# Match markers; ASCII control characters never occur in extracted text
+_START, _STOP = '\x02', '\x03'
+
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r'\w+')
+
+class SearchError(Exception):
+    """A search the user needs to change, e.g. an empty query"""
+
+def is_search_index_object(name):
+    return any(name.startswith(prefix) for prefix in SEARCH_INDEX_OBJECTS)
+
+def parse_query(query):
+    """Split a query into terms, each a list of words (one word, or a phrase)"""
+    terms = []
+    for phrase, word in _TERM.findall(query or ''):
+        words = _WORD.findall(phrase or word)
+        if words:
+            terms.append(words)
+    return terms[:MAX_QUERY_TERMS]
+
+def _fts5_query(terms):
+    # Every term quoted, so nothing the user types is read as FTS5 syntax
+    return " ".join('"' + " ".join(words) + '"' for words in terms)
+
+def _tsquery_text(terms):
+    # websearch_to_tsquery syntax: quoted phrases, implicit AND
+    return " ".join('"' + " ".join(words) + '"' if len(words) > 1 else words[0] for words in terms)
+
+def _format_snippet(snippet):
+    return html.escape(snippet or '').replace(_START, '<mark>').replace(_STOP, '</mark>')
+
+def _scope(project_id):
+    # Pages of a document still being extracted (or re-extracted) are left
+    # out until its extraction is done
+    scope = "AND d.extraction_status = 'done'"
+    return scope + (" AND d.project_id = :project_id" if project_id is not None else "")
+
+def _search_postgres(params, project_id):
+    params['options'] = (
+        f'StartSel={_START}, StopSel={_STOP}, MaxWords={SEARCH_SNIPPET_WORDS}, '
+        f'MinWords={max(SEARCH_SNIPPET_WORDS // 2, 1)}, MaxFragments=2, FragmentDelimiter=" … "'
+    )
+    # Rank and page inside the CTE; headlines, which re-parse the page
+    # text, are only built for the page of results returned
+    sql = f"""
+        WITH q AS (SELECT websearch_to_tsquery('english', :query) AS query),
+        hits AS (
+            SELECT p.id, p.document_id, p.page_number, d.filename, d.project_id, pr.name AS project_name,
+                   ts_rank_cd(p.search_vector, q.query) AS score
+            FROM q, document_pages p
+            JOIN documents d ON d.id = p.document_id
+            JOIN projects pr ON pr.id = d.project_id
+            WHERE p.search_vector @@ q.query AND pr.user_id = :user_id {_scope(project_id)}
+            ORDER BY score DESC, p.id
+            LIMIT :limit OFFSET :offset
+        )
+        SELECT hits.*, ts_headline('english', p.text, q.query, :options) AS snippet
+        FROM q, hits
+        JOIN document_pages p ON p.id = hits.id
+        ORDER BY hits.score DESC, hits.id
+    """
+    return db.session.execute(db.text(sql), params).mappings().all()
+
+def _search_sqlite(params, project_id):
+    sql = f"""
+        SELECT p.id, p.document_id, p.page_number, d.filename, d.project_id, pr.name AS project_name,
+               -bm25(document_pages_fts) AS score
+        FROM document_pages_fts
+        JOIN document_pages p ON p.id = document_pages_fts.rowid
+        JOIN documents d ON d.id = p.document_id
+        JOIN projects pr ON pr.id = d.project_id
+        WHERE document_pages_fts MATCH :query AND pr.user_id = :user_id {_scope(project_id)}
+        ORDER BY bm25(document_pages_fts), p.id
+        LIMIT :limit OFFSET :offset
+    """
+    hits = [dict(row) for row in db.session.execute(db.text(sql), params).mappings()]
+    if not hits:
+        return hits
+
+    # Snippets for the returned page only
+    ids = [hit['id'] for hit in hits]
+    snippet_sql = db.text(f"""
+        SELECT rowid, snippet(document_pages_fts, 0, char(2), char(3), '…', :words) AS snippet
+        FROM document_pages_fts
+        WHERE document_pages_fts MATCH :query AND rowid IN ({", ".join(str(int(i)) for i in ids)})
+    """)
+    snippets = dict(db.session.execute(snippet_sql, {'query': params['query'], 'words': SEARCH_SNIPPET_WORDS}).all())
+    for hit in hits:
+        hit['snippet'] = snippets.get(hit['id'])
+    return hits
+
+def search_pages(user_id, query, project_id=None, limit=20, offset=0):
+    """Pages of user_id's documents matching query, best first.
+
+    Returns (hits, has_more). Each hit is a dict with document_id, filename,
+    project_id, project_name, page_number, score and snippet.
+    """
+    terms = parse_query(query)
+    if not terms:
+        raise SearchError('Enter a word or "a phrase" to search for')
+    limit = max(1, min(limit, MAX_SEARCH_RESULTS))
+    offset = max(0, offset)
+
+    dialect = db.engine.dialect.name
+    params = {'user_id': user_id, 'project_id': project_id, 'limit': limit + 1, 'offset': offset}
+    if dialect == 'postgresql':
+        params['query'] = _tsquery_text(terms)
+        rows = _search_postgres(params, project_id)
+    elif dialect == 'sqlite':
+        params['query'] = _fts5_query(terms)
+        rows = _search_sqlite(params, project_id)
+    else:
+        raise SearchError(f'Search is not available on {dialect}')
+
+    hits = [{
+        'document_id': row['document_id'],
+        'filename': row['filename'],
+        'project_id': row['project_id'],
+        'project_name': row['project_name'],
+        'page_number': row['page_number'],
+        'score': float(f"{float(row['score']):.4g}"),
+        'snippet': _format_snippet(row['snippet'])
+    } for row in rows[:limit]]
+    return hits, len(rows) > limit
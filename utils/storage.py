@@ -1,27 +1,236 @@
-from replit.object_storage import Client
+import abc
+import hashlib
 import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = Client()
+# Which backend stores uploaded files: 'replit' (Replit Object Storage),
+# 'local' (files under LOCAL_STORAGE_ROOT) or 's3' (any S3-compatible service)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'replit')
+LOCAL_STORAGE_ROOT = os.environ.get('LOCAL_STORAGE_ROOT', 'storage')
+LOCAL_STORAGE_MMAP = os.environ.get('LOCAL_STORAGE_MMAP', '0') == '1'
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. a local MinIO for tests
+# Connection pool size for the S3 client and parallelism of get_many
+STORAGE_MAX_CONNECTIONS = int(os.environ.get('STORAGE_MAX_CONNECTIONS', '10'))
 
-def save_to_storage(file_data, key):
+# Uploads are copied through a temporary file in pieces of this size, so
+# memory use does not depend on the size of the file
+STORAGE_CHUNK_SIZE = int(os.environ.get('STORAGE_CHUNK_SIZE', str(1024 * 1024)))
+
+def copy_in_chunks(src, dest, chunk_size=STORAGE_CHUNK_SIZE, digest=None):
+    """Copy file-like src to dest chunk by chunk, returning (sha256 hex, size).
+
+    digest, if given, is a hashlib sha256 to continue, so the hash covers
+    whatever it has already seen followed by src.
+    """
+    digest = hashlib.sha256() if digest is None else digest
+    size = 0
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+        dest.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+class StorageBackend(abc.ABC):
+    """Interface shared by the storage drivers.
+
+    download returns None when the key does not exist and raises on other
+    errors; the module-level helpers below turn errors into logged failures.
+    What it returns may be a mapping of the file, so pass it to
+    release_content() once done with it.
+    """
+
+    @abc.abstractmethod
+    def upload_file(self, key, path):
+        """Store the file at local path under key"""
+
+    @abc.abstractmethod
+    def download(self, key):
+        """The object's contents, bytes-like, or None if there is no such key"""
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Remove the object, if it exists"""
+
+    def get_many(self, keys):
+        """Download several keys concurrently; returns {key: bytes or None}"""
+        keys = list(dict.fromkeys(keys))
+        if len(keys) <= 1:
+            return {key: self._download_logged(key) for key in keys}
+        with ThreadPoolExecutor(max_workers=min(STORAGE_MAX_CONNECTIONS, len(keys)),
+                                thread_name_prefix='storage-fetch') as executor:
+            return dict(zip(keys, executor.map(self._download_logged, keys)))
+
+    def _download_logged(self, key):
+        try:
+            return self.download(key)
+        except Exception as e:
+            logger.error(f"Error retrieving {key} from storage: {str(e)}")
+            return None
+
+class ReplitStorageBackend(StorageBackend):
+    def __init__(self):
+        from replit.object_storage import Client
+        self.client = Client()
+
+    def upload_file(self, key, path):
+        # The client streams the file rather than loading it
+        self.client.upload_from_filename(key, path)
+
+    def download(self, key):
+        return self.client.download_as_bytes(key)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+class LocalStorageBackend(StorageBackend):
+    """Files on local disk, laid out as <root>/<user_id>/<project_id>/<filename>"""
+
+    def __init__(self, root=LOCAL_STORAGE_ROOT, use_mmap=LOCAL_STORAGE_MMAP):
+        self.root = root
+        self.use_mmap = use_mmap
+
+    def path_for(self, key):
+        parts = key.split('/')
+        if len(parts) == 3 and parts[0].startswith('user_') and parts[1].startswith('project_'):
+            parts = [parts[0][len('user_'):], parts[1][len('project_'):], parts[2]]
+        path = os.path.normpath(os.path.join(self.root, *parts))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def upload_file(self, key, path):
+        dest = self.path_for(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Copy next to the destination then rename, so readers never see a partial file
+        tmp = f"{dest}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def download(self, key):
+        """File contents as bytes, or as a read-only mmap (which is bytes-like
+        and file-like) when use_mmap is set, so large files are paged in
+        lazily instead of being copied into memory."""
+        path = self.path_for(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            if self.use_mmap and os.fstat(f.fileno()).st_size > 0:
+                # The mapping stays valid after the file is closed, until
+                # release_content() closes it
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+
+class S3StorageBackend(StorageBackend):
+    """Any S3-compatible service. One client, with a connection pool, is
+    shared across threads."""
+
+    def __init__(self, bucket=S3_BUCKET, endpoint_url=S3_ENDPOINT_URL):
+        import boto3
+        from botocore.config import Config
+        if not bucket:
+            raise ValueError("S3_BUCKET environment variable is not set")
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=STORAGE_MAX_CONNECTIONS, retries={'mode': 'standard'})
+        )
+
+    def upload_file(self, key, path):
+        # upload_file switches to multipart uploads for large files
+        self.client.upload_file(path, self.bucket, key)
+
+    def download(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+STORAGE_BACKENDS = {
+    'replit': ReplitStorageBackend,
+    'local': LocalStorageBackend,
+    's3': S3StorageBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_storage():
+    """The configured backend, created on first use and shared afterwards"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if STORAGE_BACKEND not in STORAGE_BACKENDS:
+                    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+                _backend = STORAGE_BACKENDS[STORAGE_BACKEND]()
+    return _backend
+
+def set_storage(backend):
+    """Swap the storage backend (e.g. a LocalStorageBackend in tests)"""
+    global _backend
+    _backend = backend
+
+def upload_file_to_storage(path, key):
+    """Upload a file on local disk without loading it into memory"""
     try:
-        # Read the file data
-        data = file_data.read()
-        # Upload to object storage
-        client.upload_from_bytes(key, data)
+        get_storage().upload_file(key, path)
         logger.info(f"Successfully saved file to object storage: {key}")
         return True
     except Exception as e:
         logger.error(f"Error saving to object storage: {str(e)}")
         return False
 
+def save_to_storage(file_data, key):
+    """Stream a file-like object to storage.
+
+    Returns the sha256 of the content on success, None on failure.
+    """
+    try:
+        with tempfile.NamedTemporaryFile(prefix='upload-') as spool:
+            content_hash, size = copy_in_chunks(file_data, spool)
+            spool.flush()
+            if not upload_file_to_storage(spool.name, key):
+                return None
+        logger.info(f"Stored {size} bytes at {key}")
+        return content_hash
+    except Exception as e:
+        logger.error(f"Error saving to object storage: {str(e)}")
+        return None
+
 def get_from_storage(key):
     try:
         # Download from object storage
-        data = client.download_as_bytes(key)
+        data = get_storage().download(key)
         if data is None:
             logger.warning(f"No data found for key: {key}")
             return None
@@ -31,16 +240,25 @@ def get_from_storage(key):
         logger.error(f"Error retrieving from object storage: {str(e)}")
         return None
 
+def release_content(data):
+    """Close what a download returned if it is a file mapping; bytes and None are left alone"""
+    if isinstance(data, mmap.mmap):
+        data.close()
+
 def delete_from_storage(key):
     """Delete file from object storage"""
     try:
-        client.delete(key)
+        get_storage().delete(key)
         logger.info(f"Successfully deleted file from object storage: {key}")
         return True
     except Exception as e:
         logger.error(f"Error deleting from object storage: {str(e)}")
         return False
 
+def get_many_from_storage(keys):
+    """Fetch several objects concurrently; returns {key: bytes or None}"""
+    return get_storage().get_many(keys)
+
 def generate_storage_key(user_id, project_id, filename):
     # Create a unique key for each file in the format: user_<id>/project_<id>/<filename>
     return f"user_{user_id}/project_{project_id}/{filename}"
@@ -0,0 +1,96 @@
+"""Persistent cache of document summaries.
+
+Entries are keyed by the SHA-256 of the PDF bytes together with the summary
+prompt version and model, so an unchanged exhibit is never summarized twice
+and changing the prompt or model naturally invalidates old entries.
+"""
+import os
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from flask import has_app_context
+from models import db, SummaryCache
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get('SUMMARY_CACHE_MAX_ENTRIES', '5000'))
+SUMMARY_CACHE_MAX_AGE_DAYS = int(os.environ.get('SUMMARY_CACHE_MAX_AGE_DAYS', '90'))
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def make_cache_key(document_hash, prompt_version, model):
+    return hashlib.sha256(f"{document_hash}:{prompt_version}:{model}".encode('utf-8')).hexdigest()
+
+def cache_enabled():
+    """The cache lives in the app database, so it is only used inside an app context"""
+    return has_app_context()
+
+def _count(name, amount=1):
+    with _stats_lock:
+        _stats[name] += amount
+
+def cache_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+def get_cached_summaries(cache_keys):
+    """Return {cache_key: summary} for every key that is cached, marking them used"""
+    keys = set(cache_keys)
+    if not keys or not cache_enabled():
+        return {}
+
+    entries = SummaryCache.query.filter(SummaryCache.cache_key.in_(keys)).all()
+    now = datetime.utcnow()
+    for entry in entries:
+        entry.hit_count += 1
+        entry.last_used_at = now
+    db.session.commit()
+
+    _count('hits', len(entries))
+    _count('misses', len(keys) - len(entries))
+    return {entry.cache_key: entry.summary for entry in entries}
+
+def store_summary(cache_key, document_hash, prompt_version, model, summary):
+    if not cache_enabled():
+        return
+    try:
+        db.session.add(SummaryCache(
+            cache_key=cache_key,
+            content_hash=document_hash,
+            prompt_version=prompt_version,
+            model=model,
+            summary=summary,
+            size_bytes=len(summary.encode('utf-8'))
+        ))
+        db.session.commit()
+        _count('stores')
+    except Exception as e:
+        # Most likely a concurrent run stored the same key first
+        db.session.rollback()
+        logger.warning(f"Could not cache summary {cache_key[:12]}: {str(e)}")
+
+def evict_summaries(max_entries=None, max_age_days=None):
+    """Drop entries unused for max_age_days, then the least recently used beyond max_entries"""
+    if not cache_enabled():
+        return 0
+    max_entries = SUMMARY_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+    max_age_days = SUMMARY_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    evicted = SummaryCache.query.filter(SummaryCache.last_used_at < cutoff).delete(synchronize_session=False)
+
+    overflow = SummaryCache.query.count() - max_entries
+    if overflow > 0:
+        oldest = db.session.query(SummaryCache.id).order_by(SummaryCache.last_used_at).limit(overflow).subquery()
+        evicted += SummaryCache.query.filter(SummaryCache.id.in_(db.select(oldest.c.id))).delete(synchronize_session=False)
+
+    db.session.commit()
+    if evicted:
+        _count('evictions', evicted)
+        logger.info(f"Evicted {evicted} cached summaries")
+    return evicted
@@ -0,0 +1,247 @@
+"""Structured timeline: dated events parsed from the outline and the exhibits.
+
+Events come from outline lines, from the dates in exhibit filenames
+("2020.07.08 ESY Progress Report.pdf") and, where summaries exist, from their
+dated bullet points. merge_events() puts them in chronological order and
+folds duplicates together (the same event on the same date, reported by the
+outline and by an exhibit, becomes one event citing both); render_markdown()
+turns the result into the timeline shown to users and given to the model.
+
+Dates are recognised in the usual US legal-record forms: "September 1, 2023",
+"Sept. 1st 2023", "1 September 2023", "9/1/2023", "9/1/23", "2023-09-01",
+"2020.07.08", and "September 2023" for events known only to the month.
+"""
+import os
+import re
+from datetime import date
+from itertools import count
+from sqlalchemy import select
+from models import db, TimelineEvent
+
+_MONTHS = {
+    'jan': 1, 'january': 1, 'feb': 2, 'february': 2, 'mar': 3, 'march': 3, 'apr': 4, 'april': 4,
+    'may': 5, 'jun': 6, 'june': 6, 'jul': 7, 'july': 7, 'aug': 8, 'august': 8,
+    'sep': 9, 'sept': 9, 'september': 9, 'oct': 10, 'october': 10, 'nov': 11, 'november': 11,
+    'dec': 12, 'december': 12,
+}
+_MONTH = r'(?<![a-z])(?P<month>' + '|'.join(sorted(_MONTHS, key=len, reverse=True)) + r')\.?'
+_DAY = r'(?P<day>\d{1,2})(?:st|nd|rd|th)?'
+_YEAR = r'(?P<year>\d{4})(?!\d)'
+
+# (pattern, precision); the earliest match in a line wins, the longest on a tie.
+# Boundaries are lookarounds rather than \b so "2020.07.08_ESY" (a
+# secure_filename'd upload) still matches.
+_DATE_PATTERNS = [
+    (re.compile(r'(?<!\d)(?P<year>\d{4})[-./](?P<mon>\d{1,2})[-./](?P<day>\d{1,2})(?!\d)'), 'day'),
+    (re.compile(r'(?<!\d)(?P<mon>\d{1,2})[/.-](?P<day>\d{1,2})[/.-](?P<year>\d{4}|\d{2})(?!\d)'), 'day'),
+    (re.compile(rf'{_MONTH}\s+{_DAY},?\s+{_YEAR}', re.IGNORECASE), 'day'),
+    (re.compile(rf'(?<!\d){_DAY}\s+{_MONTH},?\s+{_YEAR}', re.IGNORECASE), 'day'),
+    (re.compile(rf'{_MONTH},?\s+{_YEAR}', re.IGNORECASE), 'month'),
+]
+
+_WORD = re.compile(r'[a-z0-9]+')
+_MARKDOWN = re.compile(r'[*_`]+')
+_LEADING_PUNCTUATION = re.compile(r'^[\s:;,.\-–—]+')
+_BULLET = re.compile(r'^\s*(?:[-*+]|\d+\.)\s+')
+_STOPWORDS = frozenset('a an and are as at by for from in is of on or the to was were with'.split())
+
+# Bump when parsing, merging or rendering changes so stored timelines are rebuilt
+TIMELINE_VERSION = '3'
+
+OUTLINE, DOCUMENT = 0, 1  # outline lines sort before exhibit events on the same date
+
+class Event:
+    """One timeline event. date is None for undated lines, which keep their
+    place after the dated line that preceded them in the outline."""
+
+    __slots__ = ('date', 'precision', 'text', 'sources', 'sort_key', 'words')
+
+    def __init__(self, event_date, precision, text, sources=(), sort_key=None):
+        self.date = event_date
+        self.precision = precision
+        self.text = text
+        self.sources = list(sources)
+        self.sort_key = sort_key
+        self.words = frozenset(_WORD.findall(text.lower())) - _STOPWORDS
+
+    def to_dict(self):
+        return {
+            'date': self.date.isoformat() if self.date else None,
+            'precision': self.precision,
+            'text': self.text,
+            'sources': self.sources
+        }
+
+def _year(value):
+    year = int(value)
+    if len(value) == 2:
+        year += 2000 if year < 70 else 1900
+    return year
+
+def find_date(text):
+    """(date, precision, start, end) of the first date in text, or None"""
+    best = None
+    for pattern, precision in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            groups = match.groupdict()
+            month = int(groups['mon']) if groups.get('mon') else _MONTHS[groups['month'].lower()]
+            try:
+                found = date(_year(groups['year']), month, int(groups.get('day') or 1))
+            except ValueError:
+                continue
+            candidate = (found, precision, match.start(), match.end())
+            if best is None or (match.start(), -match.end()) < (best[2], -best[3]):
+                best = candidate
+            break
+    return best
+
+def _split_dated(line):
+    """(date, precision, text without the date) for a line of prose"""
+    line = _MARKDOWN.sub('', _BULLET.sub('', line)).strip()
+    found = find_date(line)
+    if not found:
+        return None, None, line
+    event_date, precision, start, end = found
+    if start == 0:
+        text = _LEADING_PUNCTUATION.sub('', line[end:])
+    else:
+        text = line
+    return event_date, precision, text.strip() or line
+
+def events_from_outline(outline_text, source=None):
+    """One event per non-empty outline line, dated where the line has a date"""
+    events = []
+    last_date = date.min
+    sequence = count()
+    for line in outline_text.splitlines():
+        if not line.strip():
+            continue
+        event_date, precision, text = _split_dated(line)
+        last_date = event_date or last_date
+        events.append(Event(event_date, precision, text, [source] if source else (),
+                            (last_date, OUTLINE, next(sequence))))
+    return events
+
+def event_from_filename(filename):
+    """The exhibit itself as an event, if its filename starts with a date"""
+    name = os.path.splitext(os.path.basename(filename))[0]
+    found = find_date(name)
+    if not found or found[2] != 0:
+        return None
+    event_date, precision, _, end = found
+    title = _LEADING_PUNCTUATION.sub('', name[end:]).replace('_', ' ').strip() or 'Document'
+    return Event(event_date, precision, title, [filename], (event_date, DOCUMENT, 0))
+
+def events_from_summary(summary, filename):
+    """Dated bullet points of an exhibit summary"""
+    events = []
+    for sequence, line in enumerate(summary.splitlines()):
+        if not _BULLET.match(line):
+            continue
+        event_date, precision, text = _split_dated(line)
+        if event_date:
+            events.append(Event(event_date, precision, text, [filename], (event_date, DOCUMENT, sequence)))
+    return events
+
+def events_from_passage(text, source):
+    """Dated lines of a passage of exhibit text"""
+    events = []
+    for sequence, line in enumerate(text.splitlines()):
+        event_date, precision, description = _split_dated(line)
+        if event_date:
+            events.append(Event(event_date, precision, description, [source], (event_date, DOCUMENT, sequence)))
+    return events
+
+def build_events(outline_text, filenames=(), summaries=None):
+    """Every event of a case: outline lines, dated exhibit filenames and,
+    if summaries ({filename: summary}) are given, their dated bullets"""
+    events = events_from_outline(outline_text)
+    for filename in filenames:
+        event = event_from_filename(filename)
+        if event:
+            events.append(event)
+    for filename, summary in (summaries or {}).items():
+        events.extend(events_from_summary(summary or '', filename))
+    return merge_events(events)
+
+def _same_event(a, b):
+    # One description's significant words contain the other's
+    return a.words <= b.words or b.words <= a.words
+
+def merge_events(events):
+    """Chronological order with duplicates folded together.
+
+    A sort by (date, outline before exhibits, original order) puts every
+    candidate duplicate on the same date; each event is then only compared
+    with the events already kept for its date, so the whole merge is
+    O(n log n) for the sort plus a few comparisons per event. The kept event
+    is the first one (so outline wording wins) and collects the sources of
+    the ones folded into it.
+    """
+    ordered = sorted(events, key=lambda event: event.sort_key)
+    kept = []
+    by_date = {}
+    for event in ordered:
+        if event.date is None or not event.words:
+            kept.append(event)
+            continue
+        same_day = by_date.setdefault((event.date, event.precision), [])
+        for other in same_day:
+            if _same_event(event, other):
+                other.sources.extend(source for source in event.sources if source not in other.sources)
+                break
+        else:
+            same_day.append(event)
+            kept.append(event)
+    return kept
+
+def format_date(event_date, precision):
+    if precision == 'month':
+        return f"{event_date:%B} {event_date.year}"
+    return f"{event_date:%B} {event_date.day}, {event_date.year}"
+
+def render_markdown(events):
+    """The markdown timeline, one '- ' line per event"""
+    lines = ["# Timeline of Events", ""]
+    for event in events:
+        line = f"- **{format_date(event.date, event.precision)}**: {event.text}" if event.date else f"- {event.text}"
+        if event.sources:
+            line += f" _({'; '.join(event.sources)})_"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def save_events(project_id, events):
+    """Replace the stored events of a project; the caller commits"""
+    TimelineEvent.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(TimelineEvent, [{
+        'project_id': project_id,
+        'position': position,
+        'event_date': event.date,
+        'precision': event.precision,
+        'description': event.text,
+        'sources': event.sources or None
+    } for position, event in enumerate(events)])
+
+def load_events(project_id, start=None, end=None):
+    """Stored events of a project in timeline order, optionally only those
+    dated within [start, end]; undated events are left out of a range"""
+    return rows_to_events(db.session.scalars(select_events(project_id, start, end)))
+
+def select_events(project_id, start=None, end=None):
+    """load_events' query, for running on any session"""
+    query = select(TimelineEvent).filter_by(project_id=project_id)
+    if start:
+        query = query.filter(TimelineEvent.event_date >= start)
+    if end:
+        query = query.filter(TimelineEvent.event_date <= end)
+    return query.order_by(TimelineEvent.position)
+
+def rows_to_events(rows):
+    return [Event(row.event_date, row.precision, row.description, row.sources or ()) for row in rows]
+
+def filter_events(events, start=None, end=None):
+    """load_events' date range, for events not read from the database"""
+    return [
+        event for event in events
+        if event.date and (not start or event.date >= start) and (not end or event.date <= end)
+    ]
@@ -0,0 +1,402 @@
+"""Uploads of exhibits: resumable chunked uploads for large files, and bulk
+ingest of many small ones in a single request.
+
+A client opens an upload session, PUTs the file in chunks at increasing
+offsets (asking for the received offset to resume after a failure), then
+completes the session, at which point the assembled file is streamed to
+object storage. Chunks are appended to a part file on local disk, so no
+request ever holds more than one chunk in memory.
+
+ingest_documents() takes the files of one multipart request, writes them to
+object storage in parallel and adds their Document rows in one statement;
+see its docstring for deduplication and failure handling.
+"""
+import os
+import hashlib
+import secrets
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from models import db, Document, DocumentPage, UploadSession, lock_project
+from utils.storage import (
+    STORAGE_CHUNK_SIZE, STORAGE_MAX_CONNECTIONS, copy_in_chunks, get_storage, upload_file_to_storage,
+    generate_storage_key
+)
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_TMP_DIR = os.environ.get('UPLOAD_TMP_DIR', os.path.join('instance', 'uploads'))
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', str(1024 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get('UPLOAD_SESSION_TTL_HOURS', '24'))
+# Files of one bulk upload written to object storage at once
+BULK_UPLOAD_CONCURRENCY = int(os.environ.get('BULK_UPLOAD_CONCURRENCY', str(STORAGE_MAX_CONNECTIONS)))
+# Times a bulk upload picks its filenames again after losing one to a concurrent upload
+BULK_UPLOAD_NAME_RETRIES = 3
+
+class UploadError(Exception):
+    """An upload request the client got wrong; carries the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# upload id -> hashlib sha256 of the bytes received so far, kept by the
+# process that appended them; upload.content_hash is its hex digest
+_running_hashes = {}
+
+def _part_path(upload):
+    return os.path.join(UPLOAD_TMP_DIR, f"{upload.id}.part")
+
+def _running_hash(upload):
+    """A copy of the hash of the bytes upload has received, or None if this process does not have it"""
+    if upload.received == 0:
+        return hashlib.sha256()
+    digest = _running_hashes.get(upload.id)
+    if digest is None or digest.hexdigest() != upload.content_hash:
+        return None
+    return digest.copy()
+
+def start_upload(user_id, project_id, filename, file_type, total_size):
+    if total_size < 0 or total_size > MAX_UPLOAD_SIZE:
+        raise UploadError(f'File size must be between 0 and {MAX_UPLOAD_SIZE} bytes', 413)
+
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    upload = UploadSession(
+        id=secrets.token_hex(16),
+        user_id=user_id,
+        project_id=project_id,
+        filename=filename,
+        file_type=file_type,
+        total_size=total_size
+    )
+    open(_part_path(upload), 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    return upload
+
+def append_chunk(upload, offset, stream):
+    """Append the body of a chunk request at offset.
+
+    offset must equal the bytes received so far; a mismatch is a 409 carrying
+    the offset the client should resume from. The chunk is received into a
+    file of its own and only appended to the part file once a conditional
+    UPDATE on (id, received) has claimed the offset, so of two requests
+    sending the same offset only one is appended.
+    """
+    if upload.status != 'open':
+        raise UploadError('Upload is already complete', 409)
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}', 409)
+
+    # Hash the chunk on its way to disk; a chunk that is rejected or cut
+    # short leaves the stored state untouched
+    digest = _running_hash(upload)
+    fd, chunk_path = tempfile.mkstemp(prefix=f'{upload.id}-', suffix='.chunk', dir=UPLOAD_TMP_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as chunk:
+            content_hash, size = copy_in_chunks(stream, chunk, STORAGE_CHUNK_SIZE, digest=digest)
+        if offset + size > upload.total_size:
+            raise UploadError('Chunk runs past the declared file size', 413)
+
+        claimed = UploadSession.query.filter_by(id=upload.id, status='open', received=offset).update({
+            'received': offset + size,
+            'content_hash': content_hash if digest is not None else None,
+            'updated_at': datetime.utcnow()
+        }, synchronize_session=False)
+        if not claimed:
+            db.session.rollback()
+            db.session.refresh(upload)
+            if upload.status != 'open':
+                raise UploadError('Upload is already complete', 409)
+            raise UploadError(f'Expected offset {upload.received}', 409)
+
+        # The UPDATE holds the row until the commit, so nothing reads the
+        # part file's new length before the chunk is in it
+        with open(chunk_path, 'rb') as chunk, open(_part_path(upload), 'r+b') as part:
+            part.seek(offset)
+            part.truncate()
+            copy_in_chunks(chunk, part, STORAGE_CHUNK_SIZE)
+        db.session.commit()
+    finally:
+        os.remove(chunk_path)
+
+    if digest is None:
+        _running_hashes.pop(upload.id, None)
+    else:
+        _running_hashes[upload.id] = digest
+    db.session.refresh(upload)
+    return upload
+
+def complete_upload(upload):
+    """Send the assembled file to object storage; returns its sha256.
+
+    The upload is marked complete with a conditional UPDATE on (id,
+    status='open') first, so a second request completing it at the same
+    time gets a 409 instead of storing the file twice. The caller commits.
+    """
+    if upload.status != 'open':
+        raise UploadError('Upload is already complete', 409)
+    if upload.received != upload.total_size:
+        raise UploadError(f'Upload incomplete: {upload.received} of {upload.total_size} bytes received', 409)
+
+    claimed = UploadSession.query.filter_by(id=upload.id, status='open', received=upload.total_size).update({
+        'status': 'complete',
+        'updated_at': datetime.utcnow()
+    }, synchronize_session=False)
+    if not claimed:
+        raise UploadError('Upload is already complete', 409)
+
+    path = _part_path(upload)
+    content_hash = upload.content_hash
+    if content_hash is None:
+        # The chunks were not all hashed in one process (e.g. it restarted)
+        with open(path, 'rb') as part:
+            content_hash, _ = copy_in_chunks(part, _NullWriter())
+
+    key = generate_storage_key(upload.user_id, upload.project_id, upload.filename)
+    if not upload_file_to_storage(path, key):
+        raise UploadError('Error saving file to storage', 500)
+
+    os.remove(path)
+    _running_hashes.pop(upload.id, None)
+    return content_hash
+
+def expire_uploads():
+    """Delete upload sessions (and their part files) idle for longer than the TTL"""
+    cutoff = datetime.utcnow() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    stale = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+    for upload in stale:
+        try:
+            os.remove(_part_path(upload))
+        except FileNotFoundError:
+            pass
+        _running_hashes.pop(upload.id, None)
+        db.session.delete(upload)
+    db.session.commit()
+    return len(stale)
+
+class BulkUploadError(UploadError):
+    """A bulk upload that stored nothing; results says what happened to each file"""
+
+    def __init__(self, message, results, status=500):
+        super().__init__(message, status)
+        self.results = results
+
+def _spool(item):
+    """Copy an item's uploaded file to local disk, hashing it on the way.
+
+    The path is recorded on the item as soon as the file exists, so the
+    caller can remove it even if another file of the upload fails to spool.
+    """
+    fd, item['path'] = tempfile.mkstemp(prefix='bulk-', dir=UPLOAD_TMP_DIR)
+    with os.fdopen(fd, 'wb') as out:
+        item['content_hash'], item['size'] = copy_in_chunks(item['file'].stream, out)
+
+def _store(item):
+    """Upload one spooled file; returns the error message, or None on success"""
+    try:
+        get_storage().upload_file(item['key'], item['path'])
+        return None
+    except Exception as e:
+        logger.error(f"Error saving {item['key']} to object storage: {str(e)}")
+        return str(e)
+
+def _discard(key):
+    try:
+        get_storage().delete(key)
+    except Exception as e:
+        logger.error(f"Could not remove {key} after a failed upload: {str(e)}")
+
+def _free_filename(filename, content_hash, taken):
+    """filename, or a variant tagged with the content hash if a different file already has it"""
+    if filename not in taken:
+        return filename
+    stem, ext = os.path.splitext(filename)
+    candidate, n = f"{stem}-{content_hash[:8]}{ext}", 2
+    while candidate in taken:
+        candidate, n = f"{stem}-{content_hash[:8]}-{n}{ext}", n + 1
+    return candidate
+
+def _name_items(user_id, project_id, items):
+    """Mark the items whose content the project already has as duplicates and
+    give the rest a free filename and storage key; returns the rest"""
+    hashes = {item['content_hash'] for item in items}
+    existing = dict(db.session.query(Document.content_hash, Document.filename).filter(
+        Document.project_id == project_id,
+        Document.file_type == 'supporting',
+        Document.content_hash.in_(hashes)
+    ).all())
+    taken = {name for (name,) in db.session.query(Document.filename).filter(Document.project_id == project_id)}
+
+    new_items = []
+    for item in items:
+        result = item['result']
+        result.pop('duplicate_of', None)
+        if item['content_hash'] in existing:
+            result.update(status='duplicate', stored_as=None, duplicate_of=existing[item['content_hash']])
+            continue
+        filename = _free_filename(item['filename'], item['content_hash'], taken)
+        taken.add(filename)
+        existing[item['content_hash']] = filename
+        item['key'] = generate_storage_key(user_id, project_id, filename)
+        result.update(status='pending', stored_as=filename)
+        new_items.append(item)
+    return new_items
+
+def _insert_documents(project_id, items):
+    """Insert the Document rows of items in one statement; returns their ids"""
+    if not items:
+        return []
+    now = datetime.utcnow()
+    return db.session.scalars(
+        insert(Document).returning(Document.id, sort_by_parameter_order=True),
+        [{
+            'project_id': project_id,
+            'filename': item['result']['stored_as'],
+            'file_type': 'supporting',
+            'content_hash': item['content_hash'],
+            'created_at': now
+        } for item in items]
+    ).all()
+
+def record_document(project_id, filename, file_type, content_hash):
+    """The Document for a file just stored under filename, in the caller's
+    transaction. Storing it replaced the object of any document of the
+    project with that name, so such a document is reset to the new content
+    rather than a second row added."""
+    lock_project(project_id)
+    document = Document.query.filter_by(project_id=project_id, filename=filename).first()
+    if document is None:
+        document = Document(project_id=project_id, filename=filename, file_type=file_type, content_hash=content_hash)
+        db.session.add(document)
+        return document
+    DocumentPage.query.filter_by(document_id=document.id).delete()
+    document.file_type = file_type
+    document.content_hash = content_hash
+    document.extraction_status = 'pending'
+    document.extraction_error = None
+    document.page_count = document.text_pages = document.ocr_pages = document.failed_pages = None
+    return document
+
+def ingest_documents(user_id, project_id, files, before_commit=None):
+    """Store the supporting documents of one multipart upload.
+
+    Each file is spooled to disk and hashed, then:
+      - a file whose content is already in the project, or repeats an
+        earlier file of the same upload, is not stored again ('duplicate');
+      - all the rest's Document rows are inserted with one statement, under
+        their own name or, if a different file of the project already has
+        that name, the name tagged with the content hash; if a concurrent
+        upload takes a name first, the names are picked again, up to
+        BULK_UPLOAD_NAME_RETRIES times;
+      - their files are written to object storage BULK_UPLOAD_CONCURRENCY
+        at a time.
+
+    before_commit, if given, is called with the new document ids inside the
+    same transaction (e.g. to queue their extraction jobs). Either every new
+    file is stored and recorded or none is: if a write, the insert or the
+    commit fails, the session is rolled back, the objects already written
+    are deleted and BulkUploadError is raised. Returns (results,
+    document_ids), results holding one entry per file in upload order.
+    """
+    results = []
+    items = []
+    for file in files:
+        if not file.filename:
+            continue
+        filename = secure_filename(file.filename)
+        result = {'filename': file.filename, 'stored_as': None, 'status': 'pending'}
+        results.append(result)
+        if not filename:
+            result.update(status='skipped', message='Invalid filename')
+            continue
+        items.append({'file': file, 'filename': filename, 'result': result})
+    if not items:
+        return results, []
+
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    workers = max(1, min(BULK_UPLOAD_CONCURRENCY, len(items)))
+    stored_keys = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk-upload') as executor:
+            # Leaving the executor waits for every spool, so each file on
+            # disk is on its item by the time the finally below runs
+            list(executor.map(_spool, items))
+            for item in items:
+                item['result'].update(content_hash=item['content_hash'], size=item['size'])
+
+            # Pick the names and insert the rows before writing any object,
+            # under the project lock: until the commit, a concurrent upload
+            # waits, so it never takes a name these files' objects are being
+            # written under. A row added without the lock is caught by the
+            # unique (project_id, filename) constraint and the names picked again.
+            for attempt in range(BULK_UPLOAD_NAME_RETRIES + 1):
+                lock_project(project_id)
+                new_items = _name_items(user_id, project_id, items)
+                try:
+                    document_ids = _insert_documents(project_id, new_items)
+                    break
+                except IntegrityError:
+                    db.session.rollback()
+                    if attempt == BULK_UPLOAD_NAME_RETRIES:
+                        raise BulkUploadError('Files with these names are being uploaded to this project; '
+                                              'try again', results, 409)
+                    logger.info(f"Filename taken by a concurrent upload to project {project_id}; renaming")
+
+            errors = list(executor.map(_store, new_items))
+            stored_keys = [item['key'] for item, error in zip(new_items, errors) if error is None]
+            if any(errors):
+                for item, error in zip(new_items, errors):
+                    if error:
+                        item['result'].update(status='failed', message=error)
+                    else:
+                        item['result'].update(status='rolled_back')
+                raise BulkUploadError('Some files could not be stored; nothing was saved', results)
+
+        if new_items and before_commit:
+            before_commit(document_ids)
+        db.session.commit()
+        for item, document_id in zip(new_items, document_ids):
+            item['result'].update(status='stored', document_id=document_id)
+        return results, document_ids
+    except BulkUploadError:
+        _roll_back(stored_keys)
+        raise
+    except Exception as e:
+        _roll_back(stored_keys)
+        for result in results:
+            if result['status'] == 'pending':
+                result.update(status='rolled_back')
+        raise BulkUploadError(f'Error saving documents: {str(e)}', results) from e
+    except BaseException:
+        # KeyboardInterrupt, SystemExit and the like: undo, then let them through unchanged
+        _roll_back(stored_keys)
+        raise
+    finally:
+        for item in items:
+            if item.get('path'):
+                try:
+                    os.remove(item['path'])
+                except FileNotFoundError:
+                    pass
+
+def _roll_back(stored_keys):
+    db.session.rollback()
+    _discard_all(stored_keys)
+
+def _discard_all(keys):
+    """Delete objects written by an upload that is being rolled back"""
+    if not keys:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_UPLOAD_CONCURRENCY, len(keys))),
+                            thread_name_prefix='bulk-upload-cleanup') as executor:
+        list(executor.map(_discard, keys))
+
+class _NullWriter:
+    def write(self, data):
+        pass
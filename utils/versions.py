@@ -0,0 +1,159 @@
+"""Output history: every finished run is kept as a version of the project's output.
+
+The latest version stays in the outputs row, so reading it costs exactly
+what it did before. Every version is also recorded in output_versions as a
+line delta against the version before it: difflib opcodes, where unchanged
+runs of lines are [start, stop] references into the previous version and
+only new lines are stored as text, as zlib-compressed JSON. Every
+OUTPUT_SNAPSHOT_INTERVAL versions, and whenever a delta would be no smaller,
+a compressed full snapshot is stored instead, so rebuilding an old version
+applies at most that many deltas to the nearest snapshot before it.
+
+A narrative still being streamed is a draft in the outputs row and becomes
+a version only once it is complete.
+"""
+import os
+import json
+import zlib
+import difflib
+import hashlib
+from sqlalchemy import func
+from sqlalchemy.orm import undefer
+from models import db, OutputVersion
+
+OUTPUT_SNAPSHOT_INTERVAL = int(os.environ.get('OUTPUT_SNAPSHOT_INTERVAL', '10'))
+
+KINDS = ('timeline', 'narrative')
+
+class VersionError(Exception):
+    """A version that does not exist or cannot be rebuilt"""
+
+def make_delta(base, text):
+    """Ops rebuilding text from base: [start, stop] copies base lines, a string is inserted"""
+    base_lines = base.splitlines(keepends=True)
+    lines = text.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            ops.append(''.join(lines[j1:j2]))
+    return ops
+
+def apply_delta(base, ops):
+    base_lines = base.splitlines(keepends=True)
+    return ''.join(''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+def _pack(payload):
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'), 6)
+
+def _unpack(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def _sha256(text):
+    return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+def _content(output):
+    return output.timeline_content or '', output.narrative_content or ''
+
+def record_version(output, previous):
+    """Add the output's content to its history as version output.version.
+
+    previous is (timeline, narrative) of the version before it, or None if
+    there is none; the caller commits. Returns the new row.
+    """
+    content = _content(output)
+    data = _pack([[text] if text else [] for text in content])
+    base_version = None
+    if previous is not None and output.version % OUTPUT_SNAPSHOT_INTERVAL:
+        delta = _pack([make_delta(base, text) for base, text in zip(previous, content)])
+        if len(delta) < len(data):
+            data, base_version = delta, output.version - 1
+    row = OutputVersion(
+        project_id=output.project_id,
+        version=output.version,
+        base_version=base_version,
+        timeline_hash=output.timeline_hash,
+        narrative_hash=output.narrative_hash,
+        data=data,
+        size_bytes=len(data)
+    )
+    db.session.add(row)
+    return row
+
+def record_unversioned(output):
+    """Enter an output saved before versions were kept into its history
+    before it is overwritten. Returns its latest version's row, or None if
+    the output has no versions yet."""
+    if not output.version:
+        return None
+    latest = OutputVersion.query.filter_by(project_id=output.project_id, version=output.version).first()
+    if latest is None:
+        if output.timeline_hash is None or output.narrative_hash is None:
+            output.update_hashes()
+        latest = record_version(output, None)
+    return latest
+
+def previous_content(output):
+    """(timeline, narrative) of the output's latest version, before new
+    content replaces it; None if there is none"""
+    latest = record_unversioned(output)
+    if latest is None:
+        return None
+    if (output.timeline_hash, output.narrative_hash) == (latest.timeline_hash, latest.narrative_hash):
+        return _content(output)
+    # The outputs row holds a draft; the version is only in the history
+    return rebuild_version(output.project_id, output.version)
+
+def rebuild_version(project_id, version):
+    """(timeline, narrative) of a version, from its nearest snapshot and the deltas after it"""
+    snapshot = db.session.query(func.max(OutputVersion.version)).filter(
+        OutputVersion.project_id == project_id,
+        OutputVersion.base_version.is_(None),
+        OutputVersion.version <= version
+    ).scalar()
+    if snapshot is None:
+        raise VersionError(f'Version {version} not found')
+    rows = OutputVersion.query.options(undefer(OutputVersion.data)).filter(
+        OutputVersion.project_id == project_id,
+        OutputVersion.version.between(snapshot, version)
+    ).order_by(OutputVersion.version).all()
+    if rows[-1].version != version:
+        raise VersionError(f'Version {version} not found')
+
+    content = ('', '')
+    for row in rows:
+        ops = _unpack(row.data)
+        if row.base_version is None:
+            content = tuple(apply_delta('', kind_ops) for kind_ops in ops)
+        else:
+            content = tuple(apply_delta(base, kind_ops) for base, kind_ops in zip(content, ops))
+    if (_sha256(content[0]), _sha256(content[1])) != (rows[-1].timeline_hash, rows[-1].narrative_hash):
+        raise VersionError(f'Version {version} could not be rebuilt')
+    return content
+
+def get_version(output, version):
+    """(timeline, narrative) of a version; the latest one is read straight from the outputs row"""
+    if version == output.version:
+        latest = OutputVersion.query.filter_by(project_id=output.project_id, version=version).first()
+        if latest is None or (latest.timeline_hash, latest.narrative_hash) == (output.timeline_hash, output.narrative_hash):
+            return _content(output)
+    return rebuild_version(output.project_id, version)
+
+def list_versions(project_id):
+    """The project's versions, newest first, without their content"""
+    return OutputVersion.query.filter_by(project_id=project_id).order_by(OutputVersion.version.desc()).all()
+
+def diff_versions(output, from_version, to_version, kind='narrative'):
+    """Unified diff of one kind of content between two versions, and its line counts"""
+    position = KINDS.index(kind)
+    before = get_version(output, from_version)[position]
+    after = get_version(output, to_version)[position]
+    lines = list(difflib.unified_diff(
+        before.splitlines(keepends=True), after.splitlines(keepends=True),
+        fromfile=f'{kind} v{from_version}', tofile=f'{kind} v{to_version}'
+    ))
+    added = sum(1 for line in lines if line.startswith('+') and not line.startswith('+++'))
+    removed = sum(1 for line in lines if line.startswith('-') and not line.startswith('---'))
+    return ''.join(line if line.endswith('\n') else line + '\n' for line in lines), added, removed